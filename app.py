@@ -1,161 +1,247 @@
 import asyncio
-import json
 import logging
 import os
+import tempfile
+import time
 import traceback
+from contextlib import aclosing
 from datetime import datetime
-from pprint import pprint
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import aiohttp
-from pony.orm import *
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
 from slack_bolt.async_app import AsyncApp, AsyncSay
 from slack_sdk.errors import SlackApiError
 from slack_sdk.web.async_client import AsyncWebClient
 
-from database import db
-from openai_wrapper import OpenAIWrapper
-from plugins.browsing import browser_text, github, pdf
-from plugins.search import search
-from plugins.youtube import youtube
+from blob_store import migrate_to_blobs
+from context_builder import ContextBuilder
+from conversation_cache import ConversationCache
+from conversation_cleanup import HistoryCleaner
+from conversation_export import ConversationExporter, ndjson_to_gzip_json
+from database import db, run_in_db_thread
+from http_clients import http_clients
+from message_buffer import MessageBuffer
+from metrics import event_seconds, events_total, first_token_seconds, generation_seconds, registry, run_metrics
+from openai_wrapper import OpenAIWrapper, TextDelta, ToolEnd, ToolStart, drop_unanswered_tool_calls
+from plugin import tool_cache
+from plugin_registry import load_tools
+from plugins.documents import rank_tool_output
+from prompt_store import add_extra_prompts, get_thread_extra_prompts
+from thread_scheduler import ThreadScheduler
+from tool_cache import migrate_legacy_cache
 from transcribe import transcribe
+from update_scheduler import UpdateScheduler
+from workers import Supervisor, broadcast, worker_count
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+slack_api_url = os.environ.get("SLACK_API_URL", AsyncWebClient.BASE_URL)
 slack = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+slack.client.base_url = slack_api_url
 openai = OpenAIWrapper()
-
-
-async def download_file(url):
+updater = UpdateScheduler()
+conversations = ConversationCache()
+context = ContextBuilder(openai.model)
+generations = ThreadScheduler()
+registry.gauge(
+    "conversation_cache_hit_rate", "Hit rate of the conversation cache.", func=lambda: conversations.hit_rate
+)
+registry.gauge("tool_cache_hit_rate", "Hit rate of the tool cache.", func=lambda: tool_cache.stats()["hit_rate"])
+audio_max_bytes = int(os.environ.get("AUDIO_MAX_BYTES", 25 * 1024 * 1024))  # the upload limit of Whisper
+# large clips on slow links take longer than the 20 seconds of the shared session, a stalled download still fails
+download_seconds = float(os.environ.get("FILE_DOWNLOAD_TIMEOUT", 300))
+download_timeout = aiohttp.ClientTimeout(total=download_seconds, connect=20, sock_read=60)
+
+
+async def download_file(url, max_bytes: int = audio_max_bytes) -> tempfile.SpooledTemporaryFile:
+    """Streams a Slack file into a temporary file, kept in memory up to 1 MB. Raises ValueError if it fails."""
     logging.debug("Downloading file: %s", url)
-    async with aiohttp.ClientSession() as aiohttp_session:
-        async with aiohttp_session.get(url, headers={"Authorization": f"Bearer {os.environ['SLACK_BOT_TOKEN']}"}) as r:
+    f = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        async with http_clients.aiohttp.get(
+            url, headers={"Authorization": f"Bearer {os.environ['SLACK_BOT_TOKEN']}"}, timeout=download_timeout
+        ) as r:
             if not r.ok:
-                logging.error("Failed to download file: %s", url)
-                return
-            return await r.content.read()
+                raise ValueError(f"download failed with HTTP status {r.status}")
+            size = 0
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"the file is larger than {max_bytes // 1024 // 1024} MB")
+                f.write(chunk)
+        f.seek(0)
+        return f
+    except BaseException:
+        f.close()
+        raise
 
 
-class SlackExtraPrompt(db.Entity):
-    _table_ = "SlackToolCallPrompt"  # historical reasons
-    ts = PrimaryKey(str)
-    channel = Required(str)
-    thread_ts = Optional(str)
-    prompts = Required(Json)
+async def transcribe_audio(file: Dict) -> str:
+    if file.get("size", 0) > audio_max_bytes:
+        raise ValueError(f"the file is larger than {audio_max_bytes // 1024 // 1024} MB")
+    with await download_file(file["url_private"]) as f:
+        transcript = await transcribe((file.get("name") or "audio.m4a", f))
+    return transcript.text
 
 
-@db_session
-def get_extra_prompts(msg_ts):
-    prompt = SlackExtraPrompt.get(ts=msg_ts)
-    return prompt.prompts if prompt else []
+SYSTEM_PROMPTS = [{"role": "system", "content": "You are a helpful assistant."}]
 
 
-@db_session
-def add_extra_prompts(channel, msg_ts, prompts, thread_ts=None):
-    if SlackExtraPrompt.exists(ts=msg_ts):
-        prompt = SlackExtraPrompt.get(ts=msg_ts)
-        prompt.prompts += prompts
-    else:
-        SlackExtraPrompt(ts=msg_ts, channel=channel, thread_ts=thread_ts, prompts=prompts)
-
-
-def generate_prompts(thread_msgs: List[Dict]):
-    yield {"role": "system", "content": "You are a helpful assistant."}
+def generate_turns(thread_msgs: List[Dict], extra_prompts: Dict[str, List]):
     for msg in thread_msgs:
-        for p in get_extra_prompts(msg["ts"]):
-            yield p
+        prompts = list(extra_prompts.get(msg["ts"], []))
         if not msg["text"]:  # skip empty messages, e.g. audio prompts
-            continue
-        if "bot_id" in msg:
-            yield {"role": "assistant", "content": msg["text"]}
+            pass
+        elif "bot_id" in msg:
+            prompts.append({"role": "assistant", "content": msg["text"]})
         elif "user" in msg:
-            yield {"role": "user", "content": msg["text"]}
+            prompts.append({"role": "user", "content": msg["text"]})
         else:
             print("Unknown message type")
+        yield msg["ts"], prompts
 
 
 @slack.event("message")
 async def message_handler(event: Dict, say: AsyncSay, client: AsyncWebClient):
-    async def update_response():
-        nonlocal slack_response, response, channel
-        await client.chat_update(channel=channel, ts=slack_response["ts"], text=response)
+    events_total.inc(kind="hidden" if "hidden" in event else "message")
+    with event_seconds.time():
+        await handle_message(event, say, client)
 
-    async def new_response(msg):
-        nonlocal thread_ts
-        return await say(msg, thread_ts=thread_ts, username="AI Assistant")
 
+async def handle_message(event: Dict, say: AsyncSay, client: AsyncWebClient):
     logging.debug("event: %s", event)
     if "hidden" in event:
         logging.debug("hidden message")
+        conversations.handle_hidden_event(event)
         return
     channel = event["channel"]
     thread_ts = event.get("thread_ts") or event["ts"]
-
-    # transcribe audio files
-    for file in event.get("files", []):
-        if file.get("subtype") == "slack_audio":
-            logging.debug("transcribing audio file")
-            url = file["url_private"]
-            transcript = await transcribe(await download_file(url))
+    conversations.add_message(channel, event, thread_ts)
+
+    # transcribe audio files, concurrently but in the order of the message
+    audio_files = [file for file in event.get("files", []) if file.get("subtype") == "slack_audio"]
+    if audio_files:
+        logging.debug("transcribing %d audio files", len(audio_files))
+        transcripts = await asyncio.gather(*[transcribe_audio(file) for file in audio_files], return_exceptions=True)
+        prompts = []
+        for file, transcript in zip(audio_files, transcripts):
+            if isinstance(transcript, Exception):
+                logging.error("Failed to transcribe audio file %s: %s", file.get("id"), transcript)
+                text = f"Failed to transcribe {file.get('name') or 'audio'}: {transcript}"
+            else:
+                text = f"You: {transcript}"
+                prompts.append({"role": "user", "content": transcript})
             await client.chat_postEphemeral(
-                channel=channel,
-                user=event["user"],
-                username="AI Assistant",
-                text=f"You: {transcript.text}",
-                thread_ts=thread_ts,
+                channel=channel, user=event["user"], username="AI Assistant", text=text, thread_ts=thread_ts
             )
-            add_extra_prompts(channel, event["ts"], [{"role": "user", "content": transcript.text}], thread_ts)
+        if prompts:
+            await add_extra_prompts(channel, event["ts"], prompts, thread_ts)
+
+    # bursts of messages are answered once, and a new message supersedes the reply in progress
+    generations.submit((channel, thread_ts), lambda: generate_response(channel, thread_ts, say, client))
+
+
+async def generate_response(channel: str, thread_ts: str, say: AsyncSay, client: AsyncWebClient):
+    t0 = time.perf_counter()
+
+    def streamed_text() -> str:
+        return "\n".join(filter(None, [buffer.text, status]))
+
+    def update_response(text, final=False):
+        nonlocal slack_response
+        updater.update(client, channel, slack_response["ts"], text, final=final)
+
+    async def new_response(msg):
+        response = await say(msg, thread_ts=thread_ts, username="AI Assistant")
+        conversations.add_message(channel, response["message"], thread_ts)
+        return response
+
+    async def post_chunks():
+        # every finished chunk fills the current message, the remaining text continues in a new one
+        nonlocal slack_response
+        for chunk in buffer.pop_chunks():
+            update_response(chunk, final=True)
+            conversations.update_text(channel, thread_ts, slack_response["ts"], chunk)
+            slack_response = await new_response(buffer.text or "(Thinking...)")
 
     try:
-        thread_msgs = await client.conversations_replies(channel=channel, ts=thread_ts)
+        thread_msgs = await conversations.get(client, channel, thread_ts)
     except SlackApiError:
         logging.error("Failed to fetch thread messages. channel: %s, ts: %s", channel, thread_ts)
         return
-    prompts = list(generate_prompts(thread_msgs["messages"]))
+    extra_prompts = await get_thread_extra_prompts(channel, thread_ts)
+    prompts = await context.build_async(SYSTEM_PROMPTS, generate_turns(thread_msgs, extra_prompts))
     logging.debug("prompts: %s", prompts)
-    response = ""
-    last_send_time = datetime.now()
+    buffer = MessageBuffer()
     old_prompts_len = len(prompts)
     slack_response = await new_response("(Thinking...)")
+    superseded = streaming = False
+    outcome = "ok"
+    running_tools: Dict[str, str] = {}  # tool call id -> function name
+    status = ""
     try:
-        async for delta in openai.generate_reply(prompts):
-            if len(response.encode("utf-8")) + len(delta.encode("utf-8")) > 3000:  # slack message length limit
-                await update_response()
-                response = delta
-                slack_response = await new_response(response)
-                last_send_time = datetime.now()
-            else:
-                response += delta
-            if (datetime.now() - last_send_time).total_seconds() > 1:
-                await update_response()
-                last_send_time = datetime.now()
-    except Exception as e:
-        response += f"(Exception when generating reply: {e})"
-        logging.error("Exception when generating reply: %s", e)
-        traceback.print_exc()
-    if len(prompts) > old_prompts_len:  # new tool calls from assistant
-        add_extra_prompts(channel, slack_response["ts"], prompts[old_prompts_len:], thread_ts)
-    await update_response()
+        try:
+            async with aclosing(openai.generate_reply(prompts)) as reply:
+                async for event in reply:
+                    if isinstance(event, ToolStart):
+                        running_tools[event.tool_call_id] = event.name
+                    elif isinstance(event, ToolEnd):
+                        running_tools.pop(event.tool_call_id, None)
+                    else:
+                        assert isinstance(event, TextDelta)
+                        if not streaming:
+                            streaming = True
+                            first_token_seconds.observe(time.perf_counter() - t0)
+                        buffer.append(event.text)
+                        if buffer.has_chunks():  # slack message length limit
+                            await post_chunks()
+                    status = f"(Running {', '.join(sorted(set(running_tools.values())))}...)" if running_tools else ""
+                    if buffer.size or status:  # merged and paced by the update scheduler, built only when sent
+                        update_response(streamed_text)
+        except asyncio.CancelledError:
+            superseded = True
+            outcome = "superseded"
+            buffer.append("\n(Superseded by a newer message)")
+            await post_chunks()
+        except Exception as e:
+            outcome = "error"
+            buffer.append(f"(Exception when generating reply: {e})")
+            await post_chunks()
+            logging.error("Exception when generating reply: %s", e)
+            traceback.print_exc()
+        new_prompts = drop_unanswered_tool_calls(prompts[old_prompts_len:])
+        if new_prompts:  # new tool calls from assistant
+            await add_extra_prompts(channel, slack_response["ts"], new_prompts, thread_ts)
+        final_text = buffer.text or "(Empty response)"
+        conversations.update_text(channel, thread_ts, slack_response["ts"], final_text)
+        await updater.flush(client, channel, slack_response["ts"], final_text)
+        generation_seconds.observe(time.perf_counter() - t0, outcome=outcome)
+    finally:  # the pending edits of the reply are dropped even if it could not be finalized
+        updater.discard(channel, slack_response["ts"])
+    if superseded:
+        raise asyncio.CancelledError
 
 
 # clear all messages in the IM
 @slack.command("/clear")
 async def clear_all_history(ack, body, client: AsyncWebClient):
-    async def try_delete(channel, ts):
-        try:
-            await client.chat_delete(channel=channel, ts=ts)
-        except Exception as e:
-            pprint(e)
-
     await ack()
-    h = await client.conversations_history(channel=body["channel_id"])
-    for msg in h["messages"]:
-        if msg.get("bot_id"):
-            await try_delete(body["channel_id"], msg["ts"])
-        else:
-            replies = await client.conversations_replies(channel=body["channel_id"], ts=msg["ts"])
-            for reply in replies["messages"]:
-                await try_delete(body["channel_id"], reply["ts"])
+    channel, user = body["channel_id"], body["user_id"]
+
+    async def progress(text):
+        await client.chat_postEphemeral(channel=channel, user=user, text=text)
+
+    try:
+        result = await HistoryCleaner(client, channel, progress).run()
+    except Exception as e:
+        logging.error("Failed to clear history: %s", e)
+        print(traceback.format_exc())
+        await progress(f"Failed to clear history: {e}")
+        return
+    text = f"Deleted {result['deleted']} messages."
+    if result["skipped"] or result["failed"]:
+        text += f" {result['skipped']} could not be deleted, {result['failed']} failed."
+    await progress(text)
 
 
 # set OpenAI key by slash command
@@ -170,73 +256,92 @@ async def set_openai_key(ack, body, client: AsyncWebClient):
     key = body["text"]
     logging.info("Setting OpenAI key: %s", key)
     openai.set_openai_key(key)
+    await broadcast({"type": "openai_key", "key": key})
     await client.chat_postEphemeral(channel=body["channel_id"], user=body["user_id"], text="OpenAI key set")
 
 
-# dump all messages to json
+# dump all messages to a gzip compressed JSON file, or NDJSON with "/dump-conversations ndjson"
+running_exports = set()
+
+
 @slack.command("/dump-conversations")
 async def dump_conversation(ack, body, client: AsyncWebClient):
     await ack()
+    channel, user = body["channel_id"], body["user_id"]
 
-    await client.chat_postEphemeral(
-        channel=body["channel_id"],
-        user=body["user_id"],
-        text="Dumping conversations to JSON file, this may take up to an hour according to your conversation size, "
-        "please wait...",
-    )
+    async def progress(text):
+        await client.chat_postEphemeral(channel=channel, user=user, text=text)
 
+    if (channel, user) in running_exports:
+        await progress("An export of this conversation is already running, please wait...")
+        return
+    ndjson = body.get("text", "").strip().lower() == "ndjson"
+    exporter = ConversationExporter(client, channel, user, progress)
+    running_exports.add((channel, user))
     try:
-        h = await client.conversations_history(channel=body["channel_id"], limit=999)
-        assert h["ok"]
-        msg_history = h["messages"]
-
-        while h["has_more"]:
-            await asyncio.sleep(1)  # need to wait 1 sec before next call due to rate limits
-            h = await client.conversations_history(
-                channel=body["channel_id"], limit=999, cursor=h["response_metadata"]["next_cursor"]
-            )
-            assert h["ok"]
-            messages = h["messages"]
-            msg_history += messages
-
-        # receive all threads
-        msg_replies = []
-        for msg in msg_history:
-            if "thread_ts" in msg:
-                await asyncio.sleep(1)
-                thread = await client.conversations_replies(channel=body["channel_id"], ts=msg["ts"])
-                msg_replies.extend(thread["messages"])
-
-        msg_all = msg_history + msg_replies
-        msg_all.sort(key=lambda x: float(x["ts"]))
-        msg_json = json.dumps(msg_all, ensure_ascii=False)
-
-        await client.files_upload(
-            channels=body["channel_id"],
-            content=msg_json,
-            title="conversations of user {} before {}".format(body["user_id"], datetime.now().strftime("%Y-%m-%d")),
-            filename="conversation.json",
-            initial_comment="Fetched a total of {} messages.".format(len(msg_all)),
-            filetype="json",
+        await progress(
+            "Dumping conversations to a file, this may take a while according to your conversation size. "
+            "If it is interrupted, run the command again to resume."
         )
+        path, count = await exporter.run()
+        if exporter.resumed:
+            logging.info("Resumed the export of %s for %s", channel, user)
+        if ndjson:
+            upload_path, filename = path, "conversation.ndjson"
+        else:
+            upload_path, filename = path + ".json.gz", "conversation.json.gz"
+            await asyncio.to_thread(ndjson_to_gzip_json, path, upload_path)
+        try:
+            await client.files_upload_v2(
+                channel=channel,
+                file=upload_path,
+                title="conversations of user {} before {}".format(user, datetime.now().strftime("%Y-%m-%d")),
+                filename=filename,
+                initial_comment="Fetched a total of {} messages.".format(count),
+            )
+        finally:
+            if upload_path != path:
+                os.remove(upload_path)
+        await exporter.finish()
     except Exception as e:
-        logging.error("Failed to dump conversations to JSON file: %s", e)
+        logging.error("Failed to dump conversations: %s", e)
         print(traceback.format_exc())
-        await client.chat_postEphemeral(
-            channel=body["channel_id"],
-            user=body["user_id"],
-            text=f"Failed to dump conversation to JSON file: {e}",
-        )
+        await progress(f"Failed to dump conversations: {e}. Run the command again to resume.")
+    finally:
+        running_exports.discard((channel, user))
 
 
-async def main():
+async def on_socket_message(client, message: Dict, raw_message: Optional[str] = None):
+    """Listener of all Socket Mode messages: a hello starts every new connection, a reconnect included."""
+    if message.get("type") == "hello":
+        conversations.clear()
+
+
+async def setup():
+    """Prepares this process to handle events: the database mapping, the tools and the token encoding."""
     db.generate_mapping(create_tables=True, check_tables=True)
-    openai.add_function(browser_text)
-    openai.add_function(github)
-    openai.add_function(pdf)
-    openai.add_function(youtube)
-    openai.add_function(search)
-    await AsyncSocketModeHandler(slack, os.environ["SLACK_APP_TOKEN"]).start_async()
+    for tool in load_tools():  # the plugins are imported on their first call
+        openai.add_function(tool)
+    openai.add_result_processor(rank_tool_output)
+    await context.load()
+
+
+async def main():
+    await setup()
+    await run_in_db_thread(migrate_legacy_cache)
+    await run_in_db_thread(migrate_to_blobs)
+    metrics_task = asyncio.create_task(run_metrics())
+    try:
+        if worker_count > 1:  # the workers handle the events, see workers.py
+            web_client = AsyncWebClient(base_url=slack_api_url)
+            await Supervisor(worker_count, os.environ["SLACK_APP_TOKEN"], web_client).run()
+        else:
+            async with http_clients:  # pooled connections of the plugins, closed on shutdown
+                handler = AsyncSocketModeHandler(slack, os.environ["SLACK_APP_TOKEN"])
+                handler.client.message_listeners.append(on_socket_message)
+                await handler.start_async()
+    finally:
+        metrics_task.cancel()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+Large tool outputs and transcripts, stored once per content in the Blob table and compressed with zlib.
+Extra prompts and cached tool results only keep a reference to the blob, so a YouTube transcript fetched in many
+threads is stored once. Every reference is counted, and a blob is deleted with its last reference.
+
+The functions below, except migrate_to_blobs, run in a db_session, i.e. in the DB thread.
+"""
+
+import hashlib
+import logging
+import os
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+from pony.orm import PrimaryKey, Required, db_session, select
+
+from database import SQLITE_MAX_VARIABLES, db
+
+blob_min_bytes = int(os.environ.get("BLOB_MIN_BYTES", 4096))  # smaller contents are stored inline
+compression_level = 6
+BLOB_REF_PREFIX = "blob:sha256:"  # a cached tool result stored as a blob
+BLOB_KEY = "content_blob"  # replaces "content" in an extra prompt stored as a blob
+SCHEMA_VERSION = 1  # PRAGMA user_version once the existing rows are moved into blobs
+
+
+class Blob(db.Entity):
+    """Content addressed, compressed text"""
+
+    hash = PrimaryKey(str)  # sha256 of the UTF-8 encoded text
+    data = Required(bytes, lazy=True)
+    codec = Required(str)
+    size = Required(int)  # of the text in bytes
+    refs = Required(int)
+
+
+# The reference counts are changed by single statements, as other workers or DB threads may store or release the same
+# text at the same time, see WORKERS and DB_WORKERS.
+
+
+def put_blob(text: str) -> str:
+    """Stores the text, or adds a reference to the same text stored before. Returns its hash."""
+    data = text.encode("utf-8")
+    key = hashlib.sha256(data).hexdigest()
+    if db.execute('UPDATE "Blob" SET "refs" = "refs" + 1 WHERE "hash" = $key').rowcount:
+        return key  # stored before, not compressed again
+    compressed, size = zlib.compress(data, compression_level), len(data)
+    db.execute(
+        'INSERT INTO "Blob" ("hash", "data", "codec", "size", "refs") VALUES ($key, $compressed, \'zlib\', $size, 1) '
+        'ON CONFLICT ("hash") DO UPDATE SET "refs" = "refs" + 1'
+    )
+    return key
+
+
+def release_blob(key: str):
+    if not db.execute('UPDATE "Blob" SET "refs" = "refs" - 1 WHERE "hash" = $key').rowcount:
+        logging.warning("Blob %s is missing", key)
+        return
+    db.execute('DELETE FROM "Blob" WHERE "hash" = $key AND "refs" <= 0')
+
+
+def read_blobs(keys: Iterable[str]) -> Dict[str, str]:
+    """Decompresses the given blobs, loading them in batches. Missing blobs are left out."""
+    keys = list(set(keys))
+    result = {}
+    for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+        batch = keys[i : i + SQLITE_MAX_VARIABLES]
+        for key, codec, data in select((b.hash, b.codec, b.data) for b in Blob if b.hash in batch):
+            assert codec == "zlib", codec
+            result[key] = zlib.decompress(data).decode("utf-8")
+    return result
+
+
+def _is_large(text) -> bool:
+    # a character takes at most 4 bytes, short texts are not encoded
+    return isinstance(text, str) and len(text) * 4 >= blob_min_bytes and len(text.encode("utf-8")) >= blob_min_bytes
+
+
+# extra prompts: large contents are replaced by {"content_blob": hash}
+
+
+def pack_prompts(prompts: List[Dict]) -> List[Dict]:
+    packed = []
+    for prompt in prompts:
+        if _is_large(prompt.get("content")):
+            prompt = dict(prompt)
+            prompt[BLOB_KEY] = put_blob(prompt.pop("content"))
+        packed.append(prompt)
+    return packed
+
+
+def unpack_prompts(prompts_by_key: Dict[str, List[Dict]]) -> Dict[str, List[Dict]]:
+    """Puts the contents back into the prompts, reading all blobs they refer to at once."""
+    keys = [prompt[BLOB_KEY] for prompts in prompts_by_key.values() for prompt in prompts if BLOB_KEY in prompt]
+    if not keys:
+        return prompts_by_key
+    texts = read_blobs(keys)
+    result = {}
+    for key, prompts in prompts_by_key.items():
+        result[key] = []
+        for prompt in prompts:
+            if BLOB_KEY in prompt:
+                prompt = dict(prompt)
+                prompt["content"] = texts.get(prompt.pop(BLOB_KEY), "(Content missing)")
+            result[key].append(prompt)
+    return result
+
+
+def release_prompts(prompts: List[Dict]):
+    for prompt in prompts:
+        if BLOB_KEY in prompt:
+            release_blob(prompt[BLOB_KEY])
+
+
+# cached tool results: large values are replaced by "blob:sha256:<hash>"
+
+
+def blob_ref(value: str) -> Optional[str]:
+    if value.startswith(BLOB_REF_PREFIX) and len(value) == len(BLOB_REF_PREFIX) + 64:
+        return value[len(BLOB_REF_PREFIX) :]
+    return None
+
+
+def pack_value(value: str) -> str:
+    return BLOB_REF_PREFIX + put_blob(value) if _is_large(value) and blob_ref(value) is None else value
+
+
+def unpack_value(value: str) -> Optional[str]:
+    key = blob_ref(value)
+    if key is None:
+        return value
+    return read_blobs([key]).get(key)
+
+
+def release_value(value: str):
+    key = blob_ref(value)
+    if key is not None:
+        release_blob(key)
+
+
+def migrate_to_blobs(page_size: int = 200) -> Dict[str, int]:
+    """Moves the large contents of existing extra prompts and cached tool results into blobs, once."""
+    from prompt_store import SlackExtraPrompt
+    from tool_cache import ToolResultCache
+
+    with db_session:
+        if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return {}
+    moved = {"prompts": 0, "tool_results": 0}
+    last = ""
+    while True:  # a transaction per page, the tables may be large
+        with db_session:
+            page = SlackExtraPrompt.select(lambda p: p.ts > last).order_by(SlackExtraPrompt.ts)[:page_size]
+            for row in page:
+                packed = pack_prompts(row.prompts)
+                if packed != row.prompts:
+                    row.prompts = packed
+                    moved["prompts"] += 1
+            if not page:
+                break
+            last = page[-1].ts
+    last = ""
+    while True:
+        with db_session:
+            page = ToolResultCache.select(lambda e: e.key_hash > last).order_by(ToolResultCache.key_hash)[:page_size]
+            for entry in page:
+                packed = pack_value(entry.value)
+                if packed != entry.value:
+                    entry.value = packed
+                    moved["tool_results"] += 1
+            if not page:
+                break
+            last = page[-1].key_hash
+    with db_session:
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    logging.info("Moved into blobs: %s", moved)
+    return moved
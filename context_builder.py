@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import tiktoken
+
+# context window of each model minus the room reserved for the reply
+MODEL_BUDGETS = {
+    "gpt-4-1106-preview": 128000 - 4096,
+    "gpt-4-0125-preview": 128000 - 4096,
+    "gpt-4-turbo": 128000 - 4096,
+    "gpt-4o": 128000 - 4096,
+    "gpt-4o-mini": 128000 - 4096,
+    "gpt-4-32k": 32768 - 4096,
+    "gpt-4": 8192 - 2048,
+    "gpt-3.5-turbo-1106": 16385 - 4096,
+    "gpt-3.5-turbo": 16385 - 4096,
+}
+DEFAULT_BUDGET = 8192 - 2048
+
+# tool results larger than this are cut before any turn is dropped
+max_tool_result_tokens = int(os.environ.get("MAX_TOOL_RESULT_TOKENS", 8000))
+
+Turn = Tuple[str, List[Dict]]  # the ts of a Slack message, and the prompts generated from it
+
+# counting a large tool result takes long enough to stall the event loop, and loading an encoding may download its BPE
+# file; a single thread, as the cached counts are not thread safe
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokens")
+
+
+def model_budget(model: str) -> int:
+    if os.environ.get("OPENAI_CONTEXT_BUDGET"):
+        return int(os.environ["OPENAI_CONTEXT_BUDGET"])
+    if model in MODEL_BUDGETS:
+        return MODEL_BUDGETS[model]
+    # dated snapshots share the context window of their base model, e.g. gpt-4o-2024-08-06
+    for name in sorted(MODEL_BUDGETS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_BUDGETS[name]
+    return DEFAULT_BUDGET
+
+
+def prompt_text(prompt: Dict) -> str:
+    content = prompt.get("content") or ""
+    if not isinstance(content, str):
+        content = content.decode("utf-8", errors="replace") if isinstance(content, bytes) else json.dumps(content)
+    if prompt.get("tool_calls"):
+        content += json.dumps(prompt["tool_calls"], ensure_ascii=False)
+    return content
+
+
+class ContextBuilder:
+    """
+    Fits the prompts of a thread into the token budget of a model.
+    Token counts are cached per message ts, as the older messages of a thread rarely change.
+    """
+
+    def __init__(self, model: str, budget: Optional[int] = None, cache_size: int = 100000):
+        self.model = model
+        self.budget = budget or model_budget(model)
+        self.cache_size = cache_size
+        self._encoding = None
+        # by ts, index and hash of the text
+        self._counts: "OrderedDict[Tuple[str, int, int], int]" = OrderedDict()
+
+    @property
+    def encoding(self):
+        """The tiktoken encoding of the model, or False if it cannot be loaded, e.g. without access to the BPE file."""
+        if self._encoding is None:
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logging.warning("Failed to load tiktoken encoding, estimating token counts instead: %s", e)
+                self._encoding = False
+        return self._encoding
+
+    def count_text(self, text: str) -> int:
+        if not self.encoding:
+            return len(text.encode("utf-8")) // 4 + 1
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count(self, ts: str, index: int, prompt: Dict) -> int:
+        """Tokens of a prompt, including the per-message overhead of the chat format."""
+        text = prompt_text(prompt)
+        key = ts, index, hash(text)  # an edited message is counted again, even if its length did not change
+        tokens = self._counts.get(key)
+        if tokens is None:
+            tokens = self._counts[key] = self.count_text(text) + 4
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(key)
+        return tokens
+
+    async def load(self):
+        """Loads the encoding in the token counting thread, e.g. at startup."""
+        await asyncio.get_running_loop().run_in_executor(executor, lambda: self.encoding)
+
+    async def build_async(self, system_prompts: List[Dict], turns: Iterable[Turn]) -> List[Dict]:
+        """Runs `build` in the token counting thread."""
+        turns = [(ts, list(prompts)) for ts, prompts in turns]  # the messages are read here, on the event loop
+        return await asyncio.get_running_loop().run_in_executor(executor, self.build, system_prompts, turns)
+
+    def truncate(self, prompt: Dict, max_tokens: int) -> Dict:
+        text = prompt_text(prompt)
+        if self.encoding:
+            truncated = self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+        else:
+            truncated = text.encode("utf-8")[: max_tokens * 4].decode("utf-8", errors="ignore")
+        return {**prompt, "content": truncated + "\n(truncated to fit the context window)"}
+
+    def build(self, system_prompts: List[Dict], turns: Iterable[Turn]) -> List[Dict]:
+        """
+        Returns the system prompts followed by as many turns as fit into the budget.
+        Oversized tool results are cut first, then the oldest turns are dropped. The latest turn is always kept.
+        """
+        turns = [(ts, list(prompts)) for ts, prompts in turns]
+        counts = [[self.count(ts, i, p) for i, p in enumerate(prompts)] for ts, prompts in turns]
+        total = sum(self.count("system", i, p) for i, p in enumerate(system_prompts)) + sum(map(sum, counts)) + 3
+
+        for t, (ts, prompts) in enumerate(turns):
+            if total <= self.budget:
+                break
+            for i, prompt in enumerate(prompts):
+                if prompt.get("role") == "tool" and counts[t][i] > max_tool_result_tokens:
+                    prompts[i] = self.truncate(prompt, max_tool_result_tokens)
+                    tokens = self.count_text(prompt_text(prompts[i])) + 4
+                    total -= counts[t][i] - tokens
+                    counts[t][i] = tokens
+
+        first = 0
+        while total > self.budget and first < len(turns) - 1:
+            total -= sum(counts[first])
+            first += 1
+        if first:
+            logging.info("Dropped %d of %d turns to fit into %d tokens", first, len(turns), self.budget)
+        return system_prompts + [p for _, prompts in turns[first:] for p in prompts]
+
+
+def main():
+    random.seed(0)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+    def text(n):
+        return " ".join(random.choice(words) for _ in range(n))
+
+    turns = []
+    for i in range(1000):
+        prompts = [{"role": "user" if i % 2 else "assistant", "content": text(200)}]
+        if i % 50 == 0:  # a tool call with a big result, e.g. a YouTube transcript
+            prompts = [
+                {"role": "assistant", "tool_calls": [{"id": f"call_{i}", "type": "function"}]},
+                {"role": "tool", "tool_call_id": f"call_{i}", "name": "youtube", "content": text(20000)},
+            ] + prompts
+        turns.append((f"{i}.0", prompts))
+    system = [{"role": "system", "content": "You are a helpful assistant."}]
+
+    builder = ContextBuilder("gpt-4-1106-preview")
+    for run in ["cold", "cached"]:
+        t0 = time.perf_counter()
+        prompts = builder.build(system, turns)
+        t1 = time.perf_counter()
+        tokens = sum(builder.count_text(prompt_text(p)) + 4 for p in prompts)
+        print(f"{run}: {(t1 - t0) * 1000:.1f}ms, {len(prompts)} prompts, ~{tokens} tokens, budget {builder.budget}")
+    assert prompts[0] == system[0] and prompts[-1] == turns[-1][1][-1]
+    assert tokens <= builder.budget
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from slack_sdk.web.async_client import AsyncWebClient
+
+default_max_threads = int(os.environ.get("CONVERSATION_CACHE_THREADS", 1000))
+default_max_bytes = int(os.environ.get("CONVERSATION_CACHE_BYTES", 64 * 1024 * 1024))
+
+# fields of a Slack message needed to build the prompts
+MESSAGE_FIELDS = ("ts", "thread_ts", "text", "user", "bot_id", "subtype")
+
+
+def slim_message(msg: Dict) -> Dict:
+    return {k: msg[k] for k in MESSAGE_FIELDS if k in msg}
+
+
+def message_size(msg: Dict) -> int:
+    return len(msg.get("text") or "") + 100  # rough estimation, including the dict overhead
+
+
+class Conversation:
+    def __init__(self, messages: List[Dict]):
+        self.messages = sorted((slim_message(m) for m in messages), key=lambda m: float(m["ts"]))
+        self.size = sum(message_size(m) for m in self.messages)
+
+    def upsert(self, msg: Dict) -> int:
+        """Adds or replaces a message, keeping the ts order. Returns the change in size."""
+        msg = slim_message(msg)
+        for i in range(len(self.messages) - 1, -1, -1):
+            existing = self.messages[i]
+            if existing["ts"] == msg["ts"]:
+                self.messages[i] = {**existing, **msg}
+                delta = message_size(self.messages[i]) - message_size(existing)
+                break
+            if float(existing["ts"]) < float(msg["ts"]):
+                self.messages.insert(i + 1, msg)
+                delta = message_size(msg)
+                break
+        else:
+            self.messages.insert(0, msg)
+            delta = message_size(msg)
+        self.size += delta
+        return delta
+
+
+class ConversationCache:
+    """
+    An LRU cache of thread messages keyed by (channel, thread_ts).
+    It is kept up to date from incoming message events and the bot's own replies, so that conversations.replies is only
+    called when a thread is not cached or the cached copy may be stale. Events sent while the Socket Mode connection
+    was down may be missed, so all threads are dropped when it is established again, see `clear`.
+    """
+
+    def __init__(self, max_threads: int = default_max_threads, max_bytes: int = default_max_bytes):
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._threads: "OrderedDict[Tuple[str, str], Conversation]" = OrderedDict()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "threads": len(self._threads),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    async def get(self, client: AsyncWebClient, channel: str, thread_ts: str) -> List[Dict]:
+        """Returns the messages of a thread, fetching them from Slack on a cache miss."""
+        key = channel, thread_ts
+        conversation = self._threads.get(key)
+        if conversation is not None:
+            self.hits += 1
+            self._threads.move_to_end(key)
+            return list(conversation.messages)
+        self.misses += 1
+        messages = await fetch_thread(client, channel, thread_ts)
+        self._put(key, Conversation(messages))
+        logging.debug("conversation cache: %s", self.stats())
+        return messages
+
+    def add_message(self, channel: str, msg: Dict, thread_ts: Optional[str] = None):
+        """Records a new or updated message, sent by a user or by the bot."""
+        thread_ts = thread_ts or msg.get("thread_ts") or msg["ts"]
+        key = channel, thread_ts
+        conversation = self._threads.get(key)
+        if conversation is None:
+            if thread_ts == msg["ts"]:  # the first message of a new thread
+                self._put(key, Conversation([msg]))
+            return  # otherwise the thread is fetched on the next get()
+        self.size += conversation.upsert(msg)
+        self._threads.move_to_end(key)
+        self._evict()
+
+    def update_text(self, channel: str, thread_ts: str, ts: str, text: str):
+        self.add_message(channel, {"ts": ts, "text": text}, thread_ts)
+
+    def handle_hidden_event(self, event: Dict):
+        """Applies message_changed events, and drops the thread touched by any other hidden event, e.g. deletions."""
+        if event.get("subtype") == "message_changed" and "ts" in event.get("message", {}):
+            self.add_message(event["channel"], event["message"])
+            return
+        msg = event.get("message") or event.get("previous_message") or {}
+        if "ts" in msg:
+            self.invalidate(event["channel"], msg.get("thread_ts") or msg["ts"])
+
+    def invalidate(self, channel: str, thread_ts: str):
+        conversation = self._threads.pop((channel, thread_ts), None)
+        if conversation is not None:
+            self.size -= conversation.size
+
+    def clear(self):
+        """Drops all threads, e.g. after a reconnect, the events of which may have missed messages."""
+        self._threads.clear()
+        self.size = 0
+
+    def _put(self, key: Tuple[str, str], conversation: Conversation):
+        self.invalidate(*key)
+        self._threads[key] = conversation
+        self.size += conversation.size
+        self._evict()
+
+    def _evict(self):
+        while self._threads and (len(self._threads) > self.max_threads or self.size > self.max_bytes):
+            _, conversation = self._threads.popitem(last=False)
+            self.size -= conversation.size
+
+
+async def fetch_thread(client: AsyncWebClient, channel: str, thread_ts: str) -> List[Dict]:
+    messages = []
+    cursor = None
+    while True:
+        replies = await client.conversations_replies(channel=channel, ts=thread_ts, cursor=cursor)
+        messages += [slim_message(m) for m in replies["messages"]]
+        cursor = (replies.get("response_metadata") or {}).get("next_cursor")
+        if not replies.get("has_more") or not cursor:
+            return messages
+
+
+async def main():
+    class FakeClient:
+        calls = 0
+
+        async def conversations_replies(self, channel, ts, cursor=None):
+            self.calls += 1
+            return {"messages": [{"ts": ts, "text": "hello", "user": "U1"}], "has_more": False}
+
+    client = FakeClient()
+    cache = ConversationCache(max_threads=16)
+    for i in range(100):
+        thread_ts = f"{i % 12}.0"
+        await cache.get(client, "C1", thread_ts)
+        cache.add_message("C1", {"ts": f"{i % 12}.{i + 1}", "text": "reply", "bot_id": "B1"}, thread_ts)
+    print(f"{client.calls} conversations.replies calls, stats: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
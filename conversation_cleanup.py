@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from conversation_export import (
+    FakeHistoryClient,
+    fetch_replies,
+    history_burst,
+    history_rate,
+    page_size,
+    replies_burst,
+    replies_rate,
+)
+from prompt_store import delete_extra_prompts_by_ts
+from update_scheduler import TokenBucket, rate_limited_call
+
+# chat.delete is a Tier 3 method (50+ requests per minute)
+delete_rate = float(os.environ.get("SLACK_DELETE_RATE", 50 / 60))
+delete_burst = int(os.environ.get("SLACK_DELETE_BURST", 5))
+clear_concurrency = int(os.environ.get("CLEAR_CONCURRENCY", 4))
+progress_interval = 30  # seconds between progress messages
+
+# errors of messages which cannot be deleted by the bot, or are gone already
+SKIPPED_ERRORS = {"cant_delete_message", "message_not_found", "compliance_exports_prevent_deletion"}
+
+
+class HistoryCleaner:
+    """
+    Deletes the bot's messages in a channel, thread replies included, going through all pages of the history.
+    Threads are fetched and messages deleted concurrently, every kind of call paced by its own token bucket.
+    """
+
+    def __init__(
+        self,
+        client: AsyncWebClient,
+        channel: str,
+        progress: Callable[[str], Awaitable] = None,
+        history_bucket: TokenBucket = None,
+        replies_bucket: TokenBucket = None,
+        delete_bucket: TokenBucket = None,
+        concurrency: int = clear_concurrency,
+    ):
+        self.client = client
+        self.channel = channel
+        self.progress = progress
+        self.history_bucket = history_bucket or TokenBucket(history_rate, history_burst)
+        self.replies_bucket = replies_bucket or TokenBucket(replies_rate, replies_burst)
+        self.delete_bucket = delete_bucket or TokenBucket(delete_rate, delete_burst)
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.deleted: List[str] = []
+        self.skipped = 0
+        self.failed = 0
+        self._progress_at = time.monotonic()
+
+    async def _delete(self, ts: str):
+        try:
+            await rate_limited_call(self.delete_bucket, self.client.chat_delete, channel=self.channel, ts=ts)
+        except SlackApiError as e:
+            if e.response.get("error") in SKIPPED_ERRORS:
+                self.skipped += 1
+            else:
+                self.failed += 1
+                logging.error("Failed to delete message. channel: %s, ts: %s, error: %s", self.channel, ts, e)
+        else:
+            self.deleted.append(ts)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            ts = await queue.get()
+            try:
+                await self._delete(ts)
+            finally:
+                queue.task_done()
+
+    async def _queue_thread(self, thread_ts: str, queue: asyncio.Queue):
+        async with self.semaphore:
+            messages = await fetch_replies(self.client, self.replies_bucket, self.channel, thread_ts)
+        for msg in messages:
+            if msg.get("bot_id"):
+                await queue.put(msg["ts"])
+
+    async def _report(self):
+        if self.progress is None or time.monotonic() - self._progress_at < progress_interval:
+            return
+        self._progress_at = time.monotonic()
+        try:
+            await self.progress(f"Deleted {len(self.deleted)} messages so far...")
+        except Exception as e:
+            logging.warning("Failed to report progress: %s", e)
+
+    async def run(self) -> Dict[str, int]:
+        """Deletes the messages, then the extra prompts stored for them, and returns the counts."""
+        queue = asyncio.Queue(maxsize=page_size * 4)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            cursor = None
+            while True:
+                page = await rate_limited_call(
+                    self.history_bucket,
+                    self.client.conversations_history,
+                    channel=self.channel,
+                    limit=page_size,
+                    cursor=cursor,
+                )
+                threads = []
+                for msg in page["messages"]:
+                    if msg.get("thread_ts") == msg["ts"]:  # the parent is deleted with its replies
+                        threads.append(asyncio.create_task(self._queue_thread(msg["ts"], queue)))
+                    elif "thread_ts" not in msg and msg.get("bot_id"):  # broadcast replies go with their thread
+                        await queue.put(msg["ts"])
+                try:
+                    await asyncio.gather(*threads)
+                finally:
+                    for task in threads:
+                        task.cancel()
+                await self._report()
+                cursor = (page.get("response_metadata") or {}).get("next_cursor")
+                if not page.get("has_more") or not cursor:
+                    break
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            purged = await delete_extra_prompts_by_ts(self.deleted)
+        return {"deleted": len(self.deleted), "skipped": self.skipped, "failed": self.failed, "prompts": purged}
+
+
+class FakeDeleteClient(FakeHistoryClient):
+    """Every other thread reply is from the bot, chat.delete is rate limited like the other methods."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for i, msg in enumerate(self.history):
+            if i % 2 and "thread_ts" not in msg:
+                msg["bot_id"] = "B1"
+        self.deleted = set()
+
+    async def conversations_replies(self, channel, ts, limit, cursor=None):
+        replies = await super().conversations_replies(channel, ts, limit, cursor)
+        for i, msg in enumerate(replies["messages"]):
+            if i % 2:
+                msg["bot_id"] = "B1"
+        return replies
+
+    async def chat_delete(self, channel, ts):
+        await self._call("chat.delete")
+        self.deleted.add(ts)
+
+
+async def main():
+    from database import db
+    from prompt_store import add_extra_prompts
+
+    logging.basicConfig(level=logging.INFO)
+    db.generate_mapping(create_tables=True, check_tables=True)
+    client = FakeDeleteClient(messages=2000, thread_every=20, replies=30, limit=100)
+    for msg in client.history[1::2]:
+        await add_extra_prompts("D1", msg["ts"], [{"role": "tool", "content": "result"}])
+
+    async def progress(text):
+        print(text)
+
+    t0 = time.monotonic()
+    buckets = [TokenBucket(rate=80, capacity=10) for _ in range(3)]
+    cleaner = HistoryCleaner(client, "D1", progress, *buckets, concurrency=8)
+    result = await cleaner.run()
+    print(f"{result} in {time.monotonic() - t0:.2f}s, {client.rate_limited} rate limited calls")
+    assert result["deleted"] == len(client.deleted) == 1000 + 100 * 15 and result["prompts"] == 1000
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
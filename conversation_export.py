@@ -0,0 +1,288 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from pony.orm import *
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
+
+from database import db, run_in_db_thread
+from update_scheduler import TokenBucket, rate_limited_call
+
+# conversations.history and conversations.replies are Tier 3 methods (50+ requests per minute), each limited on its own
+history_rate = float(os.environ.get("SLACK_HISTORY_RATE", 50 / 60))
+history_burst = int(os.environ.get("SLACK_HISTORY_BURST", 5))
+replies_rate = float(os.environ.get("SLACK_REPLIES_RATE", 50 / 60))
+replies_burst = int(os.environ.get("SLACK_REPLIES_BURST", 5))
+export_concurrency = int(os.environ.get("EXPORT_CONCURRENCY", 4))
+# an interrupted export resumes from the file written so far, so the directory must survive restarts of the container
+export_dir = os.environ.get("EXPORT_DIR") or tempfile.gettempdir()
+progress_interval = 30  # seconds between progress messages
+page_size = 200
+
+
+class ConversationExport(db.Entity):
+    """The state of a /dump-conversations export, so that an interrupted export can be resumed"""
+
+    channel = Required(str)
+    user = Required(str)
+    PrimaryKey(channel, user)
+    path = Required(str)  # the NDJSON file written so far
+    cursor = Optional(str)  # the next page of conversations.history, empty before the first page
+    offset = Required(int)  # bytes of the file written up to the cursor
+    count = Required(int)
+    done = Required(bool, default=False)
+
+
+@db_session
+def _get_export(channel, user) -> Dict:
+    export = ConversationExport.get(channel=channel, user=user)
+    return export.to_dict() if export else None
+
+
+@db_session
+def _save_export(channel, user, **fields):
+    export = ConversationExport.get(channel=channel, user=user)
+    if export is None:
+        ConversationExport(channel=channel, user=user, **fields)
+    else:
+        export.set(**fields)
+
+
+@db_session
+def _delete_export(channel, user):
+    ConversationExport.select(lambda e: e.channel == channel and e.user == user).delete(bulk=True)
+
+
+def ndjson_to_gzip_json(ndjson_path: str, json_path: str):
+    """Converts the NDJSON file into a gzip compressed JSON array, a batch of lines at a time."""
+    with open(ndjson_path, "rb") as src, gzip.open(json_path, "wb") as dst:
+        separator = b"[\n"
+        while True:
+            lines = src.readlines(1024 * 1024)
+            if not lines:
+                break
+            dst.write(separator + b",\n".join(line.rstrip(b"\n") for line in lines))
+            separator = b",\n"
+        dst.write(b"\n]\n" if separator == b",\n" else b"[]\n")
+
+
+async def fetch_replies(client: AsyncWebClient, bucket: TokenBucket, channel: str, thread_ts: str) -> List[Dict]:
+    """Fetches all pages of a thread, the parent message first."""
+    messages = []
+    cursor = None
+    while True:
+        replies = await rate_limited_call(
+            bucket, client.conversations_replies, channel=channel, ts=thread_ts, limit=page_size, cursor=cursor
+        )
+        messages += replies["messages"]
+        cursor = (replies.get("response_metadata") or {}).get("next_cursor")
+        if not replies.get("has_more") or not cursor:
+            return messages
+
+
+class ConversationExporter:
+    """
+    Streams the history of a channel, with the replies of every thread right after their parent message, into an
+    NDJSON file. Threads of a history page are fetched concurrently, the calls of each method paced by its own token
+    bucket.
+    The cursor is saved after every page, running the export again resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        client: AsyncWebClient,
+        channel: str,
+        user: str,
+        progress: Callable[[str], Awaitable] = None,
+        history_bucket: TokenBucket = None,
+        replies_bucket: TokenBucket = None,
+        concurrency: int = export_concurrency,
+    ):
+        self.client = client
+        self.channel = channel
+        self.user = user
+        self.progress = progress
+        self.history_bucket = history_bucket or TokenBucket(history_rate, history_burst)
+        self.replies_bucket = replies_bucket or TokenBucket(replies_rate, replies_burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.path = os.path.join(export_dir, f"conversations-{channel}-{user}.ndjson")
+        self.count = 0
+        self.resumed = False
+        self._progress_at = time.monotonic()
+
+    async def _fetch_thread(self, thread_ts: str) -> List[Dict]:
+        async with self.semaphore:
+            return await fetch_replies(self.client, self.replies_bucket, self.channel, thread_ts)
+
+    async def _report(self):
+        if self.progress is None or time.monotonic() - self._progress_at < progress_interval:
+            return
+        self._progress_at = time.monotonic()
+        try:
+            await self.progress(f"Exported {self.count} messages so far...")
+        except Exception as e:
+            logging.warning("Failed to report export progress: %s", e)
+
+    async def run(self) -> Tuple[str, int]:
+        """Exports the conversation and returns the path of the NDJSON file and the number of messages in it."""
+        state = await run_in_db_thread(_get_export, self.channel, self.user)
+        if state and os.path.exists(state["path"]):
+            self.path, cursor, offset, self.count = state["path"], state["cursor"], state["offset"], state["count"]
+            self.resumed = True
+            if state["done"]:
+                return self.path, self.count
+        else:
+            cursor, offset = "", 0
+            await run_in_db_thread(_save_export, self.channel, self.user, path=self.path, cursor="", offset=0, count=0)
+        with open(self.path, "ab") as f:
+            f.truncate(offset)  # drop what was written after the last saved cursor
+            while True:
+                page = await rate_limited_call(
+                    self.history_bucket,
+                    self.client.conversations_history,
+                    channel=self.channel,
+                    limit=page_size,
+                    cursor=cursor or None,
+                )
+                threads = {
+                    msg["ts"]: asyncio.create_task(self._fetch_thread(msg["ts"]))
+                    for msg in page["messages"]
+                    if msg.get("thread_ts") == msg["ts"]
+                }
+                try:
+                    for msg in page["messages"]:
+                        if msg.get("thread_ts", msg["ts"]) != msg["ts"]:
+                            continue  # replies also sent to the channel are exported with their thread
+                        for m in await threads[msg["ts"]] if msg["ts"] in threads else [msg]:
+                            f.write(json.dumps(m, ensure_ascii=False).encode() + b"\n")
+                            self.count += 1
+                finally:
+                    for task in threads.values():
+                        task.cancel()
+                f.flush()
+                cursor = (page.get("response_metadata") or {}).get("next_cursor") or ""
+                done = not page.get("has_more") or not cursor
+                await run_in_db_thread(
+                    _save_export, self.channel, self.user, cursor=cursor, offset=f.tell(), count=self.count, done=done
+                )
+                if done:
+                    return self.path, self.count
+                await self._report()
+
+    async def finish(self):
+        """Removes the exported file and the saved cursor, once the export has been delivered."""
+        await run_in_db_thread(_delete_export, self.channel, self.user)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class FakeHistoryClient:
+    """
+    Mimics conversations.history and conversations.replies, answering with HTTP 429 above `limit` calls per second of
+    a method.
+    """
+
+    def __init__(self, messages: int, thread_every: int, replies: int, limit: int):
+        self.history = [
+            {"ts": f"{1000000 + i}.000000", "text": f"message {i}", "user": "U1"} for i in range(messages, 0, -1)
+        ]
+        for i, msg in enumerate(self.history):
+            if i % thread_every == 0:
+                msg["thread_ts"] = msg["ts"]
+        self.replies = replies
+        self.limit = limit
+        self.calls = {}
+        self.rate_limited = 0
+        self.fail_after = None  # simulates an interruption after this many calls
+
+    async def _call(self, method: str):
+        now = time.monotonic()
+        calls = self.calls[method] = [t for t in self.calls.get(method, []) if now - t < 1] + [now]
+        if self.fail_after is not None:
+            self.fail_after -= 1
+            if self.fail_after < 0:
+                raise ConnectionError("connection lost")
+        if len(calls) > self.limit:
+            self.rate_limited += 1
+            raise SlackApiError(
+                "ratelimited",
+                AsyncSlackResponse(
+                    client=self,
+                    http_verb="POST",
+                    api_url=f"https://slack.com/api/{method}",
+                    req_args={},
+                    data={"ok": False, "error": "ratelimited"},
+                    headers={"Retry-After": "1"},
+                    status_code=429,
+                ),
+            )
+        await asyncio.sleep(0.01)
+
+    def _page(self, items, limit, cursor):
+        start = int(cursor or 0)
+        more = start + limit < len(items)
+        return {
+            "ok": True,
+            "messages": items[start : start + limit],
+            "has_more": more,
+            "response_metadata": {"next_cursor": str(start + limit) if more else ""},
+        }
+
+    async def conversations_history(self, channel, limit, cursor=None):
+        await self._call("conversations.history")
+        return self._page(self.history, limit, cursor)
+
+    async def conversations_replies(self, channel, ts, limit, cursor=None):
+        await self._call("conversations.replies")
+        thread = [{"ts": ts, "thread_ts": ts, "text": "parent"}] + [
+            {"ts": f"{ts[:-6]}{i:06d}", "thread_ts": ts, "text": f"reply {i}"} for i in range(1, self.replies + 1)
+        ]
+        return self._page(thread, limit, cursor)
+
+
+async def main():
+    import tracemalloc
+
+    logging.basicConfig(level=logging.INFO)
+    db.generate_mapping(create_tables=True, check_tables=True)
+    client = FakeHistoryClient(messages=20000, thread_every=20, replies=300, limit=120)
+    buckets = [TokenBucket(rate=150, capacity=20), TokenBucket(rate=150, capacity=20)]
+
+    async def progress(text):
+        print(text)
+
+    tracemalloc.start()
+    t0 = time.monotonic()
+    client.fail_after = 300
+    try:
+        await ConversationExporter(client, "D1", "U1", progress, *buckets, concurrency=8).run()
+    except ConnectionError as e:
+        print(f"Interrupted: {e}")
+    client.fail_after = None
+    exporter = ConversationExporter(client, "D1", "U1", progress, *buckets, concurrency=8)
+    path, count = await exporter.run()
+    t1 = time.monotonic()
+    _, peak = tracemalloc.get_traced_memory()
+    print(
+        f"Exported {count} messages in {t1 - t0:.2f}s, resumed: {exporter.resumed}, {client.rate_limited} rate limited"
+    )
+    print(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB, file size: {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+    with open(path) as f:
+        ts = [json.loads(line)["ts"] for line in f]
+    assert len(ts) == len(set(ts)) == count == 20000 + 1000 * 300
+    ndjson_to_gzip_json(path, path + ".json.gz")
+    with gzip.open(path + ".json.gz") as f:
+        assert len(json.load(f)) == count
+    os.remove(path + ".json.gz")
+    await exporter.finish()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
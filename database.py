@@ -1,7 +1,88 @@
+import asyncio
+import functools
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
-from pony.orm import Database
+from pony.orm import Database, db_session
+
+from metrics import Histogram, db_query_seconds, loop_lag_seconds, monitor_loop_lag
 
 db = Database()
+SQLITE_MAX_VARIABLES = 900  # stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
 db_path = os.environ.get("DB_PATH", "db.sqlite")
 db.bind(provider="sqlite", filename=db_path, create_db=True)
+
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",  # durable enough with WAL, no fsync on every commit
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16384",  # 16 MiB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",  # 256 MiB
+]
+
+
+def _configure_connection():
+    """Applies SQLITE_PRAGMAS to the connection of the current thread, Pony keeps one connection per thread."""
+    with db_session:
+        connection = db.get_connection()
+        connection.commit()  # pragmas like journal_mode cannot be changed inside a transaction
+        for pragma in SQLITE_PRAGMAS:
+            connection.execute(pragma)
+
+
+# all database access goes through this executor, so that SQLite never blocks the event loop
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DB_WORKERS", 1)),
+    thread_name_prefix="db",
+    initializer=_configure_connection,
+)
+
+
+async def run_in_db_thread(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    with db_query_seconds.time(query=getattr(func, "__name__", "other")):
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def main():
+    from pony.orm import Required
+
+    class LoopLagBenchmark(db.Entity):
+        value = Required(str)
+
+    db.generate_mapping(create_tables=True, check_tables=True)
+
+    @db_session
+    def write_and_read(i):
+        LoopLagBenchmark(value="x" * 1000)
+        return LoopLagBenchmark.select().count()
+
+    async def run(name, call):
+        lag = Histogram("benchmark_loop_lag_seconds", "Loop lag of a benchmark run.", buckets=loop_lag_seconds.buckets)
+        monitor = asyncio.create_task(monitor_loop_lag(0.001, lag))
+        t0 = time.perf_counter()
+        await asyncio.gather(*[call(i) for i in range(500)])
+        t1 = time.perf_counter()
+        monitor.cancel()
+        print(
+            f"{name}: {t1 - t0:.2f}s, loop lag p50 below {lag.quantile(0.5) * 1000:g}ms, "
+            f"p99 below {lag.quantile(0.99) * 1000:g}ms"
+        )
+
+    async def on_loop(i):
+        await asyncio.sleep(0)
+        return write_and_read(i)
+
+    try:
+        await run("on the event loop", on_loop)
+        await run("in the db thread", functools.partial(run_in_db_thread, write_and_read))
+    finally:
+        with db_session:
+            db.execute("DROP TABLE LoopLagBenchmark")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
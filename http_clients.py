@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+import aiohttp
+import httpx
+
+max_connections = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+max_connections_per_host = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 10))
+keepalive_expiry = 60
+
+
+class HttpClients:
+    """
+    Process-wide HTTP clients with connection pooling and keep-alive, shared by the plugins and file downloads.
+    The clients are created on first use and closed when leaving `async with http_clients`.
+    """
+
+    def __init__(self):
+        self._httpx: Optional[httpx.AsyncClient] = None
+        self._aiohttp: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def httpx(self) -> httpx.AsyncClient:
+        if self._httpx is None or self._httpx.is_closed:
+            self._httpx = httpx.AsyncClient(
+                http2=True,
+                timeout=20,
+                # httpx has no limit per host, the setting bounds the idle connections of the whole pool instead
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections_per_host,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            )
+        return self._httpx
+
+    @property
+    def aiohttp(self) -> aiohttp.ClientSession:
+        if self._aiohttp is None or self._aiohttp.closed:
+            self._aiohttp = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=max_connections,
+                    limit_per_host=max_connections_per_host,
+                    keepalive_timeout=keepalive_expiry,
+                ),
+                timeout=aiohttp.ClientTimeout(total=20),
+            )
+        return self._aiohttp
+
+    async def close(self):
+        if self._httpx is not None:
+            await self._httpx.aclose()
+            self._httpx = None
+        if self._aiohttp is not None:
+            await self._aiohttp.close()
+            self._aiohttp = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+http_clients = HttpClients()
+
+
+async def main():
+    from aiohttp import web
+
+    async def hello(request):
+        return web.json_response({"data": "hello"})
+
+    app = web.Application()
+    app.router.add_post("/", hello)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/"
+
+    async def new_client_per_call():
+        async with httpx.AsyncClient(http2=True, timeout=20) as client:
+            await client.post(url, json={"url": "https://example.com"})
+
+    async def pooled_client():
+        await http_clients.httpx.post(url, json={"url": "https://example.com"})
+
+    async def new_session_per_call():
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"url": "https://example.com"}) as r:
+                await r.read()
+
+    async def pooled_session():
+        async with http_clients.aiohttp.post(url, json={"url": "https://example.com"}) as r:
+            await r.read()
+
+    async with http_clients:
+        for name, call in [
+            ("httpx, new client per call", new_client_per_call),
+            ("httpx, pooled client", pooled_client),
+            ("aiohttp, new session per call", new_session_per_call),
+            ("aiohttp, pooled session", pooled_session),
+        ]:
+            t0 = time.perf_counter()
+            for _ in range(200):
+                await call()
+            t1 = time.perf_counter()
+            print(f"{name}: {(t1 - t0) / 200 * 1000:.2f}ms per call")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Sequence
+
+from metrics import job_queue_seconds, job_seconds, jobs_rejected_total
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class JobTimeoutError(TimeoutError):
+    pass
+
+
+def _run_in_child(conn, func, args, kwargs):
+    try:
+        result = True, func(*args, **kwargs)
+    except BaseException as e:
+        result = False, e
+    try:
+        conn.send(result)
+    except Exception as e:  # the result or the exception cannot be pickled, e.g. it holds a traceback
+        error = result[1] if not result[0] else e
+        conn.send((False, RuntimeError(f"{type(error).__name__}: {error}")))
+    finally:
+        conn.close()
+
+
+class _Slot:
+    """A worker slot taken from the semaphore, given back once, by an abandoned thread only when it finishes."""
+
+    def __init__(self, semaphore: asyncio.Semaphore):
+        self.semaphore = semaphore
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+    def release_when_done(self, future: asyncio.Future):
+        self.held = False
+        future.add_done_callback(lambda _: self.semaphore.release())
+
+
+class JobExecutor:
+    """
+    A bounded executor for blocking, CPU-heavy jobs, e.g. yt-dlp extraction.
+    At most `max_workers` jobs run at once and at most `max_queue` wait for a worker, more jobs are rejected with
+    QueueFullError. In "process" mode every job runs in its own child process, which is killed on timeout or when the
+    caller is cancelled. In "thread" mode jobs run in dedicated threads and are only abandoned, an abandoned job keeps
+    its worker until it finishes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int = 2,
+        max_queue: int = 8,
+        timeout: Optional[float] = None,
+        mode: str = "process",
+        start_method: str = "forkserver",
+        preload: Sequence[str] = (),
+    ):
+        assert mode in ("process", "thread")
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.mode = mode
+        self._threads = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._context = None
+        if mode == "process":
+            # forking the bot itself could copy locks held by its DB and HTTP threads, so workers are forked from a
+            # clean server process, which imports the modules of the jobs once
+            self._context = multiprocessing.get_context(start_method)
+            if start_method == "forkserver" and preload:
+                self._context.set_forkserver_preload(list(preload))
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    async def run(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` in a worker. In process mode `func` and its arguments must be picklable.
+        The time waited for the worker and the execution time are recorded in job_queue_seconds and job_seconds.
+        """
+        if self._waiting >= self.max_queue and self.semaphore.locked():
+            jobs_rejected_total.inc(executor=self.name)
+            raise QueueFullError(f"Too many {self.name} jobs queued")
+        timeout = timeout or self.timeout
+        t0 = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        slot = _Slot(self.semaphore)
+        try:
+            t1 = time.perf_counter()
+            job_queue_seconds.observe(t1 - t0, executor=self.name)
+            outcome = "cancelled"
+            try:
+                if self.mode == "process":
+                    result = await self._run_process(func, args, kwargs, timeout)
+                else:
+                    result = await self._run_thread(func, args, kwargs, timeout, slot)
+                outcome = "ok"
+                return result
+            except JobTimeoutError:
+                outcome = "timeout"
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                job_seconds.observe(time.perf_counter() - t1, executor=self.name, outcome=outcome)
+        finally:
+            slot.release()
+
+    async def _run_thread(self, func, args, kwargs, timeout, slot: _Slot):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._threads, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            slot.release_when_done(future)  # the thread cannot be stopped
+            raise JobTimeoutError(f"{self.name} job timed out after {timeout} seconds")
+        except asyncio.CancelledError:
+            slot.release_when_done(future)
+            raise
+
+    async def _run_process(self, func, args, kwargs, timeout):
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_run_in_child, args=(child_conn, func, args, kwargs), daemon=True)
+        stopped = threading.Event()
+        starting = threading.Lock()  # a job is stopped either before its process starts, or after
+
+        def supervise():
+            with starting:
+                if stopped.is_set():  # cancelled before a worker was free
+                    return False, RuntimeError(f"{self.name} job cancelled")
+                process.start()
+            child_conn.close()
+            try:
+                return parent_conn.recv()
+            except EOFError:  # killed, or crashed without sending a result
+                process.join()
+                return False, RuntimeError(f"{self.name} worker exited with code {process.exitcode}")
+            finally:
+                parent_conn.close()
+                process.join()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._threads, supervise)
+        try:
+            ok, value = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self._stop(process, stopped, starting)
+            raise JobTimeoutError(f"{self.name} job timed out after {timeout} seconds")
+        except asyncio.CancelledError:
+            self._stop(process, stopped, starting)
+            raise
+        if not ok:
+            raise value
+        return value
+
+    def _stop(self, process, stopped: threading.Event, starting: threading.Lock):
+        with starting:  # waits for a process being started, which is then killed
+            stopped.set()
+            self._kill(process)
+
+    def _kill(self, process):
+        if process.pid is not None and process.is_alive():
+            logging.warning("Killing %s worker %s", self.name, process.pid)
+            process.kill()
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False, cancel_futures=True)
+
+
+def _busy(seconds):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        pass
+    return seconds
+
+
+async def main():
+    executor = JobExecutor("bench", max_workers=2, max_queue=3, timeout=1)
+
+    async def job(seconds):
+        try:
+            return await executor.run(_busy, seconds)
+        except Exception as e:
+            return repr(e)
+
+    t0 = time.perf_counter()
+    print(await asyncio.gather(*[job(s) for s in [0.2, 0.2, 0.2, 0.2, 3, 0.2]]))
+    outcomes = {outcome: job_seconds.count(executor="bench", outcome=outcome) for outcome in ["ok", "timeout"]}
+    rejected = jobs_rejected_total.get(executor="bench")
+    wait = job_queue_seconds.quantile(0.9, executor="bench")
+    print(f"{time.perf_counter() - t0:.2f}s, jobs: {outcomes}, rejected: {rejected:.0f}, queue wait p90 below {wait}s")
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,344 @@
+"""
+Offline load test of the bot: Slack and OpenAI are replaced by local fake servers, and message events are dispatched
+to app.slack as Socket Mode would. With --workers, the events go through the fake Socket Mode endpoint to the
+supervisor and its worker processes instead. Example:
+
+    python loadtest.py --threads 50 --messages 3 --tokens 200 --token-rate 50 --tool-calls 0.3
+    python loadtest.py --threads 50 --messages 3 --workers 4
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# the app reads its configuration on import, none of these reach a real service
+for name, value in {
+    "SLACK_BOT_TOKEN": "xoxb-loadtest",
+    "OPENAI_API_KEY": "sk-loadtest",
+    "GOOGLE_SEARCH_KEY": "loadtest",
+    "GOOGLE_SEARCH_CX": "loadtest",
+    "BING_SEARCH_V7_SUBSCRIPTION_KEY": "loadtest",
+    "BING_SEARCH_V7_ENDPOINT": "http://127.0.0.1:9",
+    "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="loadtest"), "db.sqlite"),
+    "LOG_LEVEL": "WARNING",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def start_server(app: web.Application) -> Tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:%d" % runner.addresses[0][1]
+
+
+class FakeSlack:
+    """
+    The Web API methods used by the bot, backed by in-memory threads. Methods in `limits` answer with HTTP 429 and
+    Retry-After above that many calls per minute, like Slack's rate limit tiers.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self.limits = limits or {}
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.recent: Dict[str, List[float]] = defaultdict(list)
+        self.threads: Dict[Tuple[str, str], List[Dict]] = defaultdict(list)
+        self.thread_of: Dict[Tuple[str, str], str] = {}  # bot message -> thread_ts
+        self.first_update: Dict[Tuple[str, str], float] = {}  # thread -> time of the first chat.update
+        self.reply_end: Optional[str] = None  # a reply whose text ends with this is finished
+        self.replied: Dict[Tuple[str, str], asyncio.Event] = defaultdict(asyncio.Event)
+        self.socket_url = ""
+        self.sockets: List[web.WebSocketResponse] = []
+        self.connected = asyncio.Event()
+        self.acks: Dict[str, asyncio.Future] = {}
+        self._ts = itertools.count(1)
+        self._envelope_ids = itertools.count(1)
+
+    def next_ts(self) -> str:
+        return "%d.%06d" % (time.time(), next(self._ts) % 1000000)
+
+    def add_user_message(self, channel: str, thread_ts: Optional[str], text: str) -> Dict:
+        ts = self.next_ts()
+        msg = {"type": "message", "channel": channel, "user": "U1", "text": text, "ts": ts}
+        if thread_ts:
+            msg["thread_ts"] = thread_ts
+        self.threads[channel, thread_ts or ts].append(dict(msg, thread_ts=thread_ts or ts))
+        return msg
+
+    def _limited(self, method: str) -> bool:
+        limit = self.limits.get(method)
+        if not limit:
+            return False
+        now = time.monotonic()
+        recent = self.recent[method] = [t for t in self.recent[method] if now - t < 60] + [now]
+        return len(recent) > limit
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if self._limited(method):
+            self.rate_limited[method] += 1
+            return web.json_response({"ok": False, "error": "ratelimited"}, status=429, headers={"Retry-After": "1"})
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.can_read_body:
+            params.update(await request.post())
+        handler = getattr(self, method.replace(".", "_"), None)
+        if handler is None:
+            return web.json_response({"ok": False, "error": "unknown_method"})
+        return web.json_response(dict({"ok": True}, **handler(params)))
+
+    async def socket(self, request: web.Request) -> web.WebSocketResponse:
+        """The Socket Mode connection: envelopes are sent with send_envelope(), the acks come back here."""
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "hello", "num_connections": 1})
+        self.sockets.append(ws)
+        self.connected.set()
+        try:
+            async for msg in ws:
+                ack = json.loads(msg.data)
+                future = self.acks.pop(ack.get("envelope_id"), None)
+                if future is not None and not future.done():
+                    future.set_result(ack)
+        finally:
+            self.sockets.remove(ws)
+        return ws
+
+    async def send_envelope(self, payload: Dict, type: str = "events_api") -> Dict:
+        """Delivers a request over Socket Mode and returns its ack."""
+        await self.connected.wait()
+        envelope_id = "env%d" % next(self._envelope_ids)
+        future = self.acks[envelope_id] = asyncio.get_running_loop().create_future()
+        envelope = {"envelope_id": envelope_id, "type": type, "payload": payload, "accepts_response_payload": False}
+        await self.sockets[-1].send_json(envelope)
+        return await asyncio.wait_for(future, 3)
+
+    def apps_connections_open(self, params):
+        return {"url": self.socket_url}
+
+    def auth_test(self, params):
+        return {"user_id": "UBOT", "bot_id": "BBOT", "team_id": "T1", "user": "bot", "team": "loadtest"}
+
+    def chat_postMessage(self, params):
+        channel, thread_ts, ts = params["channel"], params.get("thread_ts"), self.next_ts()
+        msg = {"type": "message", "text": params.get("text", ""), "ts": ts, "bot_id": "BBOT", "user": "UBOT"}
+        if thread_ts:
+            msg["thread_ts"] = thread_ts
+        self.threads[channel, thread_ts or ts].append(msg)
+        self.thread_of[channel, ts] = thread_ts or ts
+        return {"channel": channel, "ts": ts, "message": msg}
+
+    def chat_update(self, params):
+        channel, ts = params["channel"], params["ts"]
+        thread_ts = self.thread_of.get((channel, ts))
+        self.first_update.setdefault((channel, thread_ts), time.perf_counter())
+        for msg in self.threads[channel, thread_ts]:
+            if msg["ts"] == ts:
+                msg["text"] = params.get("text", "")
+        if self.reply_end and params.get("text", "").rstrip().endswith(self.reply_end):
+            self.replied[channel, thread_ts].set()
+        return {"channel": channel, "ts": ts, "text": params.get("text", "")}
+
+    def chat_postEphemeral(self, params):
+        return {"message_ts": self.next_ts()}
+
+    def conversations_replies(self, params):
+        return {"messages": list(self.threads[params["channel"], params["ts"]]), "has_more": False}
+
+
+class FakeOpenAI:
+    """
+    Streams chat completions at `token_rate` tokens per second. A user message is answered with a call of the tool
+    `tool_name` first with probability `tool_calls`, if the tool is offered.
+    """
+
+    def __init__(self, tokens: int, token_rate: float, tool_calls: float, tool_name: str, seed: int = 0):
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.tool_calls = tool_calls
+        self.tool_name = tool_name
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    @staticmethod
+    def chunk(delta: Dict, finish_reason: Optional[str] = None) -> bytes:
+        data = {
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "loadtest",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return b"data: " + json.dumps(data).encode() + b"\n\n"
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        last = body["messages"][-1]
+        tools = [tool["function"]["name"] for tool in body.get("tools") or []]
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(1 / self.token_rate)  # time to first token
+        if last["role"] == "user" and self.tool_name in tools and self.random.random() < self.tool_calls:
+            call = {
+                "index": 0,
+                "id": "call_%d" % self.requests,
+                "type": "function",
+                "function": {"name": self.tool_name, "arguments": json.dumps({"query": last["content"][:20]})},
+            }
+            await response.write(self.chunk({"role": "assistant", "tool_calls": [call]}))
+            await response.write(self.chunk({}, "tool_calls"))
+        else:
+            for i in range(self.tokens):
+                await response.write(self.chunk({"content": "token%d " % i}))
+                await asyncio.sleep(1 / self.token_rate)
+            await response.write(self.chunk({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+async def run(args):
+    from openai import AsyncOpenAI
+    from slack_bolt.request.async_request import AsyncBoltRequest
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    import app
+    from metrics import first_token_seconds, generation_seconds, worker_requests_total
+    from plugin import tool_call
+
+    @tool_call("Looks up facts about the query.")
+    async def lookup(query: str) -> str:
+        await asyncio.sleep(args.tool_latency)
+        return f"Facts about {query}"
+
+    fake_slack = FakeSlack({"chat.update": args.update_limit} if args.update_limit else None)
+    fake_openai = FakeOpenAI(args.tokens, args.token_rate, args.tool_calls, lookup.__name__)
+    slack_app = web.Application()
+    slack_app.router.add_route("*", "/api/{method}", fake_slack.handle)
+    slack_app.router.add_get("/socket", fake_slack.socket)
+    openai_app = web.Application()
+    openai_app.router.add_post("/chat/completions", fake_openai.handle)
+    slack_runner, slack_url = await start_server(slack_app)
+    openai_runner, openai_url = await start_server(openai_app)
+    fake_slack.socket_url = slack_url.replace("http", "ws", 1) + "/socket"
+    fake_slack.reply_end = "token%d" % (args.tokens - 1)
+
+    app.db.generate_mapping(create_tables=True, check_tables=True)
+    app.slack.client.base_url = slack_url + "/api/"
+    app.openai.openai = AsyncOpenAI(base_url=openai_url, api_key="sk-loadtest", max_retries=0)
+    app.openai.add_function(lookup)
+    supervisor_task = None
+    if args.workers > 1:  # the worker processes find the fake servers through their environment
+        from workers import Supervisor
+
+        os.environ["SLACK_API_URL"] = slack_url + "/api/"
+        os.environ["OPENAI_BASE_URL"] = openai_url
+        supervisor = Supervisor(args.workers, "xapp-loadtest", AsyncWebClient(base_url=slack_url + "/api/"))
+        supervisor_task = asyncio.create_task(supervisor.run())
+        await asyncio.wait_for(fake_slack.connected.wait(), 60)
+
+    latencies = []
+    event_ids = itertools.count()
+
+    async def conversation(i: int):
+        channel, thread_ts = f"D{i:05d}", None
+        for j in range(args.messages):
+            msg = fake_slack.add_user_message(channel, thread_ts, f"Question {j} in thread {i}")
+            thread_ts = thread_ts or msg["ts"]
+            fake_slack.first_update.pop((channel, thread_ts), None)
+            body = {
+                "type": "event_callback",
+                "team_id": "T1",
+                "api_app_id": "A1",
+                "event_id": f"Ev{next(event_ids)}",
+                "event_time": int(time.time()),
+                "event": dict(msg, channel_type="im", event_ts=msg["ts"]),
+            }
+            t0 = time.perf_counter()
+            key = channel, thread_ts
+            if supervisor_task is not None:
+                fake_slack.replied[key].clear()
+                await fake_slack.send_envelope(body)
+                await fake_slack.replied[key].wait()
+                if key in fake_slack.first_update:
+                    latencies.append(fake_slack.first_update[key] - t0)
+                continue
+            response = await app.slack.async_dispatch(AsyncBoltRequest(body=body, mode="socket_mode"))
+            assert response.status == 200, response.body
+            while not app.generations.running(key):  # the handler submits the generation in the background
+                await asyncio.sleep(0.01)
+            while app.generations.running(key):
+                await asyncio.sleep(0.01)
+            if key in fake_slack.first_update:
+                latencies.append(fake_slack.first_update[key] - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[conversation(i) for i in range(args.threads)])
+    await app.generations.join()
+    elapsed = time.perf_counter() - t0
+
+    replies = args.threads * args.messages
+    print(f"{args.threads} threads x {args.messages} messages, {args.tokens} tokens at {args.token_rate}/s each")
+    print(f"{replies} replies in {elapsed:.2f}s, {replies / elapsed:.2f} replies/s")
+    print(f"time to first update: p50 {percentile(latencies, 0.5):.3f}s, p99 {percentile(latencies, 0.99):.3f}s")
+    if supervisor_task is not None:  # the other metrics are recorded in the worker processes
+        print(f"requests per worker: {dict((k[0], v) for k, v in worker_requests_total.values.items())}")
+        supervisor_task.cancel()
+        await asyncio.gather(supervisor_task, return_exceptions=True)
+    else:
+        print(
+            f"time to first token (bucketed): p50 <= {first_token_seconds.quantile(0.5)}s, "
+            f"p99 <= {first_token_seconds.quantile(0.99)}s"
+        )
+        print(f"generations: {dict((k[0], sum(v)) for k, v in generation_seconds.counts.items())}")
+    print(f"OpenAI requests: {fake_openai.requests}")
+    print(f"Slack API calls: {dict(fake_slack.calls)}, rate limited: {dict(fake_slack.rate_limited)}")
+    print(f"chat.update calls per reply: {fake_slack.calls['chat.update'] / replies:.1f}")
+
+    await app.http_clients.close()
+    await slack_runner.cleanup()
+    await openai_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=20, help="concurrent conversations")
+    parser.add_argument("--messages", type=int, default=2, help="messages per conversation, sent one after the other")
+    parser.add_argument("--tokens", type=int, default=100, help="tokens per reply")
+    parser.add_argument("--token-rate", type=float, default=100, help="tokens per second of each stream")
+    parser.add_argument("--tool-calls", type=float, default=0.2, help="fraction of replies starting with a tool call")
+    parser.add_argument("--tool-latency", type=float, default=0.2, help="seconds per tool call")
+    parser.add_argument("--update-limit", type=int, default=0, help="chat.update calls per minute, 0 for no limit")
+    parser.add_argument("--update-rate", type=float, help="overrides SLACK_UPDATE_RATE of the bot")
+    parser.add_argument("--concurrency", type=int, help="overrides MAX_CONCURRENT_GENERATIONS of the bot")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, tool calls are not made if > 1")
+    args = parser.parse_args()
+    if args.update_rate is not None:
+        os.environ["SLACK_UPDATE_RATE"] = str(args.update_rate)
+    if args.concurrency is not None:
+        os.environ["MAX_CONCURRENT_GENERATIONS"] = str(args.concurrency)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
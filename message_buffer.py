@@ -0,0 +1,122 @@
+import random
+import time
+from collections import deque
+from typing import List
+
+SLACK_MESSAGE_LIMIT = 3000  # bytes of UTF-8 text per Slack message
+
+# split points in order of preference, the chunk is cut right after the separator
+# (or right before it, for code fences, so that the fence opens the next message)
+BOUNDARIES = [
+    ("\n```", 1),
+    ("\n\n", 2),
+    ("\n", 1),
+    ("。", 1),
+    (". ", 2),
+    ("! ", 2),
+    ("? ", 2),
+    (" ", 1),
+]
+
+
+class MessageBuffer:
+    """
+    Accumulates streamed text deltas and hands out chunks that fit into a single Slack message.
+    The byte length of the pending text is tracked incrementally, so appending a delta costs only the size of the delta.
+    """
+
+    def __init__(self, limit: int = SLACK_MESSAGE_LIMIT):
+        self.limit = limit
+        self._parts: List[str] = []
+        self._size = 0  # byte length of the pending text
+        self._text = None  # cached "".join(self._parts)
+        self._chunks = deque()  # finished chunks ready to be posted
+
+    @property
+    def text(self) -> str:
+        """The pending text which has not been split off as a chunk yet."""
+        if self._text is None:
+            self._text = "".join(self._parts)
+            self._parts = [self._text] if self._text else []
+        return self._text
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def append(self, delta: str):
+        delta_size = len(delta.encode("utf-8"))
+        if self._size + delta_size <= self.limit:
+            self._parts.append(delta)
+            self._size += delta_size
+            self._text = None
+            return
+        text = self.text + delta
+        encoded = text.encode("utf-8")
+        while len(encoded) > self.limit:
+            # longest prefix fitting into the limit, without cutting a multibyte character
+            max_chars = len(encoded[: self.limit].decode("utf-8", errors="ignore"))
+            cut = find_split_point(text, max_chars)
+            self._chunks.append(text[:cut])
+            text = text[cut:]
+            encoded = text.encode("utf-8")
+        self._parts = [text] if text else []
+        self._text = text
+        self._size = len(encoded)
+
+    def has_chunks(self) -> bool:
+        return bool(self._chunks)
+
+    def pop_chunks(self) -> List[str]:
+        """Returns the finished chunks, each of them fits into one Slack message."""
+        chunks = list(self._chunks)
+        self._chunks.clear()
+        return chunks
+
+
+def find_split_point(text: str, max_chars: int) -> int:
+    """
+    Finds where to split `text` so that the first part has at most `max_chars` characters.
+    Prefers paragraph, code fence, line and sentence boundaries in the second half of the window.
+    """
+    min_chars = max_chars // 2
+    for sep, offset in BOUNDARIES:
+        pos = text.rfind(sep, min_chars, max_chars)
+        if pos != -1 and pos + offset <= max_chars:
+            return pos + offset
+    return max(max_chars, 1)
+
+
+def main():
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "数据", "流式", "😀", "```", "\n", "\n\n", ".", ","]
+    random.seed(0)
+    deltas = [random.choice(words) + " " for _ in range(50_000)]  # a synthetic reply of 50k tokens
+    print(f"reply: {len(deltas)} deltas, {len(''.join(deltas).encode())} bytes")
+
+    t0 = time.perf_counter()
+    response, messages = "", 0
+    for delta in deltas:  # the previous approach, re-encoding the whole response on every delta
+        if len(response.encode("utf-8")) + len(delta.encode("utf-8")) > SLACK_MESSAGE_LIMIT:
+            response = delta
+            messages += 1
+        else:
+            response += delta
+    t1 = time.perf_counter()
+    print(f"naive concatenation: {t1 - t0:.3f}s, {messages + 1} messages")
+
+    t0 = time.perf_counter()
+    buffer = MessageBuffer()
+    chunks = []
+    for delta in deltas:
+        buffer.append(delta)
+        if buffer.has_chunks():
+            chunks += buffer.pop_chunks()
+    chunks.append(buffer.text)
+    t1 = time.perf_counter()
+    assert "".join(chunks) == "".join(deltas)
+    assert all(len(c.encode("utf-8")) <= SLACK_MESSAGE_LIMIT for c in chunks)
+    print(f"MessageBuffer: {t1 - t0:.3f}s, {len(chunks)} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# /metrics in the Prometheus text format is served on this port when set, and/or logged every interval seconds
+metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+metrics_port = int(os.environ.get("METRICS_PORT", 0))
+metrics_log_interval = float(os.environ.get("METRICS_LOG_INTERVAL", 0))
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value as the Prometheus text format requires."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metric(ABC):
+    type: str
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """The sample lines of the metric in the Prometheus text format."""
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    """A value which is set, or read from `func` when the metrics are rendered."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), func: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+        self.func = func
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [f"{self.name} {_format_value(self.func())}"]
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: Dict[Labels, List[int]] = {}  # per bucket, the last one is +Inf
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def count(self, **labels) -> int:
+        return sum(self.counts.get(self._key(labels), []))
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimates the quantile as the upper bound of the bucket it falls into, like histogram_quantile()."""
+        counts = self.counts.get(self._key(labels))
+        if not counts:
+            return 0.0
+        rank = q * sum(counts)
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        lines = []
+        for key, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.label_names, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {self.sums[key]!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicated metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), func: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, help, labels, func))
+
+    def histogram(
+        self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+# the hot paths of the bot, recorded by the modules which own them
+events_total = registry.counter("slack_events_total", "Slack message events handled.", ["kind"])
+event_seconds = registry.histogram("slack_event_handling_seconds", "Time spent in the Slack message handler.")
+first_token_seconds = registry.histogram(
+    "reply_first_token_seconds", "Time from starting a reply to the first streamed token."
+)
+generation_seconds = registry.histogram("reply_generation_seconds", "Total time of generating a reply.", ["outcome"])
+slack_updates_total = registry.counter("slack_updates_total", "chat.update calls, by result.", ["result"])
+slack_updates_per_message = registry.histogram(
+    "slack_updates_per_message", "chat.update calls sent for one message.", buckets=COUNT_BUCKETS
+)
+openai_request_seconds = registry.histogram(
+    "openai_request_seconds", "Duration of streamed chat completion requests.", ["finish_reason"]
+)
+tool_rounds_per_reply = registry.histogram(
+    "reply_tool_rounds", "Rounds of tool calls in one reply.", buckets=(0, 1, 2, 3, 5, 8, 13, 21)
+)
+tool_call_seconds = registry.histogram("tool_call_seconds", "Latency of tool calls.", ["function", "outcome"])
+tool_cache_lookups = registry.counter(
+    "tool_cache_lookups_total", "Tool cache lookups: memory, db, miss, or shared with a call in flight.", ["result"]
+)
+worker_requests_total = registry.counter(
+    "worker_requests_total", "Socket Mode requests routed to each worker by the supervisor.", ["worker"]
+)
+worker_restarts_total = registry.counter("worker_restarts_total", "Worker processes restarted.", ["worker"])
+job_queue_seconds = registry.histogram(
+    "job_queue_seconds", "Time jobs waited for a worker of a job executor.", ["executor"]
+)
+job_seconds = registry.histogram(
+    "job_seconds", "Execution time of jobs: ok, error, timeout or cancelled.", ["executor", "outcome"]
+)
+jobs_rejected_total = registry.counter("jobs_rejected_total", "Jobs rejected as the queue was full.", ["executor"])
+db_query_seconds = registry.histogram("db_query_seconds", "Time of database calls, queueing included.", ["query"])
+loop_lag_seconds = registry.histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop wakes up from a short sleep.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+async def monitor_loop_lag(interval: float = 0.5, histogram: Histogram = loop_lag_seconds):
+    """Records how late the event loop wakes up from sleeping `interval` seconds into `histogram`, until cancelled."""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - t0 - interval))
+
+
+async def serve(host: str = metrics_host, port: int = metrics_port):
+    """Serves the registry at http://host:port/metrics, returns the runner to clean up."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info("Serving metrics on http://%s:%s/metrics", *runner.addresses[0][:2])
+    return runner
+
+
+async def log_periodically(interval: float = metrics_log_interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("Metrics:\n%s", registry.render())
+
+
+async def run_metrics():
+    """Runs the loop lag monitor and, if configured, the HTTP endpoint and the periodic dump, until cancelled."""
+    runner = await serve() if metrics_port else None
+    tasks = [asyncio.create_task(monitor_loop_lag())]
+    if metrics_log_interval > 0:
+        tasks.append(asyncio.create_task(log_periodically()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if runner is not None:
+            await runner.cleanup()
+
+
+async def main():
+    requests = registry.counter("demo_requests_total", "Demo requests.", ["path"])
+    latency = registry.histogram("demo_latency_seconds", "Demo latency.", ["path"])
+    for i in range(1000):
+        requests.inc(path="/a" if i % 3 else "/b")
+        latency.observe(i / 1000, path="/a" if i % 3 else "/b")
+
+    t0 = time.perf_counter()
+    for i in range(100_000):
+        latency.observe(0.01, path="/a")
+    print(f"observe: {(time.perf_counter() - t0) * 10:.2f}us per call")
+    print(f"p50 {latency.quantile(0.5, path='/a')}, p99 {latency.quantile(0.99, path='/a')}")
+
+    runner = await serve(port=0)
+    port = runner.addresses[0][1]
+    from http_clients import http_clients
+
+    async with http_clients:
+        async with http_clients.aiohttp.get(f"http://127.0.0.1:{port}/metrics") as response:
+            text = await response.text()
+    print("\n".join(line for line in text.splitlines() if line.startswith("demo_")))
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -1,19 +1,72 @@
 import asyncio
+import inspect
 import json
 import logging
 import os
+import time
 import traceback
+from contextlib import aclosing
+from dataclasses import dataclass
 from pprint import pprint
-from typing import Annotated, Any, AsyncGenerator, AsyncIterator, Callable, Dict, List
+from typing import Annotated, Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Union
 
 from openai import AsyncOpenAI
 
-from plugin import tool_call
+from metrics import openai_request_seconds, tool_call_seconds, tool_rounds_per_reply
+from plugin import function_schema, tool_call
+
+max_tool_rounds = int(os.environ.get("MAX_TOOL_ROUNDS", 8))
+reply_time_budget = float(os.environ.get("REPLY_TIME_BUDGET", 600))
+
+
+@dataclass
+class TextDelta:
+    text: str
+
+
+@dataclass
+class ToolStart:
+    tool_call_id: str
+    name: str
+    arguments: str  # JSON, as generated by the model
+
+
+@dataclass
+class ToolEnd:
+    tool_call_id: str
+    name: str
+    seconds: float
+    outcome: str  # ok, error, timeout or unknown
+
+
+ReplyEvent = Union[TextDelta, ToolStart, ToolEnd]
+
+
+def drop_unanswered_tool_calls(msgs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Leaves out the tool calls of the assistant missing a result, e.g. of a superseded generation, and their partial
+    results. The API rejects every later request of the thread if such a message is stored.
+    """
+    answered = {msg["tool_call_id"] for msg in msgs if msg.get("role") == "tool"}
+    dropped = set()
+    for msg in msgs:
+        if msg.get("tool_calls") and not all(call["id"] in answered for call in msg["tool_calls"]):
+            dropped.update(call["id"] for call in msg["tool_calls"])
+    return [
+        msg
+        for msg in msgs
+        if not (msg.get("tool_calls") and any(call["id"] in dropped for call in msg["tool_calls"]))
+        and not (msg.get("role") == "tool" and msg.get("tool_call_id") in dropped)
+    ]
 
 
 class OpenAIWrapper:
-    def __init__(self):
+    def __init__(self, max_tool_rounds: int = max_tool_rounds, time_budget: float = reply_time_budget):
         self.available_funcs: Dict[str, Callable] = {}
+        # async (function name, result, msg_history) -> result, applied to the result of every tool call in order
+        self.result_processors: List[Callable[[str, Any, List[Dict[str, Any]]], Awaitable[Any]]] = []
+        self.max_tool_rounds = max_tool_rounds
+        self.time_budget = time_budget
         api_key = os.getenv("OPENAI_API_KEY")
         self.openai = AsyncOpenAI(api_key=api_key)
         self.model = os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview")
@@ -32,98 +85,165 @@ class OpenAIWrapper:
     def add_function(self, func):
         self.available_funcs[func.__name__] = func
 
+    def add_result_processor(self, processor):
+        self.result_processors.append(processor)
+
     def _get_tools_schema(self):
         if not self.available_funcs:
             # openai.chat.completions.create() will fail with tools={}, so we return None instead
             return None
-        return [func.schema for func in self.available_funcs.values()]
+        return [function_schema(func) for func in self.available_funcs.values()]
 
-    async def _execute_function(self, tool_calls: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
-        async def execute_tool_call(tool_call):
-            id = tool_call["id"]
+    async def _execute_function(
+        self, tool_calls: List[Dict[str, Any]], msg_history: List[Dict[str, Any]], timeout: float
+    ) -> AsyncIterator[ReplyEvent]:
+        """
+        Runs the tool calls concurrently and yields their start and end events. The results are appended to
+        `msg_history` in the order of the calls once all of them are done. Calls still running after `timeout`
+        seconds are cancelled and answered with a timeout message.
+        """
+
+        async def execute_tool_call(index, tool_call):
             func = tool_call["function"]
             func_name = func["name"]
             if func_name not in self.available_funcs:
-                return {
-                    "tool_call_id": id,
-                    "role": "tool",
-                    "name": func_name,
-                    "content": f"(Unknown function: {func_name})",
-                }
+                # a name made up by the model is not a label value, every new one would be another time series
+                tool_call_seconds.observe(0, function="unknown", outcome="unknown")
+                return index, f"(Unknown function: {func_name})", 0.0, "unknown"
             func_to_call = self.available_funcs[func_name]
-            func_args = json.loads(func["arguments"])
+            t0 = time.perf_counter()
+            outcome = "cancelled"
             try:
-                if asyncio.iscoroutinefunction(func_to_call):
-                    func_return = await func_to_call(**func_args)
-                else:
+                func_args = json.loads(func["arguments"])
+                async with asyncio.timeout(timeout):
                     func_return = func_to_call(**func_args)
+                    if inspect.isawaitable(func_return):  # async functions, and lazily loaded plugins
+                        func_return = await func_return
+                    for process in self.result_processors:
+                        func_return = await process(func_name, func_return, msg_history)
+                outcome = "ok"
+            except TimeoutError:
+                outcome = "timeout"
+                func_return = "(Function call timed out)"
+                logging.error("Function call timed out: %s", func_name)
             except Exception as e:
+                outcome = "error"
                 func_return = f"(Exception in function call: {e})"
                 logging.error("Exception in function call: %s", e)
                 traceback.print_exc()
-            return {
-                "tool_call_id": id,
-                "role": "tool",
-                "name": func_name,
-                "content": func_return,
-            }
-
-        coroutines = [execute_tool_call(tool_call) for tool_call in tool_calls]
-        results = await asyncio.gather(*coroutines)
-        for result in results:
-            yield result
-
-    async def generate_reply(self, msg_history: List[Dict[str, Any]]) -> AsyncGenerator[str, None]:
+            finally:
+                tool_call_seconds.observe(time.perf_counter() - t0, function=func_name, outcome=outcome)
+            return index, func_return, time.perf_counter() - t0, outcome
+
+        for tool_call in tool_calls:
+            yield ToolStart(tool_call["id"], tool_call["function"]["name"], tool_call["function"]["arguments"])
+        tasks = [asyncio.create_task(execute_tool_call(i, tool_call)) for i, tool_call in enumerate(tool_calls)]
+        results: List[Any] = [None] * len(tool_calls)
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, content, seconds, outcome = await next_done
+                results[index] = content
+                tool_call = tool_calls[index]
+                yield ToolEnd(tool_call["id"], tool_call["function"]["name"], seconds, outcome)
+        finally:  # the caller stopped early, e.g. the generation was superseded
+            for task in tasks:
+                task.cancel()
+        msg_history += [
+            {"tool_call_id": tool_call["id"], "role": "tool", "name": tool_call["function"]["name"], "content": content}
+            for tool_call, content in zip(tool_calls, results)
+        ]
+
+    async def generate_reply(self, msg_history: List[Dict[str, Any]]) -> AsyncGenerator[ReplyEvent, None]:
+        """
+        Streams the reply to `msg_history` as events, running the tool calls of the model in between. Tool calls and
+        their results are appended to `msg_history`. After `max_tool_rounds` rounds of tool calls the model has to
+        answer without tools, and no new request is started once `time_budget` seconds have passed.
+        """
         logging.debug("msg_history: %s", msg_history)
-        msg = msg_history[-1]
-        if msg.get("role") in ["user", "tool"]:  # message from user or function return
-            stream = await self._raw_chat_complete(msg_history)
-            pending_tool_calls = []
-            async for chunk in stream:
-                choice = chunk.choices[0]
-                delta = choice.delta
-                assert delta is not None
-                if delta.content:
-                    yield delta.content
-                if delta.tool_calls:
-                    for tool_call in delta.tool_calls:  # new tool call
-                        if tool_call.index == len(pending_tool_calls):
-                            assert tool_call.type == "function"
-                            pending_tool_calls.append(tool_call.model_dump())
-                        else:  # existing tool call in streaming response
-                            pending_tool_calls[tool_call.index]["function"]["arguments"] += tool_call.function.arguments
-                match choice.finish_reason:
-                    case "length":
-                        yield "(Response truncated due to length limit)"
-                    case "content_filter":
-                        yield "(Request omitted due to content filter)"
-                    case "tool_calls":
+        deadline = time.monotonic() + self.time_budget
+        rounds = 0
+        try:
+            while True:
+                msg = msg_history[-1]
+                if msg.get("tool_calls"):  # tool calls from assistant
+                    rounds += 1
+                    timeout = max(deadline - time.monotonic(), 0)
+                    try:
+                        async with aclosing(self._execute_function(msg["tool_calls"], msg_history, timeout)) as events:
+                            async for event in events:
+                                yield event
+                    except BaseException:  # tool calls without results would be rejected by the API next time
+                        if msg_history[-1] is msg:
+                            msg_history.pop()
+                        raise
+                    continue
+                if msg.get("role") not in ["user", "tool"]:
+                    yield TextDelta(f"Unknown message type: {msg}")
+                    logging.error("Unknown message type: %s", msg)
+                    return
+                # message from user or function return
+                if time.monotonic() >= deadline:
+                    yield TextDelta("(Reply stopped: time limit exceeded)")
+                    logging.warning("Reply stopped after %d tool call rounds: time limit exceeded", rounds)
+                    return
+                t0 = time.perf_counter()
+                finish_reason = None
+                stream = await self._raw_chat_complete(msg_history, tools=rounds < self.max_tool_rounds)
+                pending_tool_calls = []
+                try:
+                    async for chunk in stream:
+                        choice = chunk.choices[0]
+                        delta = choice.delta
+                        assert delta is not None
+                        if delta.content:
+                            yield TextDelta(delta.content)
+                        if delta.tool_calls:
+                            for tool_call in delta.tool_calls:  # new tool call
+                                if tool_call.index == len(pending_tool_calls):
+                                    assert tool_call.type == "function"
+                                    pending_tool_calls.append(tool_call.model_dump())
+                                else:  # existing tool call in streaming response
+                                    pending_tool_calls[tool_call.index]["function"][
+                                        "arguments"
+                                    ] += tool_call.function.arguments
+                        if choice.finish_reason is not None:
+                            finish_reason = choice.finish_reason
+                            openai_request_seconds.observe(time.perf_counter() - t0, finish_reason=finish_reason)
+                finally:  # also when the caller stops early, e.g. the generation was superseded
+                    await stream.close()
+                    if finish_reason is None:
+                        openai_request_seconds.observe(time.perf_counter() - t0, finish_reason="incomplete")
+                match finish_reason:
+                    case "tool_calls" if rounds < self.max_tool_rounds:
                         msg_history.append({"role": "assistant", "tool_calls": pending_tool_calls})
                         logging.debug("pending_tool_calls: %s", pending_tool_calls)
-                        async for content in self.generate_reply(msg_history):
-                            yield content
+                        continue
+                    case "tool_calls":
+                        yield TextDelta(f"(Reply stopped: more than {self.max_tool_rounds} rounds of tool calls)")
+                        logging.warning("Reply stopped: tool call rounds exceeded %d", self.max_tool_rounds)
+                    case "length":
+                        yield TextDelta("(Response truncated due to length limit)")
+                    case "content_filter":
+                        yield TextDelta("(Request omitted due to content filter)")
                     case "stop":  # finished normally
                         pass
-                    case None:  # not finished
+                    case None:  # the stream ended without a finish reason
                         pass
                     case _:
-                        yield f"(finish: {choice.finish_reason})"
-                        logging.error("Unexpected finish reason: %s", choice.finish_reason)
-        elif msg.get("tool_calls"):  # tool calls from assistant
-            msg_history += [result async for result in self._execute_function(msg["tool_calls"])]
-            async for content in self.generate_reply(msg_history):
-                yield content
-        else:
-            yield f"Unknown message type: {msg}"
-            logging.error("Unknown message type: %s", msg)
-
-    def _raw_chat_complete(self, msg_history):
+                        yield TextDelta(f"(finish: {finish_reason})")
+                        logging.error("Unexpected finish reason: %s", finish_reason)
+                return
+        finally:
+            tool_rounds_per_reply.observe(rounds)
+
+    def _raw_chat_complete(self, msg_history, tools: bool = True):
+        tools_schema = self._get_tools_schema() if tools else None
         logging.debug("msg_history: %s", msg_history)
-        logging.debug("tools_schema: %s", self._get_tools_schema())
+        logging.debug("tools_schema: %s", tools_schema)
         return self.openai.chat.completions.create(
             model=self.model,
             messages=msg_history,
-            tools=self._get_tools_schema(),
+            tools=tools_schema,
             stream=True,
         )
 
@@ -144,8 +264,14 @@ async def main():
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": "Set a timer for 3 seconds and 5 seconds in parallel."},
         ]
-        async for r in client.generate_reply(prompts):
-            print(r, end="", flush=True)
+        async for event in client.generate_reply(prompts):
+            match event:
+                case TextDelta(text=text):
+                    print(text, end="", flush=True)
+                case ToolStart(name=name, arguments=arguments):
+                    print(f"[{name}({arguments}) started]")
+                case ToolEnd(name=name, seconds=seconds, outcome=outcome):
+                    print(f"[{name} finished in {seconds:.1f}s: {outcome}]")
         pprint(prompts)
 
 
@@ -0,0 +1,178 @@
+"""
+Local relevance ranking of long texts, e.g. a web page or a PDF returned by a plugin: the text is split into passages
+of whole lines, which are scored against a question with BM25. Nothing is precomputed, a text is ranked in one pass
+over it, so a different question costs as much as the first one.
+"""
+
+import math
+import random
+import re
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from truncation import SENTENCE_ENDS
+
+# words, and single CJK characters as these are not separated by spaces
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TOKEN = re.compile(f"[{CJK}]|[^\\W_{CJK}]+")
+K1 = 1.2  # BM25 term frequency saturation
+B = 0.75  # BM25 passage length normalization
+PASSAGE_CHARS = 1500
+
+Span = Tuple[int, int]  # start and end offset of a passage in the text
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+def _cut(text: str, start: int, limit: int) -> int:
+    """Where to cut a line longer than a passage: after a sentence, else after a space, in the second half."""
+    middle = (start + limit) // 2
+    for ends in (SENTENCE_ENDS, [" "]):
+        positions = [(text.rfind(end, middle, limit), end) for end in ends]
+        cut = max((position + len(end) for position, end in positions if position >= 0), default=0)
+        if cut:
+            return cut
+    return limit
+
+
+def split_passages(text: str, max_chars: int = PASSAGE_CHARS) -> List[Span]:
+    """Splits the text into passages of at most `max_chars` characters, made of whole lines where possible."""
+    spans = []
+    start = end = 0  # of the passage being filled
+    while end < len(text):
+        newline = text.find("\n", end)
+        line_end = len(text) if newline < 0 else newline + 1
+        if line_end - start <= max_chars:
+            end = line_end
+        elif end > start:  # the passage is full
+            spans.append((start, end))
+            start = end
+        else:  # a single line longer than a passage
+            cut = _cut(text, start, start + max_chars)
+            spans.append((start, cut))
+            start = end = cut
+    if end > start:
+        spans.append((start, end))
+    return spans
+
+
+def score_passages(text: str, spans: Sequence[Span], query: str) -> List[float]:
+    """The BM25 score of every passage for the words of `query`, 0 for passages without any of them."""
+    terms = set(tokenize(query))
+    if not terms or not spans:
+        return [0.0] * len(spans)
+    lengths = []
+    frequencies: List[Dict[str, int]] = []  # of the query terms in each passage
+    document_frequency: Counter = Counter()
+    for start, end in spans:
+        tokens = tokenize(text[start:end])
+        counts = Counter(tokens)
+        found = {term: counts[term] for term in terms if term in counts}
+        lengths.append(len(tokens))
+        frequencies.append(found)
+        document_frequency.update(found.keys())
+    average_length = sum(lengths) / len(lengths) or 1
+    idf = {
+        term: math.log(1 + (len(spans) - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()
+    }
+    scores = []
+    for length, found in zip(lengths, frequencies):
+        norm = K1 * (1 - B + B * length / average_length)
+        scores.append(sum(idf[term] * tf * (K1 + 1) / (tf + norm) for term, tf in found.items()))
+    return scores
+
+
+def select_passages(
+    text: str, spans: Sequence[Span], query: str, max_tokens: int, count_tokens: Callable[[str], int]
+) -> List[int]:
+    """
+    The indexes of the passages most relevant to `query` which fit into `max_tokens`, in the order of the text.
+    The first passage, often the title and the introduction, is always kept. If no passage matches the query, the
+    passages are taken from the start of the text.
+    """
+    scores = score_passages(text, spans, query)
+    relevant = sorted((i for i in range(1, len(spans)) if scores[i] > 0), key=lambda i: (-scores[i], i))
+    return take_passages(text, spans, [0] + (relevant or list(range(1, len(spans)))), max_tokens, count_tokens)
+
+
+def take_passages(
+    text: str, spans: Sequence[Span], order: Sequence[int], max_tokens: int, count_tokens: Callable[[str], int]
+) -> List[int]:
+    """The passages in `order` until `max_tokens` are used up, sorted by their position. At least one is taken."""
+    taken = []
+    used = 0
+    for i in order:
+        start, end = spans[i]
+        tokens = count_tokens(text[start:end])
+        if taken and used + tokens > max_tokens:
+            break
+        taken.append(i)
+        used += tokens
+    return sorted(taken)
+
+
+def _omitted(first: int, last: int, total: int) -> str:
+    numbers = f"passage {first + 1}" if first == last else f"passages {first + 1}-{last + 1}"
+    return f"[... {numbers} of {total} omitted ...]\n"
+
+
+def format_passages(text: str, spans: Sequence[Span], indexes: Sequence[int]) -> str:
+    """Joins the passages, marking the omitted ones in between by their numbers, counted from 1."""
+    parts = []
+    previous = -1
+    for i in indexes:
+        if i > previous + 1:
+            parts.append(_omitted(previous + 1, i - 1, len(spans)))
+        start, end = spans[i]
+        parts.append(text[start:end] if text[end - 1 : end] == "\n" else text[start:end] + "\n")
+        previous = i
+    if previous + 1 < len(spans):
+        parts.append(_omitted(previous + 1, len(spans) - 1, len(spans)))
+    return "".join(parts)
+
+
+def main():
+    from context_builder import ContextBuilder
+
+    count_tokens = ContextBuilder("gpt-4o").count_text
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(5000)] + ["这是", "一个", "测试", "文档", "的", "内容"]
+    lines = []
+    size = 0
+    while size < 5 * 1024 * 1024:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(5, 40))) + "."
+        lines.append(line)
+        size += len(line.encode()) + 1
+    answer = "The warranty of the flux capacitor expires after 88 years."
+    lines.insert(len(lines) * 2 // 3, answer)
+    document = "\n".join(lines)
+
+    megabytes = len(document.encode()) / 1024 / 1024
+    for query in ["When does the flux capacitor warranty expire?", "word1 word2 word3 这是 文档"]:
+        t0 = time.perf_counter()
+        spans = split_passages(document)
+        t1 = time.perf_counter()
+        kept = select_passages(document, spans, query, 3000, count_tokens)
+        excerpt = format_passages(document, spans, kept)
+        t2 = time.perf_counter()
+        print(f"{megabytes:.1f} MB document, {len(spans)} passages, query {query!r}")
+        print(f"  split: {t1 - t0:.3f}s, rank and select: {t2 - t1:.3f}s, {megabytes / (t2 - t0):.1f} MB/s")
+        print(f"  kept {len(kept)} passages, {count_tokens(excerpt)} of {count_tokens(document)} tokens")
+    assert answer in format_passages(document, spans, select_passages(document, spans, answer, 3000, count_tokens))
+
+    # passages are made of whole lines, long lines are cut after a sentence
+    assert "".join(document[start:end] for start, end in spans) == document
+    assert all(end - start <= PASSAGE_CHARS for start, end in spans)
+    assert split_passages("a\nb\nc", 4) == [(0, 4), (4, 5)]
+    assert split_passages("First one. Second one. Third", 16) == [(0, 11), (11, 23), (23, 28)]
+    assert tokenize("Hello, 世界 foo_bar") == ["hello", "世", "界", "foo", "bar"]
+    assert format_passages("a\nb\nc", [(0, 2), (2, 4), (4, 5)], [1]) == (
+        "[... passage 1 of 3 omitted ...]\nb\n[... passage 3 of 3 omitted ...]\n"
+    )
+
+
+if __name__ == "__main__":
+    main()
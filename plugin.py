@@ -1,50 +1,74 @@
 import asyncio
 import functools
+import inspect
+import logging
+import time
 from inspect import signature
-from typing import Annotated, Callable
-
-from autogen.function_utils import get_function_schema
-from pony.orm import *
+from typing import Annotated, Callable, Dict, Optional
 
 from database import db
+from metrics import tool_cache_lookups
+from tool_cache import ToolCache, cache_key_hash, delete_results
 
+tool_cache = ToolCache()
+in_flight: Dict[str, asyncio.Task] = {}  # cached tool calls being executed, by cache key hash
 
-class ToolCallCache(db.Entity):
-    """Database model for storing the tool call cache"""
-
-    key = Required(Json, index=True)  # Serialized function name and parameters
-    value = Required(str)  # the function's result as a string
 
+def tool_call(description: str, cache: bool = False, ttl: Optional[float] = None):
+    """
+    Registers a function as a tool, its schema is generated by `function_schema` when needed. With `cache`, results
+    are cached by function name and arguments, and expire after `ttl` seconds (never if None).
+    """
 
-def tool_call(description: str, cache: bool = False):
     def decorator(func: Callable):
-        schema = get_function_schema(func, description=description)
-        setattr(func, "schema", schema)
+        setattr(func, "description", description)
         if not cache:
             return func
 
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
-            key = generate_cache_index(func, *args, **kwargs)
-
-            with db_session:
-                entry = ToolCallCache.select(lambda e: e.key == key).first()
-                if entry:
-                    return entry.value
+        async def call_and_cache(key_hash, *args, **kwargs):
+            cached = await tool_cache.get(key_hash)
+            if cached is not None:
+                return cached
 
             if asyncio.iscoroutinefunction(func):
                 result = await func(*args, **kwargs)
             else:
                 result = func(*args, **kwargs)
-            with db_session:
-                ToolCallCache(key=key, value=result)
+            if isinstance(result, str):
+                try:
+                    await tool_cache.set(key_hash, func.__name__, result, ttl)
+                except Exception as e:  # the result is still good without the cache
+                    logging.exception("Failed to cache the result of %s: %s", func.__name__, e)
             return result
 
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key_hash = cache_key_hash(generate_cache_index(func, *args, **kwargs))
+
+            # single flight: concurrent calls with the same arguments share one execution
+            task = in_flight.get(key_hash)
+            if task is None:
+                task = in_flight[key_hash] = asyncio.create_task(call_and_cache(key_hash, *args, **kwargs))
+                task.add_done_callback(lambda _: in_flight.pop(key_hash, None))
+            else:
+                tool_cache_lookups.inc(result="shared")
+            # a cancelled caller, e.g. a superseded generation, must not cancel the call for the others
+            return await asyncio.shield(task)
+
         return wrapper
 
     return decorator
 
 
+def function_schema(func: Callable) -> Dict:
+    """Returns the OpenAI tool schema of a function decorated by `tool_call`, generated on first use."""
+    if getattr(func, "schema", None) is None:
+        from autogen.function_utils import get_function_schema  # slow to import, not needed with cached schemas
+
+        func.schema = get_function_schema(inspect.unwrap(func), description=func.description)
+    return func.schema
+
+
 def generate_cache_index(func, *args, **kwargs):
     """
     Convert *args and **kwargs to a key-value (KV) format.
@@ -84,6 +108,24 @@ async def main():
     print(await example_function2(1, 2))
     print(await example_function2(1, 2))  # The second call will fetch the result from the cache
 
+    executions = 0
+
+    @tool_call(description="This is a slow test function", cache=True)
+    async def slow_function(x: Annotated[int, "parameter x"]) -> str:
+        nonlocal executions
+        executions += 1
+        await asyncio.sleep(1)
+        return str(x)
+
+    # concurrent calls with the same arguments are executed only once
+    x = time.time_ns()  # not cached yet
+    results = await asyncio.gather(*[slow_function(x) for _ in range(10)], *[slow_function(x + 1) for _ in range(10)])
+    assert executions == 2 and results == [str(x)] * 10 + [str(x + 1)] * 10
+    print(f"{executions} executions for 20 concurrent calls with 2 distinct arguments")
+    print(tool_cache.stats())
+    for func in [example_function, example_function2, slow_function]:  # leave no demo results in DB_PATH
+        delete_results(func.__name__)
+
 
 if __name__ == "__main__":
     asyncio.run(main())
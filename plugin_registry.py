@@ -0,0 +1,141 @@
+"""
+The tools offered to the model, declared in PLUGINS. Their schemas are read from a cache file on startup, so that
+plugin modules, and heavy dependencies like yt_dlp and autogen, are only imported when a tool is first called.
+
+Run `python plugin_registry.py` to build the schema cache ahead of time, e.g. in the Docker image.
+"""
+
+import asyncio
+import hashlib
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+schema_cache_path = os.environ.get(
+    "PLUGIN_SCHEMA_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugin_schemas.json")
+)
+
+
+@dataclass
+class PluginSpec:
+    name: str  # of the tool, and of the function in `module`
+    module: str
+    env: Sequence[Sequence[str]] = ()  # enabled when all variables of one of these groups are set
+    rank_output: bool = False  # large results are cut down to the passages relevant to the question, see documents
+
+    def missing_config(self) -> Optional[str]:
+        """Returns the missing environment variables, or None if the plugin is configured."""
+        if not self.env or any(all(os.environ.get(name) for name in group) for group in self.env):
+            return None
+        return " or ".join(", ".join(group) for group in self.env)
+
+    def source_hash(self) -> str:
+        with open(importlib.util.find_spec(self.module).origin, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+
+PLUGINS: List[PluginSpec] = [
+    PluginSpec("browser_text", "plugins.browsing", [["BROWSER_TEXT_API_URL"]], rank_output=True),
+    PluginSpec("github", "plugins.browsing", [["GITHUB_API_URL"]], rank_output=True),
+    PluginSpec("pdf", "plugins.browsing", [["PDF_API_URL"]], rank_output=True),
+    # reads the documents shortened by the plugins above
+    PluginSpec("read_document", "plugins.documents", [["BROWSER_TEXT_API_URL"], ["GITHUB_API_URL"], ["PDF_API_URL"]]),
+    PluginSpec("youtube", "plugins.youtube"),
+    PluginSpec(
+        "search",
+        "plugins.search",
+        [["GOOGLE_SEARCH_KEY", "GOOGLE_SEARCH_CX"], ["BING_SEARCH_V7_SUBSCRIPTION_KEY", "BING_SEARCH_V7_ENDPOINT"]],
+    ),
+]
+
+
+class LazyTool:
+    """Stands in for a plugin function with its cached schema, importing the plugin on the first call."""
+
+    def __init__(self, spec: PluginSpec, schema: Dict):
+        self.__name__ = spec.name
+        self.spec = spec
+        self.schema = schema
+        self._func: Optional[Callable] = None
+
+    def load(self) -> Callable:
+        if self._func is None:
+            logging.info("Loading plugin %s from %s", self.spec.name, self.spec.module)
+            self._func = getattr(importlib.import_module(self.spec.module), self.spec.name)
+        return self._func
+
+    async def __call__(self, **kwargs):
+        result = self.load()(**kwargs)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+
+def load_schema_cache(path: str = schema_cache_path) -> Dict[str, Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_schema_cache(cache: Dict[str, Dict], path: str = schema_cache_path):
+    tmp_path = None
+    try:
+        # a temporary file of its own, as the workers may write the cache at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning("Failed to write the plugin schema cache %s: %s", path, e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def plugin_schema(spec: PluginSpec, cache: Dict[str, Dict]) -> Dict:
+    """Returns the schema of a plugin from `cache`, importing the plugin to generate it if its source changed."""
+    source_hash = spec.source_hash()
+    cached = cache.get(spec.name)
+    if cached is not None and cached.get("source_hash") == source_hash:
+        return cached["schema"]
+    from plugin import function_schema
+
+    logging.info("Generating the schema of plugin %s", spec.name)
+    schema = function_schema(getattr(importlib.import_module(spec.module), spec.name))
+    cache[spec.name] = {"source_hash": source_hash, "schema": schema}
+    return schema
+
+
+def load_tools(plugins: Sequence[PluginSpec] = PLUGINS, path: str = schema_cache_path) -> List[LazyTool]:
+    """Returns the configured plugins as lazily loaded tools. Plugins with missing configuration are skipped."""
+    cache = load_schema_cache(path)
+    cached = json.dumps(cache, sort_keys=True)
+    tools = []
+    for spec in plugins:
+        missing = spec.missing_config()
+        if missing is not None:
+            logging.warning("Plugin %s is disabled, it needs %s", spec.name, missing)
+            continue
+        tools.append(LazyTool(spec, plugin_schema(spec, cache)))
+    if json.dumps(cache, sort_keys=True) != cached:
+        save_schema_cache(cache, path)
+    return tools
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    cache = load_schema_cache()
+    for spec in PLUGINS:  # configured or not, the schemas are needed if it is configured later
+        plugin_schema(spec, cache)
+    save_schema_cache(cache)
+    print(f"Wrote the schemas of {len(cache)} plugins to {schema_cache_path}")
+
+
+if __name__ == "__main__":
+    main()
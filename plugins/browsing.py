@@ -4,9 +4,11 @@ import os
 from json import JSONDecodeError
 from typing import Annotated
 
-from httpx import AsyncClient, ReadTimeout
+from httpx import ReadTimeout
 
+from http_clients import http_clients
 from plugin import tool_call
+from truncation import max_result_length, truncate_result, truncate_text
 
 
 # using API from @SmartHypercube
@@ -15,17 +17,20 @@ from plugin import tool_call
 
 async def _api_request(api_url, url):
     try:
-        async with AsyncClient(http2=True, timeout=20) as client:
-            response = await client.post(api_url, json={"url": url})
-            try:
-                json_response = response.json()
-            except JSONDecodeError:
-                json_response = {}
-            data = json_response.get("data")
-            if data:
-                return json.dumps(data, ensure_ascii=False)
-            else:
-                return response.content
+        response = await http_clients.httpx.post(api_url, json={"url": url})
+        try:
+            json_response = response.json()
+        except JSONDecodeError:
+            json_response = {}
+        data = json_response.get("data")
+        if data:
+            if isinstance(data, dict):
+                truncate_result(data, max_result_length)
+            elif isinstance(data, str):
+                data, _ = truncate_text(data, max_result_length - 2, json_escaped=True)
+            return json.dumps(data, ensure_ascii=False)
+        else:
+            return truncate_text(response.text, max_result_length)[0]
     except ReadTimeout:
         return "(tool call timeout)"
     except Exception as e:
@@ -53,10 +58,11 @@ async def youtube(url: Annotated[str, "URL of the YouTube video."]) -> str:
 
 
 async def main():
-    print(await browser_text("https://www.openai.com/blog/"))
-    print(await github("https://github.com/torvalds/linux"))
-    print(await pdf("https://arxiv.org/pdf/2104.08691.pdf"))
-    print(await youtube("https://www.youtube.com/watch?v=QdBZY2fkU-0"))
+    async with http_clients:
+        print(await browser_text("https://www.openai.com/blog/"))
+        print(await github("https://github.com/torvalds/linux"))
+        print(await pdf("https://arxiv.org/pdf/2104.08691.pdf"))
+        print(await youtube("https://www.youtube.com/watch?v=QdBZY2fkU-0"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""
+Large results of the plugins declared with `rank_output` in plugin_registry, e.g. a web page or a PDF, are cut down to
+the passages most relevant to the user's latest question before they reach the model, see `rank_tool_output`. The full
+text is kept in a cache of its own, and the model can read more of it with `read_document`.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from typing import Annotated, Any, Dict, List, Optional, Tuple
+
+from context_builder import ContextBuilder
+from passage_ranking import format_passages, select_passages, split_passages, take_passages
+from plugin import tool_call
+from plugin_registry import PLUGINS
+from tool_cache import DocumentCache, ToolCache, cache_key_hash
+
+ranked_result_tokens = int(os.environ.get("RANKED_TOOL_RESULT_TOKENS", 3000))  # results above this are ranked
+document_ttl = float(os.environ.get("DOCUMENT_TTL", 7 * 24 * 3600))  # how long read_document can read a document
+document_max_bytes = int(os.environ.get("DOCUMENT_MAX_BYTES", 128 * 1024 * 1024))
+# kept apart from the tool results, so that long documents do not evict them; a document is read again and again
+document_cache = ToolCache(document_max_bytes, memory_max_bytes=8 * 1024 * 1024, entity=DocumentCache)
+ranked_tools = {spec.name for spec in PLUGINS if spec.rank_output}
+tokens = ContextBuilder(os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview"))
+
+MENTION = re.compile(r"<[@#!][^>]*>")  # Slack mentions in a question
+
+
+def _fits(text: str, max_tokens: int) -> bool:
+    # a token takes a few characters, longer texts are not counted
+    return len(text) <= max_tokens * 8 and tokens.count_text(text) <= max_tokens
+
+
+def latest_question(msg_history: List[Dict[str, Any]]) -> str:
+    for msg in reversed(msg_history):
+        if msg.get("role") == "user" and isinstance(msg.get("content"), str):
+            return MENTION.sub(" ", msg["content"])
+    return ""
+
+
+def _document_key(document_id: str) -> str:
+    return cache_key_hash({"func_name": "read_document", "document_id": document_id})
+
+
+async def store_document(text: str) -> str:
+    """Keeps the text for `read_document`, returns its document ID."""
+    document_id = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    await document_cache.set(_document_key(document_id), "read_document", text, document_ttl)
+    return document_id
+
+
+def _text_field(result: str) -> Tuple[Optional[Dict], Optional[str], str]:
+    """
+    The text to rank of a plugin result: the largest string field of a JSON object, the string of a JSON string, or
+    the result itself. Returns the object, the name of the field and the text.
+    """
+    try:
+        data = json.loads(result)
+    except ValueError:
+        return None, None, result
+    if isinstance(data, str):
+        return None, None, data
+    fields = [k for k, v in data.items() if isinstance(v, str)] if isinstance(data, dict) else []
+    if not fields:
+        return None, None, result
+    field = max(fields, key=lambda k: len(data[k]))
+    return data, field, data[field]
+
+
+def _rank(result: str, question: str, max_tokens: int) -> Optional[Tuple[str, str, int, int]]:
+    """Returns the text to keep, the excerpt of it, and the number of kept and all passages, or None if it is small."""
+    data, field, text = _text_field(result)
+    if data is not None:
+        data[field] = ""
+        max_tokens -= tokens.count_text(json.dumps(data, ensure_ascii=False))
+    if _fits(text, max_tokens):
+        return None
+    spans = split_passages(text)
+    kept = select_passages(text, spans, question, max_tokens, tokens.count_text)
+    excerpt = format_passages(text, spans, kept)
+    if data is not None:
+        data[field] = excerpt
+        excerpt = json.dumps(data, ensure_ascii=False)
+    return text, excerpt, len(kept), len(spans)
+
+
+async def rank_tool_output(func_name: str, result: Any, msg_history: List[Dict[str, Any]]) -> Any:
+    """
+    Result processor of OpenAIWrapper: cuts a large result of a ranked plugin down to the passages most relevant to the
+    latest question of the user, and stores the full text for `read_document`.
+    """
+    if func_name not in ranked_tools or not isinstance(result, str) or _fits(result, ranked_result_tokens):
+        return result
+    t0 = time.perf_counter()
+    try:
+        ranked = await asyncio.to_thread(_rank, result, latest_question(msg_history), ranked_result_tokens)
+        if ranked is None:
+            return result
+        text, excerpt, kept, total = ranked
+        document_id = await store_document(text)
+    except Exception as e:
+        logging.exception("Failed to rank the result of %s, keeping all of it: %s", func_name, e)
+        return result
+    logging.info(
+        "Ranked the result of %s: kept %d of %d passages, %d of %d bytes, in %.3fs",
+        func_name,
+        kept,
+        total,
+        len(excerpt.encode("utf-8")),
+        len(result.encode("utf-8")),
+        time.perf_counter() - t0,
+    )
+    return (
+        f'(Long result shortened to the {kept} of {total} passages most relevant to the question. Call read_document '
+        f'with document_id "{document_id}" to read other passages or to search it for other words.)\n{excerpt}'
+    )
+
+
+@tool_call(
+    "Reads more of a long document which another tool returned shortened. Searches the document for the words of "
+    "`query`, or reads it on from passage number `passage` if no query is given."
+)
+async def read_document(
+    document_id: Annotated[str, "document_id given with the shortened result"],
+    query: Annotated[str, "words to search the document for"] = "",
+    passage: Annotated[int, "number of the first passage to read, if no query is given"] = 1,
+) -> str:
+    text = await document_cache.get(_document_key(document_id))
+    if text is None:
+        return f"(Document {document_id} not found, it may have expired. Call the original tool again.)"
+    spans = split_passages(text)
+    if query:
+        kept = await asyncio.to_thread(select_passages, text, spans, query, ranked_result_tokens, tokens.count_text)
+    else:
+        order = range(min(max(passage, 1), len(spans)) - 1, len(spans))
+        kept = take_passages(text, spans, order, ranked_result_tokens, tokens.count_text)
+    return format_passages(text, spans, kept)
+
@@ -1,75 +1,142 @@
 import asyncio
 import json
+import logging
 import os
 import sys
-from typing import Annotated
+from abc import ABC, abstractmethod
+from typing import Annotated, Dict, List
 
 import aiohttp
 
+from http_clients import http_clients
 from plugin import tool_call
 
 # The original version is from: https://github.com/zzh1996/chatgpt-telegram-bot
 
-# google
-key = os.environ["GOOGLE_SEARCH_KEY"]
-cx = os.environ["GOOGLE_SEARCH_CX"]
+# each engine has its own timeout, the tool returns whatever arrived within the latency budget; a longer timeout would
+# never take effect, so it is at most the budget
+latency_budget = float(os.environ.get("SEARCH_LATENCY_BUDGET", 10))
+engine_timeout = min(float(os.environ.get("SEARCH_ENGINE_TIMEOUT", latency_budget)), latency_budget)
 
-# bing
-subscription_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
-endpoint = os.environ["BING_SEARCH_V7_ENDPOINT"] + "/v7.0/search"
 
+class SearchEngine(ABC):
+    """A search backend, its results are returned under "<name>_results"."""
 
-@tool_call("Search on Google and Bing and get the search results. Use concise keywords as query.", cache=True)
-async def search(query: Annotated[str, "The search query, English only."]) -> str:
-    query = query.strip()
-    if not query:
-        return {"error": "query is empty"}
+    name: str
+
+    @abstractmethod
+    async def search(self, query: str) -> List[Dict]:
+        """Results with a title, link and snippet each."""
+
+
+class GoogleSearch(SearchEngine):
+    name = "google"
     api_url = "https://www.googleapis.com/customsearch/v1"
-    params = {
-        "key": key,
-        "cx": cx,
-        "q": query,
-    }
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
-        async with session.get(api_url, params=params) as response:
+
+    def __init__(self, key, cx):
+        self.key = key
+        self.cx = cx
+
+    async def search(self, query):
+        params = {
+            "key": self.key,
+            "cx": self.cx,
+            "q": query,
+        }
+        async with http_clients.aiohttp.get(
+            self.api_url, params=params, timeout=aiohttp.ClientTimeout(total=engine_timeout)
+        ) as response:
             response.raise_for_status()
             results = await response.json()
-            # print(json.dumps(results, ensure_ascii=False, indent=2))
-            google_results = []
-            if "items" in results:
-                for item in results["items"]:
-                    obj = {}
-                    if "title" in item:
-                        obj["title"] = item["title"]
-                    if "link" in item:
-                        obj["link"] = item["link"]
-                    if "snippet" in item:
-                        obj["snippet"] = item["snippet"]
-                    if len(obj):
-                        google_results.append(obj)
-
-    params = {"q": query}
-    headers = {"Ocp-Apim-Subscription-Key": subscription_key}
-
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
-        async with session.get(endpoint, headers=headers, params=params) as response:
+        # print(json.dumps(results, ensure_ascii=False, indent=2))
+        google_results = []
+        if "items" in results:
+            for item in results["items"]:
+                obj = {}
+                if "title" in item:
+                    obj["title"] = item["title"]
+                if "link" in item:
+                    obj["link"] = item["link"]
+                if "snippet" in item:
+                    obj["snippet"] = item["snippet"]
+                if len(obj):
+                    google_results.append(obj)
+        return google_results
+
+
+class BingSearch(SearchEngine):
+    name = "bing"
+
+    def __init__(self, subscription_key, endpoint):
+        self.subscription_key = subscription_key
+        self.endpoint = endpoint + "/v7.0/search"
+
+    async def search(self, query):
+        params = {"q": query}
+        headers = {"Ocp-Apim-Subscription-Key": self.subscription_key}
+        async with http_clients.aiohttp.get(
+            self.endpoint, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=engine_timeout)
+        ) as response:
             response.raise_for_status()
             results = await response.json()
-            # print(json.dumps(results, ensure_ascii=False, indent=2))
-            bing_results = []
-            if "webPages" in results and "value" in results["webPages"]:
-                for item in results["webPages"]["value"]:
-                    obj = {}
-                    if "name" in item:
-                        obj["title"] = item["name"]
-                    if "url" in item:
-                        obj["link"] = item["url"]
-                    if "snippet" in item:
-                        obj["snippet"] = item["snippet"]
-                    if len(obj):
-                        bing_results.append(obj)
-
-    return json.dumps({"google_results": google_results, "bing_results": bing_results}, ensure_ascii=False)
+        # print(json.dumps(results, ensure_ascii=False, indent=2))
+        bing_results = []
+        if "webPages" in results and "value" in results["webPages"]:
+            for item in results["webPages"]["value"]:
+                obj = {}
+                if "name" in item:
+                    obj["title"] = item["name"]
+                if "url" in item:
+                    obj["link"] = item["url"]
+                if "snippet" in item:
+                    obj["snippet"] = item["snippet"]
+                if len(obj):
+                    bing_results.append(obj)
+        return bing_results
+
+
+def configured_engines() -> List[SearchEngine]:
+    """The engines whose keys are set, an engine without them is left out."""
+    engines = []
+    if os.environ.get("GOOGLE_SEARCH_KEY") and os.environ.get("GOOGLE_SEARCH_CX"):
+        engines.append(GoogleSearch(os.environ["GOOGLE_SEARCH_KEY"], os.environ["GOOGLE_SEARCH_CX"]))
+    if os.environ.get("BING_SEARCH_V7_SUBSCRIPTION_KEY") and os.environ.get("BING_SEARCH_V7_ENDPOINT"):
+        engines.append(BingSearch(os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"], os.environ["BING_SEARCH_V7_ENDPOINT"]))
+    return engines
+
+
+engines: List[SearchEngine] = configured_engines()
+
+
+async def search_all(query: str, engines: List[SearchEngine], budget: float) -> Dict:
+    """Queries all engines concurrently. Engines failing or not answering within `budget` get an "<name>_error"."""
+    if not engines:  # asyncio.wait rejects an empty set
+        return {}
+    tasks = {engine.name: asyncio.create_task(engine.search(query)) for engine in engines}
+    await asyncio.wait(tasks.values(), timeout=budget)
+    result = {}
+    for name, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            result[f"{name}_error"] = "timeout"
+        elif task.exception() is not None:
+            logging.error("Search engine %s failed: %r", name, task.exception())
+            result[f"{name}_error"] = repr(task.exception())
+        else:
+            result[f"{name}_results"] = task.result()
+    if all(f"{engine.name}_error" in result for engine in engines):
+        raise RuntimeError(f"All search engines failed: {result}")  # do not cache the failure
+    return result
+
+
+@tool_call(
+    "Search on Google and Bing and get the search results. Use concise keywords as query.", cache=True, ttl=60 * 60
+)
+async def search(query: Annotated[str, "The search query, English only."]) -> str:
+    query = query.strip()
+    if not query:
+        return {"error": "query is empty"}
+    return json.dumps(await search_all(query, engines, latency_budget), ensure_ascii=False)
 
 
 async def main():
@@ -79,7 +146,8 @@ async def main():
     keyword = "ChatGPT"
     if len(sys.argv) > 1:
         keyword = sys.argv[1]
-    print(await search(keyword))
+    async with http_clients:
+        print(await search(keyword))
 
 
 if __name__ == "__main__":
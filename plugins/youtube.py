@@ -2,24 +2,115 @@ import asyncio
 import json
 import logging
 import os
+import re
 import tempfile
-from typing import Annotated, Callable
-
-import yt_dlp
-
-from plugin import tool_call
-from transcribe import transcribe
-
-max_result_length = 6291556
-
+from typing import Annotated, Dict, List, Optional, Tuple
+
+import httpx
+
+from http_clients import http_clients
+from job_executor import JobExecutor
+from plugin import tool_cache, tool_call
+from plugins import ytdlp_jobs
+from tool_cache import cache_key_hash
+from transcribe import ffmpeg, transcribe_file
+from truncation import max_result_length, truncate_result
+
+# yt-dlp jobs run in their own bounded pool, away from the event loop and the default executor
+executor = JobExecutor(
+    "youtube",
+    max_workers=int(os.environ.get("YOUTUBE_WORKERS", 2)),
+    max_queue=int(os.environ.get("YOUTUBE_QUEUE_DEPTH", 8)),
+    timeout=float(os.environ.get("YOUTUBE_JOB_TIMEOUT", 300)),
+    mode=os.environ.get("YOUTUBE_EXECUTOR", "process"),
+    preload=["plugins.ytdlp_jobs"],
+)
+# audio of up to 500 MB is downloaded for transcription, which takes longer than other jobs
+download_timeout = float(os.environ.get("YOUTUBE_DOWNLOAD_TIMEOUT", 1800))
+# the subtitle URLs in an extracted info are signed and expire after a few hours
+info_ttl = float(os.environ.get("YOUTUBE_INFO_TTL", 3600))
+
+VIDEO_ID = re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)([\w-]{11})")
+EVENTS = re.compile(r'"events"\s*:\s*\[')
+
+
+def video_id(url: str) -> Optional[str]:
+    match = VIDEO_ID.search(url)
+    return match[1] if match else None
+
+
+async def get_info(url: str, fresh: bool = False) -> Tuple[Dict, bool]:
+    """
+    The info of the video, extracted by yt-dlp or cached by video ID, so that other URLs of a video, e.g. with a start
+    time, skip the extraction. Returns the info and whether it was cached.
+    """
+    key = cache_key_hash({"func_name": "youtube_info", "video_id": video_id(url)}) if video_id(url) else None
+    if key is not None and not fresh:
+        cached = await tool_cache.get(key)
+        if cached is not None:
+            return json.loads(cached), True
+    info = await executor.run(ytdlp_jobs.extract_info, url)
+    if key is not None:
+        await tool_cache.set(key, "youtube_info", json.dumps(info, ensure_ascii=False), info_ttl)
+    return info, False
+
+
+class Json3Lines:
+    """
+    Incremental parser of a json3 subtitle: fed with the text as it is received, it decodes the events one by one
+    and keeps only their lines, never the whole document.
+    """
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._in_events = False
+        self._done = False
+
+    def feed(self, chunk: str):
+        if self._done:
+            return
+        self._buffer += chunk
+        pos = 0
+        if not self._in_events:
+            match = EVENTS.search(self._buffer)
+            if match is None:
+                return
+            self._in_events = True
+            pos = match.end()
+        while True:
+            while pos < len(self._buffer) and self._buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(self._buffer):
+                break
+            if self._buffer[pos] == "]":
+                self._done = True
+                break
+            try:
+                event, pos_end = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:  # the event is not complete yet
+                break
+            pos = pos_end
+            line = "".join(seg.get("utf8", "") for seg in event.get("segs", [])).strip()
+            if line:
+                self.lines.append(line)
+        self._buffer = self._buffer[pos:]
 
-async def run_sync_in_executor(func: Callable, *args, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    def close(self) -> List[str]:
+        if not self._done:
+            raise ValueError("Incomplete json3 subtitle")
+        return self.lines
 
 
-def result_length(r):
-    return len(json.dumps(r, ensure_ascii=False).encode())
+async def fetch_subtitle(track: Dict) -> str:
+    """Downloads a json3 subtitle track with the pooled HTTP client, parsing it while it is received."""
+    parser = Json3Lines()
+    async with http_clients.httpx.stream("GET", track["url"], headers=track.get("http_headers")) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            parser.feed(chunk)
+    return "\n".join(parser.close())
 
 
 def find_audio_files(path, extensions):
@@ -27,10 +118,16 @@ def find_audio_files(path, extensions):
 
 
 def find_audio_format_id(info):
+    if ffmpeg:  # long audio is split into segments below Whisper's 25 MB upload limit
+        return "bestaudio[filesize<500M]/bestaudio"
     return "bestaudio[filesize<20M]"
 
 
-@tool_call("Fetches the title, associated channel, description, and subtitles of a YouTube video.", cache=True)
+@tool_call(
+    "Fetches the title, associated channel, description, and subtitles of a YouTube video.",
+    cache=True,
+    ttl=30 * 24 * 60 * 60,
+)
 async def youtube(url: Annotated[str, "URL of the YouTube video."]) -> str:
     logging.debug("youtube: %s", url)
 
@@ -40,8 +137,7 @@ async def youtube(url: Annotated[str, "URL of the YouTube video."]) -> str:
     sub_preferences_zh = ["zh-CN", "zh-Hans", "zh", "zh-Hant", "zh-TW", "zh-HK", "zh-SG"]
     autosub_preferences = ["en"]
 
-    with yt_dlp.YoutubeDL() as ydl:
-        info = await run_sync_in_executor(ydl.extract_info, url, download=False, process=False)
+    info, cached = await get_info(url)
 
     if "title" in info:
         data["title"] = info["title"]
@@ -71,60 +167,48 @@ async def youtube(url: Annotated[str, "URL of the YouTube video."]) -> str:
     subtitle = None
     for lang in sub_preferences:
         if lang in info["subtitles"]:
-            subtitle = "sub", lang
+            subtitle = "subtitles", lang
             break
     if subtitle is None:
         for lang in info["subtitles"]:
             if lang != "live_chat":
-                subtitle = "sub", lang
+                subtitle = "subtitles", lang
                 break
     if subtitle is None:
         for lang in autosub_preferences:
             if lang in info["automatic_captions"]:
-                subtitle = "autosub", lang
+                subtitle = "automatic_captions", lang
                 break
 
     if subtitle is None:  # download audio and transcribe
         with tempfile.TemporaryDirectory() as tmpdir:
             audio_options = {"format": find_audio_format_id(info), "outtmpl": f"{tmpdir}/audio.%(ext)s"}
-            with yt_dlp.YoutubeDL(audio_options) as ydl:
-                await run_sync_in_executor(ydl.download, [url])
+            await executor.run(ytdlp_jobs.download, url, audio_options, timeout=download_timeout)
             audio_file = find_audio_files(tmpdir, [".webm", ".m4a", ".mp4"])[0]
             audio_path = f"{tmpdir}/{audio_file}"
             try:
-                with open(audio_path, "rb") as audio_file:
-                    transcript_response = await transcribe(audio_file)
-                transcript = transcript_response.text
+                transcript_response = await transcribe_file(audio_path)
+                if len(transcript_response.parts) > 1:
+                    transcript = transcript_response.timestamped_text()
+                else:
+                    transcript = transcript_response.text
                 logging.debug("transcript success")
             except Exception as e:
                 logging.error(f"Error in transcribing audio: {e}")
                 raise ValueError("Audio transcription failed")
-    else:  # download subtitle
-        with tempfile.TemporaryDirectory() as tmpdir:
-            options = {
-                "outtmpl": f"{tmpdir}/output.%(ext)s",
-                "skip_download": True,
-                "subtitleslangs": [subtitle[1]],
-                "subtitlesformat": "json3",
-            }
-            if subtitle[0] == "sub":
-                options["writesubtitles"] = True
-            elif subtitle[0] == "autosub":
-                options["writeautomaticsub"] = True
-
-            with yt_dlp.YoutubeDL(options) as ydl:
-                await run_sync_in_executor(ydl.download, [url])
-
-            with open(f"{tmpdir}/output.{subtitle[1]}.json3") as f:
-                json3 = json.load(f)
-                subtitle_lines = []
-                for event in json3["events"]:
-                    if "segs" in event:
-                        line = "".join([seg["utf8"] for seg in event["segs"]]).strip()
-                        if line:
-                            subtitle_lines.append(line)
-        transcript = "\n".join(subtitle_lines)
-        logging.debug("subtitle: %s, %s", subtitle[0], subtitle[1])
+    else:  # fetch the subtitle track found in the info
+        kind, lang = subtitle
+        try:
+            transcript = await fetch_subtitle(info[kind][lang])
+        except httpx.HTTPStatusError as e:
+            if not cached:
+                raise
+            logging.info("Subtitle URL of the cached info failed, extracting again: %s", e)
+            info, _ = await get_info(url, fresh=True)
+            if lang not in info[kind]:
+                raise ValueError(f"Subtitle {lang} is no longer available")
+            transcript = await fetch_subtitle(info[kind][lang])
+        logging.debug("subtitle: %s, %s", kind, lang)
 
     result = {
         "data": data,
@@ -139,24 +223,13 @@ async def youtube(url: Annotated[str, "URL of the YouTube video."]) -> str:
         ],
     }
     result["data"]["transcript"] = transcript
-    if result_length(result) > max_result_length:
-        result["truncated"] = True
-        result["data"]["transcript"] = ""
-        left = 0
-        right = len(transcript)
-        while left + 1 < right:
-            mid = (left + right) // 2
-            result["data"]["transcript"] = transcript[:mid]
-            if result_length(result["data"]) > max_result_length:
-                right = mid
-            else:
-                left = mid
-        result["data"]["transcript"] = transcript[:left]
+    result["truncated"] = truncate_result(result["data"], max_result_length, ["transcript"])
     return json.dumps(result["data"], ensure_ascii=False)
 
 
 async def test_youtube():
     from database import db
+    from metrics import job_seconds
 
     db.generate_mapping(create_tables=True, check_tables=True)
 
@@ -168,6 +241,7 @@ async def test_youtube():
     _timer_task = asyncio.create_task(async_timer(100000))
     url = "https://www.youtube.com/watch?v=5cqaHCQ4pi4"
     print(await youtube(url))
+    print(job_seconds.render())
 
 
 if __name__ == "__main__":
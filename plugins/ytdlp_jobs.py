@@ -0,0 +1,38 @@
+# yt-dlp jobs run by the YouTube executor, possibly in a child process.
+# Jobs and their results must be picklable, so only module level functions returning plain data.
+
+from typing import Dict, List
+
+import yt_dlp
+
+INFO_FIELDS = ["id", "title", "channel", "uploader", "description"]
+SUBTITLE_FORMAT = "json3"
+
+
+def _subtitle_tracks(tracks: Dict[str, List[Dict]]) -> Dict[str, Dict]:
+    """The json3 format of each subtitle language, with what is needed to fetch it."""
+    result = {}
+    for lang, formats in (tracks or {}).items():
+        for f in formats:
+            if f.get("ext") == SUBTITLE_FORMAT and f.get("url"):
+                result[lang] = {"url": f["url"], "http_headers": f.get("http_headers") or {}}
+                break
+    return result
+
+
+def extract_info(url: str) -> Dict:
+    """
+    The fields of the video used by the YouTube plugin. Of the subtitles and automatic captions only the json3 tracks
+    are kept, they are fetched from their URL without another extraction.
+    """
+    with yt_dlp.YoutubeDL() as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False, process=False))
+    result = {field: info[field] for field in INFO_FIELDS if field in info}
+    result["subtitles"] = _subtitle_tracks(info.get("subtitles"))
+    result["automatic_captions"] = _subtitle_tracks(info.get("automatic_captions"))
+    return result
+
+
+def download(url: str, options: Dict):
+    with yt_dlp.YoutubeDL(options) as ydl:
+        ydl.download([url])
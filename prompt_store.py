@@ -0,0 +1,117 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, Iterable, List
+
+from pony.orm import *
+
+from blob_store import pack_prompts, release_prompts, unpack_prompts
+from database import SQLITE_MAX_VARIABLES, db, run_in_db_thread
+
+
+class SlackExtraPrompt(db.Entity):
+    """Prompts which are not visible in the Slack thread, e.g. tool calls and audio transcripts"""
+
+    _table_ = "SlackToolCallPrompt"  # historical reasons
+    ts = PrimaryKey(str)
+    channel = Required(str)
+    thread_ts = Optional(str)
+    prompts = Required(Json)  # large contents are stored in blobs, see blob_store
+    composite_index(channel, thread_ts)
+
+
+@db_session
+def _get_extra_prompts(msg_ts):
+    prompt = SlackExtraPrompt.get(ts=msg_ts)
+    return unpack_prompts({msg_ts: prompt.prompts})[msg_ts] if prompt else []
+
+
+@db_session
+def _get_thread_extra_prompts(channel, thread_ts) -> Dict[str, List]:
+    query = SlackExtraPrompt.select(lambda p: p.channel == channel and p.thread_ts == thread_ts)
+    return unpack_prompts({p.ts: p.prompts for p in query})
+
+
+@db_session
+def _get_extra_prompts_by_ts(msg_ts_list: Iterable[str]) -> Dict[str, List]:
+    msg_ts_list = list(msg_ts_list)
+    result = {}
+    for i in range(0, len(msg_ts_list), SQLITE_MAX_VARIABLES):
+        batch = msg_ts_list[i : i + SQLITE_MAX_VARIABLES]
+        result.update({p.ts: p.prompts for p in SlackExtraPrompt.select(lambda p: p.ts in batch)})
+    return unpack_prompts(result)
+
+
+@db_session
+def _add_extra_prompts(channel, msg_ts, prompts, thread_ts=None):
+    prompts = pack_prompts(prompts)
+    if SlackExtraPrompt.exists(ts=msg_ts):
+        prompt = SlackExtraPrompt.get(ts=msg_ts)
+        prompt.prompts += prompts
+    else:
+        SlackExtraPrompt(ts=msg_ts, channel=channel, thread_ts=thread_ts, prompts=prompts)
+
+
+@db_session
+def _delete_extra_prompts_by_ts(msg_ts_list: Iterable[str]) -> int:
+    msg_ts_list = list(msg_ts_list)
+    deleted = 0
+    for i in range(0, len(msg_ts_list), SQLITE_MAX_VARIABLES):
+        batch = msg_ts_list[i : i + SQLITE_MAX_VARIABLES]
+        for prompt in SlackExtraPrompt.select(lambda p: p.ts in batch):
+            release_prompts(prompt.prompts)
+            prompt.delete()
+            deleted += 1
+    return deleted
+
+
+async def get_extra_prompts(msg_ts) -> List:
+    return await run_in_db_thread(_get_extra_prompts, msg_ts)
+
+
+async def get_thread_extra_prompts(channel, thread_ts) -> Dict[str, List]:
+    """Loads the extra prompts of all messages in a thread with a single query, keyed by message ts."""
+    return await run_in_db_thread(_get_thread_extra_prompts, channel, thread_ts)
+
+
+async def get_extra_prompts_by_ts(msg_ts_list: Iterable[str]) -> Dict[str, List]:
+    """Loads the extra prompts of the given messages, keyed by message ts."""
+    return await run_in_db_thread(_get_extra_prompts_by_ts, list(msg_ts_list))
+
+
+async def add_extra_prompts(channel, msg_ts, prompts, thread_ts=None):
+    await run_in_db_thread(_add_extra_prompts, channel, msg_ts, prompts, thread_ts)
+
+
+async def delete_extra_prompts_by_ts(msg_ts_list: Iterable[str]) -> int:
+    """Deletes the extra prompts of the given messages in one transaction, returns how many were deleted."""
+    return await run_in_db_thread(_delete_extra_prompts_by_ts, list(msg_ts_list))
+
+
+async def main():
+    db.generate_mapping(create_tables=True, check_tables=True)
+    channel = f"BENCH-{uuid.uuid4().hex[:8]}"
+    thread_ts = "1700000000.000000"
+    msg_ts_list = [f"{1700000000 + i}.000000" for i in range(500)]
+    for ts in msg_ts_list[::2]:  # every assistant reply made a tool call
+        await add_extra_prompts(channel, ts, [{"role": "tool", "content": "x" * 1000}], thread_ts)
+
+    try:
+        t0 = time.perf_counter()
+        one_by_one = {ts: await get_extra_prompts(ts) for ts in msg_ts_list}
+        t1 = time.perf_counter()
+        by_thread = await get_thread_extra_prompts(channel, thread_ts)
+        t2 = time.perf_counter()
+        by_ts = await get_extra_prompts_by_ts(msg_ts_list)
+        t3 = time.perf_counter()
+        assert {ts: p for ts, p in one_by_one.items() if p} == by_thread == by_ts
+        print(f"500-message thread, one query per message: {(t1 - t0) * 1000:.1f}ms")
+        print(f"500-message thread, one query per thread:  {(t2 - t1) * 1000:.1f}ms")
+        print(f"500-message thread, one query per ts list: {(t3 - t2) * 1000:.1f}ms")
+    finally:
+        with db_session:
+            SlackExtraPrompt.select(lambda p: p.channel == channel).delete(bulk=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
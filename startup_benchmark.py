@@ -0,0 +1,92 @@
+"""
+Startup time of the bot: how long `python app.py` takes until it could connect to Slack, measured in fresh
+interpreters. The schema cache of the plugins is used when warm, and rebuilt by importing all plugins when cold.
+Example:
+
+    python startup_benchmark.py --runs 5
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SETUP = "import asyncio, app; asyncio.run(app.setup())"
+
+
+def bench_env(schema_cache: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    for name, value in {
+        "SLACK_BOT_TOKEN": "xoxb-benchmark",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="startup"), "db.sqlite"),
+        "LOG_LEVEL": "WARNING",
+        # all plugins are enabled, none of these is called
+        "BROWSER_TEXT_API_URL": "http://127.0.0.1:9",
+        "GITHUB_API_URL": "http://127.0.0.1:9",
+        "PDF_API_URL": "http://127.0.0.1:9",
+        "GOOGLE_SEARCH_KEY": "benchmark",
+        "GOOGLE_SEARCH_CX": "benchmark",
+    }.items():
+        env.setdefault(name, value)
+    env["PLUGIN_SCHEMA_CACHE"] = schema_cache
+    return env
+
+
+def run(code: str, env: Dict[str, str], *options: str) -> Tuple[float, str]:
+    t0 = time.perf_counter()
+    result = subprocess.run([sys.executable, *options, "-c", code], env=env, cwd=ROOT, capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return elapsed, result.stderr
+
+
+def slowest_imports(env: Dict[str, str], count: int) -> List[Tuple[int, str]]:
+    """Top level modules of the bot's dependencies by cumulative import time, in microseconds."""
+    _, stderr = run(SETUP, env, "-X", "importtime")
+    modules = {}
+    for match in re.finditer(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", stderr):
+        cumulative, depth, name = int(match[1]), len(match[2]), match[3]
+        if depth <= 3:  # the bot's modules and their direct imports
+            modules[name] = max(modules.get(name, 0), cumulative)
+    return sorted(((us, name) for name, us in modules.items()), reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="interpreters started per measurement")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        schema_cache = os.path.join(tmp, "plugin_schemas.json")
+        env = bench_env(schema_cache)
+        run("import plugin_registry; plugin_registry.main()", env)  # warm the cache, and the OS file cache
+
+        def measure(name: str, code: str, cold: bool = False):
+            times = []
+            for _ in range(args.runs):
+                if cold and os.path.exists(schema_cache):
+                    os.remove(schema_cache)
+                times.append(run(code, env)[0])
+            print(f"{name}: median {statistics.median(times):.3f}s, min {min(times):.3f}s")
+
+        measure("python startup", "pass")
+        measure("import app", "import app")
+        measure("import app + setup, warm schema cache", SETUP)
+        measure("import app + setup, cold schema cache", SETUP, cold=True)
+        run("import plugin_registry; plugin_registry.main()", env)
+        print("slowest imports of app + setup (cumulative):")
+        for us, name in slowest_imports(env, args.top):
+            print(f"  {us / 1000:8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
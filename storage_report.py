@@ -0,0 +1,100 @@
+"""
+Reports the storage saved by moving tool outputs into blobs, see blob_store. The database is left unchanged, a copy
+of it is migrated and measured. Example:
+
+    python storage_report.py db.sqlite
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+
+def storage_report() -> Dict[str, int]:
+    """Bytes stored in the tables holding tool outputs, and bytes of the contents referenced from blobs."""
+    from pony.orm import db_session
+
+    from database import db
+
+    with db_session:
+        blobs = db.select(
+            "SELECT count(*), coalesce(sum(length(data)), 0), coalesce(sum(size), 0), coalesce(sum(size * refs), 0) "
+            "FROM Blob"
+        )[0]
+        prompts = db.select('SELECT coalesce(sum(length(CAST(prompts AS BLOB))), 0) FROM "SlackToolCallPrompt"')[0]
+        cache = db.select("SELECT coalesce(sum(length(CAST(value AS BLOB))), 0) FROM ToolResultCache")[0]
+    return {
+        "blobs": blobs[0],
+        "blob_bytes": blobs[1],
+        "blob_content_bytes": blobs[2],
+        "referenced_content_bytes": blobs[3],
+        "prompt_bytes": prompts,
+        "tool_result_bytes": cache,
+    }
+
+
+def vacuumed_size(path: str) -> int:
+    """The size of the database file without free pages."""
+    with sqlite3.connect(path) as connection:
+        connection.execute("VACUUM")
+    return os.path.getsize(path)
+
+
+def measure():
+    """Migrates the database at DB_PATH and prints the savings."""
+    import prompt_store  # noqa: F401, the entities must be defined before the mapping
+    import tool_cache  # noqa: F401
+    from blob_store import migrate_to_blobs
+    from database import db, db_path
+
+    size_before = vacuumed_size(db_path)
+    db.generate_mapping(create_tables=True, check_tables=True)
+    before = storage_report()
+    t0 = time.perf_counter()
+    moved = migrate_to_blobs()
+    elapsed = time.perf_counter() - t0
+    after = storage_report()
+    db.disconnect()
+    size_after = vacuumed_size(db_path)
+
+    print(f"migrated in {elapsed:.2f}s: {moved}")
+    print(f"extra prompts: {before['prompt_bytes']:,} -> {after['prompt_bytes']:,} bytes")
+    print(f"tool results:  {before['tool_result_bytes']:,} -> {after['tool_result_bytes']:,} bytes")
+    print(
+        f"blobs: {after['blobs']:,}, {after['blob_bytes']:,} bytes compressed, {after['blob_content_bytes']:,} bytes "
+        f"of content, {after['referenced_content_bytes']:,} bytes referenced"
+    )
+    print(f"database file: {size_before:,} -> {size_after:,} bytes ({size_after / max(size_before, 1):.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", nargs="?", default=os.environ.get("DB_PATH", "db.sqlite"))
+    parser.add_argument("--in-place", action="store_true", help="migrate the database itself, which must be DB_PATH")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.in_place:
+        if os.path.abspath(args.db) != os.path.abspath(os.environ.get("DB_PATH", "db.sqlite")):
+            parser.error("--in-place migrates DB_PATH")
+        measure()
+        return
+    workdir = tempfile.mkdtemp(prefix="blobs")
+    try:
+        copy = os.path.join(workdir, "db.sqlite")
+        with sqlite3.connect(args.db) as source, sqlite3.connect(copy) as target:
+            source.backup(target)  # including what is still in the WAL
+        env = dict(os.environ, DB_PATH=copy)  # database.py binds DB_PATH on import
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--in-place", copy], env=env, check=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# database.py binds DB_PATH on import, the tests never touch the bot's database
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tests"), "db.sqlite")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def database():
+    """The tables of all entities in the temporary database, mapped once for all tests."""
+    import conversation_export  # noqa: F401, the entities must be defined before the mapping
+    import prompt_store  # noqa: F401
+    import tool_cache  # noqa: F401
+    from database import db
+
+    db.generate_mapping(create_tables=True, check_tables=True)
+    return db
@@ -0,0 +1,57 @@
+import threading
+
+from pony.orm import db_session
+
+from blob_store import Blob, put_blob, read_blobs, release_blob
+
+
+def refs(key):
+    with db_session:
+        blob = Blob.get(hash=key)
+        return blob.refs if blob else 0
+
+
+def test_references_are_counted(database):
+    text = "A long transcript. " * 500
+    with db_session:
+        key = put_blob(text)
+        assert put_blob(text) == key
+    assert refs(key) == 2
+    with db_session:
+        assert read_blobs([key, "0" * 64]) == {key: text}
+        release_blob(key)
+    assert refs(key) == 1
+    with db_session:
+        release_blob(key)
+        release_blob(key)  # missing, only logged
+    assert refs(key) == 0
+
+
+def test_concurrent_references_are_not_lost(database):
+    text = "Stored by many threads. " * 500
+    errors = []
+
+    @db_session
+    def put():
+        put_blob(text)
+
+    def store(count):
+        try:
+            for _ in range(count):
+                put()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(50,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    with db_session:
+        key = put_blob(text)
+    assert refs(key) == 8 * 50 + 1
+    for _ in range(8 * 50 + 1):
+        with db_session:
+            release_blob(key)
+    assert refs(key) == 0
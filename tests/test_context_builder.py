@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+from context_builder import ContextBuilder, max_tool_result_tokens, prompt_text
+
+
+def builder(budget: int) -> ContextBuilder:
+    builder = ContextBuilder("gpt-4o", budget=budget)
+    builder._encoding = False  # estimated counts, no BPE file is downloaded
+    return builder
+
+
+def test_count_is_cached_per_message_text():
+    b = builder(1000)
+    assert b.count("1.0", 0, {"role": "user", "content": "a" * 40}) == 11 + 4
+    # an edit keeping the length is counted again
+    assert b.count("1.0", 0, {"role": "user", "content": "é" * 40}) == 21 + 4
+
+
+def test_truncate_keeps_the_prefix_within_the_limit():
+    b = builder(1000)
+    prompt = {"role": "tool", "tool_call_id": "call_1", "content": "x" * 4000}
+    truncated = b.truncate(prompt, 100)
+    assert truncated["tool_call_id"] == "call_1"
+    assert truncated["content"].startswith("x" * 400)
+    assert truncated["content"].endswith("(truncated to fit the context window)")
+    assert b.count_text(truncated["content"]) <= 100 + 20
+    assert prompt["content"] == "x" * 4000  # not modified
+
+
+def test_build_keeps_everything_within_budget():
+    b = builder(1000)
+    system = [{"role": "system", "content": "You are a helpful assistant."}]
+    turns = [("1.0", [{"role": "user", "content": "hi"}]), ("2.0", [{"role": "assistant", "content": "hello"}])]
+    assert b.build(system, turns) == system + [p for _, prompts in turns for p in prompts]
+
+
+def test_build_drops_the_oldest_turns_but_keeps_the_latest():
+    b = builder(100)
+    system = [{"role": "system", "content": "system"}]
+    turns = [(f"{i}.0", [{"role": "user", "content": "w" * 120}]) for i in range(10)]  # 31 tokens each
+    prompts = b.build(system, turns)
+    assert prompts[0] == system[0]
+    assert prompts[1:] == [turns[-2][1][0], turns[-1][1][0]]
+    # a single turn over budget is still sent
+    assert b.build(system, [("1.0", [{"role": "user", "content": "w" * 4000}])])[-1]["content"] == "w" * 4000
+
+
+def test_build_cuts_large_tool_results_before_dropping_turns():
+    b = builder(max_tool_result_tokens + 500)
+    system = [{"role": "system", "content": "system"}]
+    call = {"role": "assistant", "tool_calls": [{"id": "call_1", "type": "function"}]}
+    result = {"role": "tool", "tool_call_id": "call_1", "content": "r" * (max_tool_result_tokens * 8)}
+    turns = [("1.0", [{"role": "user", "content": "question"}]), ("2.0", [call, result]), ("3.0", [])]
+    prompts = b.build(system, turns)
+    assert [p.get("role") for p in prompts] == ["system", "user", "assistant", "tool"]
+    assert b.count_text(prompt_text(prompts[-1])) <= max_tool_result_tokens + 20
+    assert result["content"] == "r" * (max_tool_result_tokens * 8)  # the caller's prompts are not modified
+
+
+def test_build_async_counts_in_another_thread(monkeypatch):
+    b = builder(100)
+    threads = []
+    count_text = b.count_text
+    monkeypatch.setattr(b, "count_text", lambda text: threads.append(threading.current_thread()) or count_text(text))
+    system = [{"role": "system", "content": "system"}]
+    turns = ((f"{i}.0", [{"role": "user", "content": "w" * 120}]) for i in range(10))  # a generator, like in app.py
+
+    async def run():
+        await b.load()
+        return await b.build_async(system, turns)
+
+    assert [p["content"] for p in asyncio.run(run())] == ["system", "w" * 120, "w" * 120]
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,30 @@
+import asyncio
+
+from conversation_cache import ConversationCache
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+        self.replies = ["1.1"]
+
+    async def conversations_replies(self, channel, ts, cursor=None):
+        self.calls += 1
+        messages = [{"ts": ts, "text": "question", "user": "U1"}]
+        messages += [{"ts": reply, "thread_ts": ts, "text": "answer", "bot_id": "B1"} for reply in self.replies]
+        return {"messages": messages, "has_more": False}
+
+
+def test_a_reconnect_drops_the_cached_threads():
+    async def run():
+        client = FakeClient()
+        cache = ConversationCache()
+        assert len(await cache.get(client, "C1", "1.0")) == 2
+        assert len(await cache.get(client, "C1", "1.0")) == 2 and client.calls == 1
+        client.replies.append("1.2")  # its event was missed while the connection was down
+        cache.clear()
+        assert cache.size == 0
+        assert [m["ts"] for m in await cache.get(client, "C1", "1.0")] == ["1.0", "1.1", "1.2"]
+        assert client.calls == 2
+
+    asyncio.run(run())
@@ -0,0 +1,39 @@
+import asyncio
+import json
+import re
+
+from pony.orm import db_session
+
+from plugins.documents import rank_tool_output, read_document
+from tool_cache import DocumentCache, ToolResultCache, delete_results
+
+paragraphs = [f"Paragraph {i} is about topic {i % 50}. " * 20 for i in range(2000)]
+paragraphs[1234] = "The answer to the question about the flux capacitor is 1.21 gigawatts."
+page = json.dumps({"title": "A long page", "text": "\n".join(paragraphs)}, ensure_ascii=False)
+history = [{"role": "user", "content": "<@U123> How much power does the flux capacitor need?"}]
+
+
+def test_long_results_are_ranked_and_kept_for_read_document(database):
+    async def run():
+        shortened = await rank_tool_output("browser_text", page, history)
+        assert "1.21 gigawatts" in shortened and len(shortened) < len(page) // 10
+        document_id = re.search(r'document_id "(\w+)"', shortened)[1]
+        assert "topic 7." in await read_document(document_id, query="topic 7")
+        assert (await read_document(document_id, passage=3)).startswith("[... passages 1-2 of")
+        assert "not found" in await read_document("0" * 16)
+
+    try:
+        asyncio.run(run())
+        with db_session:  # documents do not use up the budget of the tool results
+            assert DocumentCache.select().count() == 1
+            assert not ToolResultCache.select(lambda e: e.func_name == "read_document").exists()
+    finally:
+        delete_results("read_document", DocumentCache)
+
+
+def test_short_and_unranked_results_are_kept():
+    async def run():
+        assert await rank_tool_output("browser_text", "short", history) == "short"
+        assert await rank_tool_output("search", page, history) == page
+
+    asyncio.run(run())
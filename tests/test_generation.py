@@ -0,0 +1,62 @@
+import asyncio
+
+from openai_wrapper import drop_unanswered_tool_calls
+from update_scheduler import FakeRateLimitedClient, UpdateScheduler
+
+
+def call(*ids):
+    return {"role": "assistant", "tool_calls": [{"id": i, "type": "function"} for i in ids]}
+
+
+def result(i):
+    return {"role": "tool", "tool_call_id": i, "content": "result"}
+
+
+def test_unanswered_tool_calls_are_dropped():
+    answered = [call("a"), result("a"), {"role": "assistant", "content": "done"}]
+    assert drop_unanswered_tool_calls(answered) == answered
+    # a superseded round: the call of "c" has no result, its partial results go as well
+    assert drop_unanswered_tool_calls(answered + [call("b", "c"), result("b")]) == answered
+    assert drop_unanswered_tool_calls([call("d")]) == []
+
+
+def test_update_entries_are_dropped_when_a_reply_ends():
+    async def run():
+        client = FakeRateLimitedClient(limit=100)
+        scheduler = UpdateScheduler(rate=100, burst=100, min_interval=0, idle_ttl=0)
+        scheduler.update(client, "C1", "1", "partial")
+        await asyncio.sleep(0.05)
+        assert ("C1", "1") in scheduler._pending  # not final, kept for the next edit
+        scheduler.discard("C1", "1")
+        assert not scheduler._pending
+
+        scheduler.update(client, "C1", "2", "partial")  # a reply which is never finished
+        await asyncio.sleep(0.05)
+        scheduler._swept_at -= 60
+        scheduler.update(client, "C1", "3", "other")
+        assert ("C1", "2") not in scheduler._pending
+        assert client.messages["C1", "2"] == "partial"
+
+    asyncio.run(run())
+
+
+def test_a_streamed_text_is_built_only_when_sent():
+    async def run():
+        client = FakeRateLimitedClient(limit=100)
+        scheduler = UpdateScheduler(rate=100, burst=100, min_interval=0.2)
+        deltas = []
+        built = []
+
+        def text():
+            built.append(len(deltas))
+            return "".join(deltas)
+
+        for i in range(100):  # deltas arriving faster than the edits are sent
+            deltas.append(f"{i} ")
+            scheduler.update(client, "C1", "1", text)
+            await asyncio.sleep(0.005)
+        await scheduler.flush(client, "C1", "1")
+        assert client.messages["C1", "1"] == "".join(deltas)
+        assert 1 < len(built) < 10
+
+    asyncio.run(run())
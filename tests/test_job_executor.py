@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import pytest
+
+from job_executor import JobExecutor, JobTimeoutError
+from metrics import job_queue_seconds, job_seconds
+
+
+def test_process_jobs_are_killed_on_timeout():
+    executor = JobExecutor("killed", max_workers=1, max_queue=1, timeout=0.5)
+
+    async def run():
+        assert await executor.run(sum, [1, 2, 3]) == 6
+        t0 = time.perf_counter()
+        with pytest.raises(JobTimeoutError):
+            await executor.run(time.sleep, 30)
+        assert time.perf_counter() - t0 < 5
+        assert not executor.semaphore.locked()
+
+    asyncio.run(run())
+    executor.shutdown()
+    assert job_queue_seconds.count(executor="killed") == 2
+    assert job_seconds.count(executor="killed", outcome="ok") == 1
+    assert job_seconds.count(executor="killed", outcome="timeout") == 1
+
+
+def test_jobs_cancelled_while_waiting_never_start():
+    executor = JobExecutor("test", max_workers=1, max_queue=2, timeout=10)
+
+    async def run():
+        first = asyncio.create_task(executor.run(time.sleep, 0.5))
+        await asyncio.sleep(0.1)
+        waiting = asyncio.create_task(executor.run(time.sleep, 30))
+        await asyncio.sleep(0.1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await first
+        t0 = time.perf_counter()
+        assert await executor.run(sum, [1]) == 1  # the worker is free again
+        assert time.perf_counter() - t0 < 5
+
+    asyncio.run(run())
+    executor.shutdown()
+
+
+def test_abandoned_threads_keep_their_worker():
+    executor = JobExecutor("test", max_workers=1, max_queue=1, timeout=0.2, mode="thread")
+
+    async def run():
+        with pytest.raises(JobTimeoutError):
+            await executor.run(time.sleep, 0.6)
+        assert executor.semaphore.locked()  # the thread still runs
+        t0 = time.perf_counter()
+        assert await executor.run(sum, [1, 2]) == 3
+        assert time.perf_counter() - t0 >= 0.3
+
+    asyncio.run(run())
+    executor.shutdown()
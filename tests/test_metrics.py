@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from metrics import Counter, Histogram, Metric, tool_call_seconds
+
+
+def test_metric_without_samples_cannot_be_created():
+    class Untyped(Metric):
+        type = "untyped"
+
+    with pytest.raises(TypeError):
+        Untyped("untyped", "A metric without samples")
+
+
+def test_render():
+    counter = Counter("requests_total", "Requests", ["method"])
+    counter.inc(method="get")
+    counter.inc(2, method="get")
+    assert counter.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{method="get"} 3',
+    ]
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    histogram.observe(0.5)
+    assert histogram.samples() == [
+        'latency_seconds_bucket{le="0.1"} 0',
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="+Inf"} 1',
+        "latency_seconds_sum 0.5",
+        "latency_seconds_count 1",
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("calls_total", "Calls", ["function"])
+    counter.inc(function='say "hi"\\now\n')
+    assert counter.samples() == ['calls_total{function="say \\"hi\\"\\\\now\\n"} 1']
+
+
+def test_unknown_functions_share_one_label_value():
+    from openai_wrapper import OpenAIWrapper, ToolEnd
+
+    async def run():
+        calls = [{"id": "call_1", "function": {"name": 'made_up"\n', "arguments": "{}"}}]
+        events = [event async for event in OpenAIWrapper()._execute_function(calls, [], 1)]
+        assert [event.outcome for event in events if isinstance(event, ToolEnd)] == ["unknown"]
+
+    before = tool_call_seconds.count(function="unknown", outcome="unknown")
+    asyncio.run(run())
+    assert tool_call_seconds.count(function="unknown", outcome="unknown") == before + 1
+    assert not any("made_up" in key[0] for key in tool_call_seconds.counts)
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from typing import Annotated
+
+from plugin import tool_cache, tool_call
+from tool_cache import delete_results
+
+
+def test_concurrent_identical_calls_share_one_execution(database):
+    executions = []
+
+    @tool_call(description="A slow test function", cache=True)
+    async def slow_function(x: Annotated[int, "parameter x"]) -> str:
+        executions.append(x)
+        await asyncio.sleep(0.2)
+        return str(x)
+
+    async def run():
+        x = time.time_ns()  # not cached yet
+        calls = [slow_function(x) for _ in range(10)] + [slow_function(x + 1) for _ in range(10)]
+        results = await asyncio.gather(*calls)
+        assert results == [str(x)] * 10 + [str(x + 1)] * 10
+        assert sorted(executions) == [x, x + 1]
+        # later calls are answered from the cache
+        assert await slow_function(x) == str(x) and len(executions) == 2
+
+    asyncio.run(run())
+    delete_results("slow_function")
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_call(database):
+    @tool_call(description="Another slow test function", cache=True)
+    async def shared_function(x: Annotated[int, "parameter x"]) -> str:
+        await asyncio.sleep(0.2)
+        return str(x)
+
+    async def run():
+        x = time.time_ns()
+        first = asyncio.create_task(shared_function(x))
+        second = asyncio.create_task(shared_function(x))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        assert await second == str(x)
+
+    asyncio.run(run())
+    assert tool_cache.stats()["misses"] >= 1
+    delete_results("shared_function")
+
+
+def test_a_failed_cache_write_still_returns_the_result(database, monkeypatch):
+    @tool_call(description="A function whose result cannot be cached", cache=True)
+    async def uncached_function(x: Annotated[int, "parameter x"]) -> str:
+        return str(x)
+
+    async def failing_set(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(tool_cache, "set", failing_set)
+    x = time.time_ns()
+    assert asyncio.run(uncached_function(x)) == str(x)
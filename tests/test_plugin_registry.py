@@ -0,0 +1,24 @@
+import logging
+import os
+import threading
+
+from plugin_registry import load_schema_cache, save_schema_cache
+
+
+def test_concurrent_saves_of_the_schema_cache(tmp_path, caplog):
+    path = str(tmp_path / "plugin_schemas.json")
+    caches = [{f"plugin_{i}": {"source_hash": str(i), "schema": {"name": f"plugin_{i}"}}} for i in range(8)]
+
+    def save(cache):
+        for _ in range(50):
+            save_schema_cache(cache, path)
+
+    with caplog.at_level(logging.WARNING):
+        threads = [threading.Thread(target=save, args=(cache,)) for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert not caplog.records
+    assert load_schema_cache(path) in caches
+    assert os.listdir(tmp_path) == ["plugin_schemas.json"]  # no temporary files are left
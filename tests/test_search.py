@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from plugins.search import SearchEngine, search_all
+
+
+class FakeEngine(SearchEngine):
+    def __init__(self, name, delay=0.0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+
+    async def search(self, query):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [{"title": query, "link": f"https://{self.name}.example"}]
+
+
+def test_no_engines_give_an_empty_result():
+    assert asyncio.run(search_all("query", [], 1)) == {}
+
+
+def test_slow_and_failing_engines_are_reported():
+    engines = [FakeEngine("fast"), FakeEngine("slow", delay=5), FakeEngine("broken", error=ValueError("down"))]
+    result = asyncio.run(search_all("query", engines, 0.2))
+    assert result["fast_results"] == [{"title": "query", "link": "https://fast.example"}]
+    assert result["slow_error"] == "timeout"
+    assert "down" in result["broken_error"]
+
+
+def test_all_engines_failing_raise():
+    with pytest.raises(RuntimeError):
+        asyncio.run(search_all("query", [FakeEngine("broken", error=ValueError("down"))], 1))
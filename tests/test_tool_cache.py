@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+
+from pony.orm import db_session
+
+from tool_cache import ToolCache, ToolResultCache, _set, cache_key_hash, delete_results
+
+
+def stored_bytes():
+    from database import db
+
+    with db_session:
+        usage = db.select('SELECT "bytes" FROM "ToolCacheUsage" WHERE "name" = \'ToolResultCache\'')
+        actual = db.select('SELECT coalesce(sum("size"), 0) FROM "ToolResultCache"')[0]
+    return (usage[0] if usage else actual), actual
+
+
+def clear():
+    with db_session:
+        func_names = {e.func_name for e in ToolResultCache.select()}
+    for func_name in func_names:
+        delete_results(func_name)
+
+
+def test_running_total_matches_the_table(database):
+    clear()
+
+    async def run():
+        cache = ToolCache(max_bytes=10_000, memory_max_bytes=0)
+        keys = [cache_key_hash({"func_name": "test", "i": i}) for i in range(30)]
+        for i, key in enumerate(keys):
+            await cache.set(key, "test", "x" * 1000, ttl=0.2 if i % 3 == 0 else None)
+        await cache.set(keys[-1], "test", "y" * 500)  # replaced by a smaller value
+        return cache, keys
+
+    cache, keys = asyncio.run(run())
+    usage, actual = stored_bytes()
+    assert usage == actual <= 10_000
+    assert cache.evictions >= 20
+    # the least recently used entries were evicted, the latest is kept
+    assert asyncio.run(cache.get(keys[-1])) == "y" * 500
+    assert asyncio.run(cache.get(keys[0])) is None
+
+    time.sleep(0.3)
+    cache._swept_at = 0  # the next write sweeps the expired entries
+    asyncio.run(cache.set(cache_key_hash({"func_name": "test", "i": "new"}), "test", "z"))
+    usage, actual = stored_bytes()
+    assert usage == actual
+    with db_session:
+        assert not ToolResultCache.select(lambda e: e.expires_at is not None and e.expires_at <= time.time()).count()
+
+
+def test_concurrent_writes_of_the_same_keys(database):
+    # like several workers, or DB threads, caching the results of the same calls
+    clear()
+    keys = [cache_key_hash({"func_name": "test", "i": i}) for i in range(10)]
+    errors = []
+
+    def write(n):
+        try:
+            for i in range(100):
+                value = "x" * (1 + n + i % 7)
+                _set(ToolResultCache, keys[i % len(keys)], "test", value, None, time.time(), 10**9, False)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    usage, actual = stored_bytes()
+    assert usage == actual
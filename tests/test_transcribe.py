@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+import transcribe
+from transcribe import LongTranscript, merge_overlap, transcribe_stream
+
+
+class FakeTranscriptions:
+    """
+    Says a word every second of the audio, `word` or w<second> if None; the file holds the start and end of its
+    segment. Like the OpenAI API, only verbose_json responses have the timestamps of the segments.
+    """
+
+    def __init__(self, word):
+        self.word = word
+        self.formats = set()
+
+    async def create(self, model, file, response_format):
+        self.formats.add(response_format)
+        start, end = map(float, file.read().decode().split())
+        segments = [
+            {"start": t - start, "end": t - start + 1, "text": f" {self.word or f'w{t}'}"}
+            for t in range(int(start), int(end))
+        ]
+        text = "".join(s["text"] for s in segments)
+        return {"text": text, "segments": segments} if response_format == "verbose_json" else {"text": text}
+
+
+async def fake_extract(path, segment, out_path):
+    with open(out_path, "w") as f:
+        f.write(f"{segment.start} {segment.end}")
+
+
+def transcribe_fake(monkeypatch, model: str, word=None):
+    transcriptions = FakeTranscriptions(word)
+    monkeypatch.setattr(transcribe, "client", SimpleNamespace(audio=SimpleNamespace(transcriptions=transcriptions)))
+    monkeypatch.setattr(transcribe, "audio_model", model)
+    silences = [(t - 0.4, t + 0.4) for t in range(37, 600, 37)]
+
+    async def run():
+        transcript = LongTranscript()
+        async for part in transcribe_stream("fake.mp3", 60, 4, fake_extract, duration=600.0, silences=silences):
+            transcript.parts.append(part)
+        return transcript
+
+    return asyncio.run(run()), transcriptions.formats
+
+
+def test_repeated_words_at_segment_boundaries_are_kept(monkeypatch):
+    transcript, formats = transcribe_fake(monkeypatch, "whisper-1", word="same")
+    assert formats == {"verbose_json"}
+    assert len(transcript.parts) > 5
+    assert all(part.timestamped for part in transcript.parts)
+    assert len(transcript.text.split()) == 600
+
+
+def test_overlap_without_timestamps_is_merged(monkeypatch):
+    assert merge_overlap("one two three four", "Three four five") == "five"
+    assert merge_overlap("one two", "three four") == "three four"
+    # models other than Whisper answer without timestamps
+    transcript, formats = transcribe_fake(monkeypatch, "gpt-4o-transcribe")
+    assert formats == {"json"}
+    assert len(transcript.parts) > 5
+    assert not any(part.timestamped for part in transcript.parts)
+    assert transcript.text.split() == [f"w{t}" for t in range(600)]
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from conversation_export import replies_rate
+from workers import SHARED_RATE_LIMITS, Supervisor, worker_env, write_message
+
+
+async def connect(supervisor: Supervisor, index: int):
+    reader, writer = await asyncio.open_unix_connection(supervisor.socket_path)
+    write_message(writer, {"type": "hello", "index": index})
+    await asyncio.wait_for(supervisor.ready[index].wait(), 5)
+    return reader, writer
+
+
+async def next_message(reader: asyncio.StreamReader):
+    return json.loads(await asyncio.wait_for(reader.readline(), 5))
+
+
+def test_restarted_worker_gets_the_last_broadcast():
+    async def run():
+        supervisor = Supervisor(2, "xapp-test")
+        server = await asyncio.start_unix_server(supervisor._on_worker, supervisor.socket_path)
+        try:
+            reader0, writer0 = await connect(supervisor, 0)
+            reader1, writer1 = await connect(supervisor, 1)
+            for key in ["sk-first", "sk-second"]:
+                write_message(writer0, {"type": "broadcast", "message": {"type": "openai_key", "key": key}})
+                assert await next_message(reader1) == {"type": "openai_key", "key": key}
+
+            writer1.close()  # the worker exits and is restarted
+            await writer1.wait_closed()
+            while supervisor.ready[1].is_set():
+                await asyncio.sleep(0.01)
+            reader1, writer1 = await connect(supervisor, 1)
+            assert await next_message(reader1) == {"type": "openai_key", "key": "sk-second"}
+            writer0.close()
+            writer1.close()
+        finally:
+            server.close()
+            await supervisor.client.close()
+
+    asyncio.run(run())
+
+
+def test_workers_share_the_rate_limits():
+    env = worker_env(0, 4)
+    assert set(SHARED_RATE_LIMITS) <= set(env)
+    assert float(env["SLACK_REPLIES_RATE"]) == replies_rate / 4
+
+
+def test_workers_are_told_about_a_reconnect():
+    async def run():
+        supervisor = Supervisor(1, "xapp-test")
+        server = await asyncio.start_unix_server(supervisor._on_worker, supervisor.socket_path)
+        try:
+            reader, writer = await connect(supervisor, 0)
+            await supervisor.on_socket_message(supervisor.client, {"type": "hello", "num_connections": 1})
+            assert await next_message(reader) == {"type": "reconnected"}
+            writer.close()
+        finally:
+            server.close()
+            await supervisor.client.close()
+
+    asyncio.run(run())
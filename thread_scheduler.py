@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+default_debounce = float(os.environ.get("GENERATION_DEBOUNCE", 0.5))
+default_max_concurrency = int(os.environ.get("MAX_CONCURRENT_GENERATIONS", 8))
+
+
+class ThreadScheduler:
+    """
+    Runs at most one generation per thread.
+    A burst of messages is answered once, after no new message arrived for `debounce` seconds, and a new message
+    cancels the generation still running for the same thread. `max_concurrency` caps the generations of all threads.
+    """
+
+    def __init__(self, debounce: float = default_debounce, max_concurrency: int = default_max_concurrency):
+        self.debounce = debounce
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def submit(self, key: Hashable, func: Callable[[], Awaitable]) -> asyncio.Task:
+        """Schedules `func` for the thread `key`, superseding the generation pending or running for it."""
+        previous = self._tasks.get(key)
+        if previous is not None and not previous.done():
+            logging.debug("superseding generation of %s", key)
+            previous.cancel()
+        else:
+            previous = None
+        task = asyncio.create_task(self._run(key, func, previous))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key) if self._tasks.get(key) is t else None)
+        return task
+
+    def running(self, key: Hashable) -> bool:
+        task = self._tasks.get(key)
+        return task is not None and not task.done()
+
+    async def join(self):
+        """Waits until no generation is pending or running."""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks.values()))
+
+    async def _run(self, key: Hashable, func: Callable[[], Awaitable], previous: Optional[asyncio.Task]):
+        await asyncio.sleep(self.debounce)  # more messages may follow, only the latest one is answered
+        if previous is not None:  # let the superseded generation finish its reply
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            try:
+                await func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Exception in generation of %s: %s", key, e)
+                traceback.print_exc()
+
+
+async def main():
+    scheduler = ThreadScheduler(debounce=0.2, max_concurrency=2)
+    runs = []
+
+    async def generate(thread, msg):
+        runs.append((thread, msg))
+        await asyncio.sleep(1)
+
+    t0 = time.monotonic()
+    for thread in range(4):
+        for msg in range(5):  # a burst of messages in every thread
+            scheduler.submit(thread, lambda thread=thread, msg=msg: generate(thread, msg))
+            await asyncio.sleep(0.05)
+    await asyncio.sleep(0.3)
+    task = scheduler.submit(0, lambda: generate(0, "late"))  # supersedes the running generation of thread 0
+    await task
+    while any(scheduler.running(thread) for thread in range(4)):
+        await asyncio.sleep(0.1)
+    print(f"{len(runs)} generations for 21 messages in {time.monotonic() - t0:.2f}s: {runs}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
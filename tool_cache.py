@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Type
+
+from pony import orm
+from pony.orm import LongStr, PrimaryKey, Required, db_session
+
+from blob_store import pack_value, release_value, unpack_value
+from database import db, run_in_db_thread
+from metrics import tool_cache_lookups
+
+max_bytes = int(os.environ.get("TOOL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+memory_max_bytes = int(os.environ.get("TOOL_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+sweep_interval = 600  # seconds between scans for expired entries
+
+
+class ToolResultCache(db.Entity):
+    """Database model for storing the tool call cache"""
+
+    key_hash = PrimaryKey(str)  # sha256 of the canonicalized function name and arguments
+    func_name = Required(str)
+    value = Required(LongStr)  # the function's result as a string, or a reference to a blob if large
+    size = Required(int)  # of the result
+    created_at = Required(float)
+    expires_at = orm.Optional(float, index=True)  # None for results which never expire
+    accessed_at = Required(float, index=True)
+
+
+class DocumentCache(db.Entity):
+    """Like ToolResultCache, for the long documents kept for read_document, bounded by a budget of their own"""
+
+    key_hash = PrimaryKey(str)
+    func_name = Required(str)
+    value = Required(LongStr)
+    size = Required(int)
+    created_at = Required(float)
+    expires_at = orm.Optional(float, index=True)
+    accessed_at = Required(float, index=True)
+
+
+CacheEntity = Type[ToolResultCache]  # or DocumentCache, which has the same attributes
+
+
+def cache_key_hash(kv: Dict) -> str:
+    canonical = json.dumps(kv, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ToolCacheUsage(db.Entity):
+    """Bytes stored in a cache table, kept up to date by every write, so that no write sums the whole table"""
+
+    name = PrimaryKey(str)  # of the table
+    bytes = Required(int)
+
+
+EVICTION_BATCH = 64  # least recently used entries loaded at once
+
+
+def _count_usage(entity: CacheEntity):
+    """Sums the bytes of the table once, before the first write which keeps the total up to date."""
+    name = entity.__name__
+    if not db.select('SELECT 1 FROM "ToolCacheUsage" WHERE "name" = $name'):
+        db.execute(
+            'INSERT OR IGNORE INTO "ToolCacheUsage" ("name", "bytes") '
+            f'SELECT $name, coalesce(sum("size"), 0) FROM "{name}"'
+        )
+
+
+def _add_usage(entity: CacheEntity, delta: int) -> int:
+    """Adds `delta` bytes to the total of the table and returns the new total."""
+    name = entity.__name__
+    # a single statement, other processes may write the cache at the same time
+    db.execute('UPDATE "ToolCacheUsage" SET "bytes" = "bytes" + $delta WHERE "name" = $name')
+    return db.select('SELECT "bytes" FROM "ToolCacheUsage" WHERE "name" = $name')[0]
+
+
+def _delete(entry: ToolResultCache) -> int:
+    release_value(entry.value)
+    entry.delete()
+    return entry.size
+
+
+@db_session
+def _get(entity: CacheEntity, key_hash: str, now: float) -> Tuple[Optional[str], Optional[float], bool]:
+    """Returns the value, its expiry time, and whether an expired entry was found."""
+    entry = entity.get(key_hash=key_hash)
+    if entry is None:
+        return None, None, False
+    if entry.expires_at is not None and entry.expires_at <= now:
+        _count_usage(entity)
+        _add_usage(entity, -_delete(entry))
+        return None, None, True
+    entry.accessed_at = now
+    return unpack_value(entry.value), entry.expires_at, False
+
+
+# Another worker or DB thread may insert or change the same entry at the same time, its key is looked up outside of a
+# write lock; the conflict fails the transaction, which is run again and then finds the entry written by the other one.
+@db_session(retry=3)
+def _set(
+    entity: CacheEntity,
+    key_hash: str,
+    func_name: str,
+    value: str,
+    expires_at: Optional[float],
+    now: float,
+    limit: int,
+    sweep: bool,
+) -> int:
+    """
+    Stores the value and evicts the least recently used entries above `limit` bytes, and with `sweep` all expired
+    entries. Returns the number of evicted entries.
+    """
+    _count_usage(entity)
+    size = len(value.encode("utf-8"))
+    entry = entity.get(key_hash=key_hash)
+    if entry is None:
+        entity(
+            key_hash=key_hash,
+            func_name=func_name,
+            value=pack_value(value),
+            size=size,
+            created_at=now,
+            expires_at=expires_at,
+            accessed_at=now,
+        )
+        delta = size
+    else:
+        release_value(entry.value)
+        delta = size - entry.size
+        entry.set(value=pack_value(value), size=size, created_at=now, expires_at=expires_at, accessed_at=now)
+    evicted = 0
+    if sweep:  # the expiry index is only scanned now and then, expired entries are also dropped when read
+        for e in entity.select(lambda e: e.expires_at is not None and e.expires_at <= now):
+            delta -= _delete(e)
+            evicted += 1
+    total = _add_usage(entity, delta)
+    while total > limit:
+        freed = 0
+        page = entity.select(lambda e: e.key_hash != key_hash).order_by(entity.accessed_at)
+        for e in page[:EVICTION_BATCH]:
+            if total - freed <= limit:
+                break
+            freed += _delete(e)
+            evicted += 1
+        if not freed:  # only the new entry is left
+            break
+        total = _add_usage(entity, -freed)
+    return evicted
+
+
+@db_session
+def delete_results(func_name: str, entity: CacheEntity = ToolResultCache) -> int:
+    """Deletes the cached results of a function, e.g. of a demo, and returns their number."""
+    _count_usage(entity)
+    entries = entity.select(lambda e: e.func_name == func_name)[:]
+    _add_usage(entity, -sum(_delete(e) for e in entries))
+    return len(entries)
+
+
+@db_session
+def migrate_legacy_cache():
+    """Moves the entries of the old ToolCallCache table, keyed by JSON, into ToolResultCache."""
+    if not db.provider.table_exists(db.get_connection(), "ToolCallCache"):
+        return
+    now = time.time()
+    count = 0
+    for key, value in db.select('SELECT "key", "value" FROM "ToolCallCache"'):
+        kv = json.loads(key)
+        key_hash = cache_key_hash(kv)
+        if ToolResultCache.get(key_hash=key_hash) is None:
+            ToolResultCache(
+                key_hash=key_hash,
+                func_name=kv.get("func_name", ""),
+                value=pack_value(value),
+                size=len(value.encode("utf-8")),
+                created_at=now,
+                accessed_at=now,
+            )
+            count += 1
+    db.execute('DROP TABLE "ToolCallCache"')
+    db.execute('DELETE FROM "ToolCacheUsage"')  # counted again on the next write
+    logging.info("Migrated %d tool cache entries", count)
+
+
+class ToolCache:
+    """
+    Tool results keyed by a hash of the function name and arguments, with a per tool TTL.
+    A small in-memory LRU tier sits in front of the SQLite table `entity`, which is bounded by `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = max_bytes,
+        memory_max_bytes: int = memory_max_bytes,
+        entity: CacheEntity = ToolResultCache,
+    ):
+        self.entity = entity
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._memory: "OrderedDict[str, Tuple[str, Optional[float]]]" = OrderedDict()
+        self._memory_size = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._swept_at = 0.0
+
+    def stats(self) -> Dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "memory_bytes": self._memory_size,
+        }
+
+    async def get(self, key_hash: str) -> Optional[str]:
+        now = time.time()
+        cached = self._memory.get(key_hash)
+        if cached is not None:
+            value, expires_at = cached
+            if expires_at is None or expires_at > now:
+                self.memory_hits += 1
+                tool_cache_lookups.inc(result="memory")
+                self._memory.move_to_end(key_hash)
+                return value
+            self._forget(key_hash)
+        value, expires_at, expired = await run_in_db_thread(_get, self.entity, key_hash, now)
+        if expired:
+            self.expirations += 1
+        if value is None:
+            self.misses += 1
+            tool_cache_lookups.inc(result="miss")
+            return None
+        self.db_hits += 1
+        tool_cache_lookups.inc(result="db")
+        self._remember(key_hash, value, expires_at)
+        return value
+
+    async def set(self, key_hash: str, func_name: str, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        self._remember(key_hash, value, expires_at)
+        sweep = now - self._swept_at >= sweep_interval
+        if sweep:
+            self._swept_at = now
+        self.evictions += await run_in_db_thread(
+            _set, self.entity, key_hash, func_name, value, expires_at, now, self.max_bytes, sweep
+        )
+
+    def _remember(self, key_hash: str, value: str, expires_at: Optional[float]):
+        self._forget(key_hash)
+        size = len(value)
+        if size > self.memory_max_bytes // 4:  # keep huge results only in SQLite
+            return
+        self._memory[key_hash] = value, expires_at
+        self._memory_size += size
+        while self._memory_size > self.memory_max_bytes:
+            _, (evicted, _) = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _forget(self, key_hash: str):
+        cached = self._memory.pop(key_hash, None)
+        if cached is not None:
+            self._memory_size -= len(cached[0])
+
+
+async def main():
+    db.generate_mapping(create_tables=True, check_tables=True)
+    cache = ToolCache(max_bytes=10_000, memory_max_bytes=4_000)
+    keys = [cache_key_hash({"func_name": "bench", "i": i}) for i in range(20)]
+    for i, key in enumerate(keys):
+        await cache.set(key, "bench", "x" * 1000, ttl=0.5 if i % 2 else None)
+    for key in reversed(keys):  # the most recent results are still in memory
+        await cache.get(key)
+    await asyncio.sleep(0.6)
+    for key in keys:
+        await cache.get(key)
+    print(cache.stats())
+    delete_results("bench")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,13 @@
 import asyncio
 import logging
 import os
+import re
+import shutil
 import sys
+import tempfile
 import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
 
 import openai
 
@@ -10,20 +15,263 @@ API_KEY = os.getenv("WHISPER_API_KEY") or os.getenv("OPENAI_API_KEY") or "sk-pla
 client = openai.AsyncOpenAI(base_url=os.getenv("WHISPER_BASE_URL"), api_key=API_KEY)
 audio_model = os.getenv("OPENAI_AUDIO_MODEL", "whisper-1")
 
+# long audio is cut into segments near silences and transcribed in parallel
+segment_seconds = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", 600))
+segment_overlap = float(os.getenv("TRANSCRIBE_SEGMENT_OVERLAP", 2))
+max_concurrency = int(os.getenv("TRANSCRIBE_CONCURRENCY", 4))
+ffmpeg = shutil.which("ffmpeg")
+ffprobe = shutil.which("ffprobe")
+
 
 async def transcribe(audio_file):
     return await client.audio.transcriptions.create(model=audio_model, file=audio_file)
 
 
+@dataclass
+class Segment:
+    index: int
+    start: float  # the audio sent to Whisper, including the overlap with the neighbours
+    end: float
+    keep_from: float  # only the text spoken between the cut points is kept
+    keep_until: float
+
+
+@dataclass
+class TranscriptPart:
+    index: int
+    start: float
+    end: float
+    text: str
+    timestamped: bool = False  # cut at the segment boundaries by timestamps, so it repeats nothing of the last part
+
+
+@dataclass
+class LongTranscript:
+    parts: List[TranscriptPart] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(part.text for part in self.parts if part.text)
+
+    def timestamped_text(self) -> str:
+        return "\n".join(f"[{format_timestamp(part.start)}] {part.text}" for part in self.parts if part.text)
+
+
+def format_timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+async def run_ffmpeg(*args: str) -> str:
+    """Runs ffmpeg or ffprobe and returns its output, stderr included, as ffmpeg reports filter results there."""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    output, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(args[0])} exited with code {process.returncode}: {output[-500:]!r}")
+    return output.decode(errors="replace")
+
+
+async def probe_duration(path: str) -> float:
+    output = await run_ffmpeg(ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path)
+    return float(output.strip())
+
+
+async def detect_silences(path: str, noise: str = "-35dB", min_duration: float = 0.5) -> List[Tuple[float, float]]:
+    output = await run_ffmpeg(
+        ffmpeg, "-nostats", "-i", path, "-af", f"silencedetect=noise={noise}:d={min_duration}", "-f", "null", "-"
+    )
+    starts = [float(x) for x in re.findall(r"silence_start: ([\d.]+)", output)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", output)]
+    return list(zip(starts, ends))
+
+
+def plan_segments(
+    duration: float,
+    silences: List[Tuple[float, float]],
+    target: float = segment_seconds,
+    overlap: float = segment_overlap,
+) -> List[Segment]:
+    """
+    Cuts the audio about every `target` seconds, at the middle of the longest silence in the last third of each
+    segment, or exactly at `target` if there is none. Neighbouring segments overlap by `overlap` seconds.
+    """
+    cuts = [0.0]
+    while duration - cuts[-1] > target:
+        lo, hi = cuts[-1] + target * 2 / 3, cuts[-1] + target
+        candidates = [(e - s, (s + e) / 2) for s, e in silences if lo <= (s + e) / 2 <= hi]
+        cuts.append(max(candidates)[1] if candidates else hi)
+    cuts.append(duration)
+    return [
+        Segment(i, max(0.0, cuts[i] - overlap), min(duration, cuts[i + 1] + overlap), cuts[i], cuts[i + 1])
+        for i in range(len(cuts) - 1)
+    ]
+
+
+async def extract_segment(path: str, segment: Segment, out_path: str):
+    # mono 16 kHz is what Whisper works with anyway, and keeps each upload far below the 25 MB limit
+    await run_ffmpeg(
+        ffmpeg, "-nostdin", "-v", "error", "-y", "-ss", f"{segment.start:.3f}", "-to", f"{segment.end:.3f}",
+        "-i", path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "48k", out_path,
+    )  # fmt: skip
+
+
+def _get(obj, name):
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def response_format(model: str) -> str:
+    """Only Whisper supports verbose_json, with the timestamps of the segments, e.g. gpt-4o-transcribe does not."""
+    return "verbose_json" if "whisper" in model else "json"
+
+
+def merge_overlap(previous: str, text: str, max_words: int = 30) -> str:
+    """Drops the words at the start of `text` which repeat the end of `previous`, for responses without timestamps."""
+    prev_words, words = previous.split(), text.split()
+    for n in range(min(max_words, len(prev_words), len(words)), 0, -1):
+        if [w.lower() for w in prev_words[-n:]] == [w.lower() for w in words[:n]]:
+            return " ".join(words[n:])
+    return text
+
+
+async def transcribe_segment(path: str, segment: Segment) -> TranscriptPart:
+    with open(path, "rb") as f:
+        response = await client.audio.transcriptions.create(
+            model=audio_model, file=f, response_format=response_format(audio_model)
+        )
+    segments = _get(response, "segments")
+    if not segments:  # no timestamps, the overlap is removed by merge_overlap
+        return TranscriptPart(
+            segment.index, segment.keep_from, segment.keep_until, (_get(response, "text") or "").strip()
+        )
+    texts = []
+    for s in segments:
+        middle = segment.start + (_get(s, "start") + _get(s, "end")) / 2
+        if segment.keep_from <= middle < segment.keep_until or (middle >= segment.keep_until == segment.end):
+            texts.append(_get(s, "text").strip())
+    return TranscriptPart(segment.index, segment.keep_from, segment.keep_until, " ".join(texts), timestamped=True)
+
+
+async def transcribe_stream(
+    path: str,
+    target: float = segment_seconds,
+    concurrency: int = max_concurrency,
+    extract: Callable[[str, Segment, str], Awaitable[None]] = extract_segment,
+    duration: Optional[float] = None,
+    silences: Optional[List[Tuple[float, float]]] = None,
+) -> AsyncIterator[TranscriptPart]:
+    """
+    Transcribes a long audio file segment by segment, `concurrency` segments at a time, and yields the parts in
+    order as soon as they are ready. Without ffmpeg, or for short audio, the whole file is sent in one request.
+    """
+    if duration is None:
+        duration = await probe_duration(path) if ffmpeg and ffprobe else 0.0
+    if duration <= target * 1.2:
+        with open(path, "rb") as f:
+            response = await transcribe(f)
+        yield TranscriptPart(0, 0.0, duration, response.text.strip())
+        return
+    if silences is None:
+        silences = await detect_silences(path)
+    segments = plan_segments(duration, silences, target)
+    logging.info("Transcribing %s (%.0fs) in %d segments", path, duration, len(segments))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        async def run(segment: Segment) -> TranscriptPart:
+            async with semaphore:
+                out_path = os.path.join(tmpdir, f"segment{segment.index}.mp3")
+                await extract(path, segment, out_path)
+                try:
+                    return await transcribe_segment(out_path, segment)
+                finally:
+                    os.remove(out_path)
+
+        tasks = [asyncio.create_task(run(segment)) for segment in segments]
+        try:
+            previous = ""
+            for task in tasks:
+                part = await task
+                if previous and part.text and not part.timestamped:
+                    part.text = merge_overlap(previous, part.text)
+                previous = part.text or previous
+                yield part
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def transcribe_file(path: str, **kwargs) -> LongTranscript:
+    transcript = LongTranscript()
+    async for part in transcribe_stream(path, **kwargs):
+        transcript.parts.append(part)
+    return transcript
+
+
+async def stub_whisper_demo():
+    """Transcribes one hour of fake audio against a local stub of the Whisper endpoint, which takes 1s per request."""
+    from aiohttp import web
+
+    global client
+    words_per_second = 2
+
+    async def transcriptions(request):
+        form = await request.post()
+        start, end = map(float, form["file"].file.read().decode().split())
+        await asyncio.sleep(1)
+        segments = [
+            {"start": t - start, "end": t - start + 1, "text": f" w{t:.0f}a w{t:.0f}b"}
+            for t in range(int(start), int(end))
+        ]
+        return web.json_response({"text": "".join(s["text"] for s in segments), "segments": segments})
+
+    async def fake_extract(path, segment, out_path):
+        with open(out_path, "w") as f:
+            f.write(f"{segment.start} {segment.end}")
+
+    app = web.Application()
+    app.router.add_post("/audio/transcriptions", transcriptions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    client = openai.AsyncOpenAI(base_url=f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}", api_key="x")
+
+    duration = 3600.0
+    silences = [(t - 0.4, t + 0.4) for t in range(37, 3600, 37)]
+    for concurrency in (1, 4, 8):
+        t0 = time.time()
+        first = None
+        transcript = LongTranscript()
+        async for part in transcribe_stream(
+            "fake.mp3", 300, concurrency, fake_extract, duration=duration, silences=silences
+        ):
+            first = first or time.time() - t0
+            transcript.parts.append(part)
+        words = transcript.text.split()
+        assert len(words) == duration * words_per_second and len(set(words)) == len(words), "overlap not stitched"
+        print(
+            f"concurrency {concurrency}: {len(transcript.parts)} segments, first part after {first:.2f}s, "
+            f"done in {time.time() - t0:.2f}s"
+        )
+    print(transcript.timestamped_text()[:200])
+    await runner.cleanup()
+
+
 async def main():
     logging.basicConfig(level=logging.DEBUG)
+    if len(sys.argv) > 1 and sys.argv[1] == "--stub":
+        await stub_whisper_demo()
+        return
     filename = sys.argv[1] if len(sys.argv) > 1 else "audio.mp4"
-    with open(filename, "rb") as f:
-        t0 = time.time()
-        transcript = await transcribe(f)
-        t1 = time.time()
+    t0 = time.time()
+    transcript = await transcribe_file(filename)
+    t1 = time.time()
     print(f"Transcribed in {t1 - t0:.2f} seconds")
-    print(transcript.text)
+    print(transcript.timestamped_text())
 
 
 if __name__ == "__main__":
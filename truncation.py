@@ -0,0 +1,133 @@
+import json
+import os
+import re
+import time
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+# byte size limit of a plugin result, as JSON encoded UTF-8
+max_result_length = int(os.environ.get("MAX_TOOL_RESULT_BYTES", 6291556))
+
+# sentence ends, the text is cut right after the punctuation
+SENTENCE_ENDS = [". ", "! ", "? ", ".\t", "。", "！", "？"]
+
+# bytes escaped in a JSON string, all other control characters take six bytes (\u00XX)
+ESCAPED = re.compile(rb'[\x00-\x1f"\\]')
+SHORT_ESCAPES = set(b'"\\\n\r\t\b\f')
+
+
+class _EscapedSize:
+    """The size of every prefix of a UTF-8 text inside a JSON string, from one scan for the characters to escape."""
+
+    def __init__(self, encoded: bytes):
+        self.positions = []
+        extras = []
+        for m in ESCAPED.finditer(encoded):
+            self.positions.append(m.start())
+            extras.append(1 if encoded[m.start()] in SHORT_ESCAPES else 5)
+        self.extra_sums = [0] + list(accumulate(extras))
+
+    def __call__(self, end: int) -> int:
+        return end + self.extra_sums[bisect_left(self.positions, end)]
+
+
+def truncate_text(text: str, max_bytes: int, json_escaped: bool = False) -> Tuple[str, bool]:
+    """
+    Returns the longest prefix of `text` taking at most `max_bytes`, cut after a full line if possible, else after a
+    sentence, else after a character. With `json_escaped` the size inside a JSON string is counted, e.g. a newline
+    takes two bytes. The text is encoded and scanned once, so this is linear in its length.
+    """
+    encoded = text.encode("utf-8")
+    size = _EscapedSize(encoded) if json_escaped else (lambda end: end)
+    if size(len(encoded)) <= max_bytes:
+        return text, False
+    # the longest prefix that fits, sizes grow monotonically with the prefix length
+    left, right = 0, len(encoded)
+    while left < right:
+        mid = (left + right + 1) // 2
+        if size(mid) <= max_bytes:
+            left = mid
+        else:
+            right = mid - 1
+    while left > 0 and left < len(encoded) and 0x80 <= encoded[left] < 0xC0:  # inside a multibyte character
+        left -= 1
+    newline = encoded.rfind(b"\n", 0, left)
+    kept = encoded[: max(newline, 0)].decode("utf-8")
+    partial = encoded[newline + 1 : left].decode("utf-8")
+    if encoded[left : left + 1] == b"\n":  # the prefix ends with a full line
+        return kept + "\n" + partial if newline >= 0 else partial, True
+    cut = max(partial.rfind(end) + len(end.rstrip()) if end in partial else 0 for end in SENTENCE_ENDS)
+    if cut:
+        return kept + "\n" + partial[:cut] if newline >= 0 else partial[:cut], True
+    return (kept, True) if newline >= 0 else (partial, True)
+
+
+def truncate_result(data: Dict, max_length: int = max_result_length, fields: Optional[List[str]] = None) -> bool:
+    """
+    Shortens the largest string field of `data` (or the first of `fields` which is a string) in place so that
+    `json.dumps(data, ensure_ascii=False)` fits into `max_length` bytes. Returns whether anything was cut.
+    """
+    if len(json.dumps(data, ensure_ascii=False).encode("utf-8")) <= max_length:
+        return False
+    candidates = [k for k in (fields or data) if isinstance(data.get(k), str)]
+    if not candidates:
+        return False
+    field = max(candidates, key=lambda k: len(data[k])) if fields is None else candidates[0]
+    text = data[field]
+    data[field] = ""
+    overhead = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    data[field], truncated = truncate_text(text, max_length - overhead, json_escaped=True)
+    return truncated
+
+
+def _bisect_truncate(data: Dict, field: str, max_length: int):
+    """The previous approach, serializing the whole result at every step of a binary search."""
+    text = data[field]
+    left, right = 0, len(text)
+    while left + 1 < right:
+        mid = (left + right) // 2
+        data[field] = text[:mid]
+        if len(json.dumps(data, ensure_ascii=False).encode()) > max_length:
+            right = mid
+        else:
+            left = mid
+    data[field] = text[:left]
+
+
+def main():
+    lines = []
+    size = 0
+    i = 0
+    while size < 6 * 1024 * 1024:
+        line = f'[{i // 60:02d}:{i % 60:02d}] Speaker {i % 3}: "这是第{i}句话。" And this is sentence {i}. Right?'
+        lines.append(line)
+        size += len(line.encode()) + 1
+        i += 1
+    transcript = "\n".join(lines)
+    data = {"title": "A long video", "description": "x" * 1000, "transcript": transcript}
+    limit = 4 * 1024 * 1024
+
+    t0 = time.perf_counter()
+    old = dict(data)
+    _bisect_truncate(old, "transcript", limit)
+    t1 = time.perf_counter()
+    new = dict(data)
+    truncated = truncate_result(new, limit)
+    t2 = time.perf_counter()
+
+    new_length = len(json.dumps(new, ensure_ascii=False).encode())
+    assert truncated and new_length <= limit and new["transcript"].endswith("Right?")
+    print(f"{len(transcript.encode()) / 1024 / 1024:.1f} MB transcript cut to {limit} bytes")
+    print(f"binary search: {t1 - t0:.3f}s, prefix sums: {t2 - t1:.3f}s ({new_length} bytes, at a line boundary)")
+
+    # a single line, cut at a sentence boundary, and a single sentence, cut at a character
+    assert truncate_text("First one. Second one. Third", 16) == ("First one.", True)
+    assert truncate_text('"quoted" text', 8, json_escaped=True) == ('"quoted', True)
+    assert truncate_text("a\nFirst one. Second one. Third", 16) == ("a\nFirst one.", True)
+    assert truncate_text("一二三", 7) == ("一二", True)
+    assert truncate_text("short\ntext", 100) == ("short\ntext", False)
+
+
+if __name__ == "__main__":
+    main()
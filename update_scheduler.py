@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
+
+from metrics import slack_updates_per_message, slack_updates_total
+
+# chat.update is a Tier 3 method (50+ requests per minute per workspace)
+default_rate = float(os.environ.get("SLACK_UPDATE_RATE", 50 / 60))
+default_burst = int(os.environ.get("SLACK_UPDATE_BURST", 5))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds`, e.g. after Slack answered with Retry-After."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class _PendingUpdate:
+    def __init__(self, client: AsyncWebClient):
+        self.client = client
+        self.text: Union[str, Callable[[], str], None] = None  # latest text not sent yet
+        self.final = False
+        self.last_sent = 0.0
+        self.updated_at = time.monotonic()
+        self.sent = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class UpdateScheduler:
+    """
+    Paces chat.update calls of all streamed replies against one shared token bucket.
+    Pending edits of the same message are merged, only the latest text is sent.
+    """
+
+    def __init__(
+        self, rate: float = default_rate, burst: int = default_burst, min_interval: float = 1.0, idle_ttl: float = 600
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.min_interval = min_interval  # per message
+        self.idle_ttl = idle_ttl  # entries of messages without edits for this long are dropped, even if not final
+        self._pending: Dict[Tuple[str, str], _PendingUpdate] = {}
+        self._swept_at = time.monotonic()
+
+    def update(
+        self, client: AsyncWebClient, channel: str, ts: str, text: Union[str, Callable[[], str]], final: bool = False
+    ):
+        """
+        Schedules `text` as the new content of the message, replacing any edit still waiting to be sent. `text` may be
+        a function returning it, called only when the edit is sent, e.g. to not build a streamed text on every delta.
+        """
+        key = channel, ts
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = _PendingUpdate(client)
+        entry.text = text
+        entry.final = entry.final or final
+        entry.updated_at = time.monotonic()
+        if entry.task is None or entry.task.done():
+            entry.task = asyncio.create_task(self._run(key, entry))
+        self._evict_idle(entry.updated_at)
+
+    def discard(self, channel: str, ts: str):
+        """Forgets the message once its reply ended, an edit being sent is still delivered."""
+        entry = self._pending.pop((channel, ts), None)
+        if entry is not None:
+            slack_updates_per_message.observe(entry.sent)
+
+    def _evict_idle(self, now: float):
+        """Drops the entries of replies which ended without a final text, e.g. after an error, once a minute."""
+        if now - self._swept_at < 60:
+            return
+        self._swept_at = now
+        for key, entry in list(self._pending.items()):
+            if (entry.task is None or entry.task.done()) and now - entry.updated_at > self.idle_ttl:
+                del self._pending[key]
+
+    async def flush(self, client: AsyncWebClient, channel: str, ts: str, text: Optional[str] = None):
+        """Sends the final text of the message (or the pending one) and waits until it is delivered."""
+        if text is not None:
+            self.update(client, channel, ts, text, final=True)
+        entry = self._pending.get((channel, ts))
+        if entry is None:
+            return
+        entry.final = True
+        if entry.task is not None:
+            await asyncio.shield(entry.task)
+
+    async def _run(self, key: Tuple[str, str], entry: _PendingUpdate):
+        channel, ts = key
+        try:
+            while entry.text is not None:
+                wait = entry.last_sent + self.min_interval - time.monotonic()
+                if wait > 0 and not entry.final:
+                    await asyncio.sleep(wait)
+                    continue  # the edit may have been finalized meanwhile
+                await self.bucket.acquire()
+                text, entry.text = entry.text, None
+                if callable(text):
+                    text = text()
+                try:
+                    await entry.client.chat_update(channel=channel, ts=ts, text=text)
+                except SlackApiError as e:
+                    retry_after = rate_limit_retry_after(e.response)
+                    if retry_after is None:
+                        slack_updates_total.inc(result="error")
+                        logging.error("Failed to update message. channel: %s, ts: %s, error: %s", channel, ts, e)
+                        continue
+                    slack_updates_total.inc(result="ratelimited")
+                    logging.warning("Rate limited by Slack, retrying after %s seconds", retry_after)
+                    self.bucket.pause(retry_after)
+                    if entry.text is None:  # nothing newer arrived, resend the same text
+                        entry.text = text
+                    continue
+                entry.last_sent = time.monotonic()
+                entry.sent += 1
+                slack_updates_total.inc(result="ok")
+        finally:
+            # keep the entry until the final text is sent, so that later edits still respect min_interval
+            if entry.final and entry.text is None and self._pending.get(key) is entry:
+                del self._pending[key]
+                slack_updates_per_message.observe(entry.sent)
+
+
+def rate_limit_retry_after(response: AsyncSlackResponse) -> Optional[float]:
+    if response.status_code != 429 and response.get("error") != "ratelimited":
+        return None
+    return float(response.headers.get("Retry-After", 1))
+
+
+async def rate_limited_call(bucket: TokenBucket, method: Callable[..., Awaitable], max_retries: int = 5, **kwargs):
+    """Calls a Slack Web API method once the bucket has a token, pausing the bucket for Retry-After when limited."""
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            return await method(**kwargs)
+        except SlackApiError as e:
+            retry_after = rate_limit_retry_after(e.response)
+            if retry_after is None or attempt == max_retries:
+                raise
+            logging.warning("Rate limited by Slack, retrying after %s seconds", retry_after)
+            bucket.pause(retry_after)
+
+
+class FakeRateLimitedClient:
+    """Mimics AsyncWebClient.chat_update, answering with HTTP 429 above `limit` calls per second."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.calls = []
+        self.rate_limited = 0
+        self.messages = {}
+
+    async def chat_update(self, channel, ts, text):
+        now = time.monotonic()
+        self.calls = [t for t in self.calls if now - t < 1] + [now]
+        if len(self.calls) > self.limit:
+            self.rate_limited += 1
+            raise SlackApiError(
+                "ratelimited",
+                AsyncSlackResponse(
+                    client=self,
+                    http_verb="POST",
+                    api_url="https://slack.com/api/chat.update",
+                    req_args={},
+                    data={"ok": False, "error": "ratelimited"},
+                    headers={"Retry-After": "1"},
+                    status_code=429,
+                ),
+            )
+        await asyncio.sleep(0.01)
+        self.messages[channel, ts] = text
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    client = FakeRateLimitedClient(limit=5)
+    scheduler = UpdateScheduler(rate=10, burst=10, min_interval=0.2)
+
+    async def stream_reply(i):
+        text = ""
+        for j in range(50):
+            text += f"{j} "
+            scheduler.update(client, "C1", str(i), text)
+            await asyncio.sleep(0.02)
+        await scheduler.flush(client, "C1", str(i), text + "(done)")
+
+    t0 = time.monotonic()
+    await asyncio.gather(*[stream_reply(i) for i in range(20)])
+    print(f"20 replies streamed in {time.monotonic() - t0:.2f}s, {client.rate_limited} rate limited calls")
+    assert all(client.messages["C1", str(i)].endswith("(done)") for i in range(20))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,268 @@
+"""
+Multi-process mode of the bot, enabled with WORKERS > 1.
+
+A supervisor process holds the Socket Mode connection and forwards every request to one of the worker processes,
+chosen by hashing (channel, thread_ts), so that the generations, caches and tool calls of a thread all stay on one
+worker. The response of the worker's Bolt app, e.g. the ack of a slash command, is sent back to Slack by the
+supervisor. Workers share the SQLite database, so extra prompts and cached tool results are visible to all of them.
+
+Supervisor and workers talk over a Unix socket in newline-delimited JSON:
+    supervisor -> worker: {"type": "request", "id": envelope_id, "body": payload}, {"type": "reconnected"} when the
+                          Socket Mode connection is established again, or a broadcast message; a worker which
+                          connects gets the last broadcast message of every type first
+    worker -> supervisor: {"type": "hello", "index": i}, {"type": "response", "id": ..., "status": ..., "body": ...,
+                          "headers": ...} or {"type": "broadcast", "message": {...}} for all other workers
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from typing import Dict, Optional, Set, Tuple
+
+from metrics import worker_requests_total, worker_restarts_total
+
+worker_count = int(os.environ.get("WORKERS", 1))
+ack_timeout = 2.5  # Slack expects an ack within 3 seconds, and retries the request otherwise
+restart_delay = 1.0
+max_line = 64 * 1024 * 1024  # a request or response, in bytes
+# rate limits of the Slack app, divided between the workers; each module reads them on import
+SHARED_RATE_LIMITS = {
+    "SLACK_UPDATE_RATE": ("update_scheduler", "default_rate"),
+    "SLACK_HISTORY_RATE": ("conversation_export", "history_rate"),
+    "SLACK_REPLIES_RATE": ("conversation_export", "replies_rate"),
+    "SLACK_DELETE_RATE": ("conversation_cleanup", "delete_rate"),
+}
+
+supervisor_link: Optional[asyncio.StreamWriter] = None  # set in worker processes
+
+
+def thread_of(payload: Dict) -> Tuple[str, str]:
+    """Returns the (channel, thread_ts) a request belongs to. Requests without a thread, e.g. commands, use ''."""
+    event = payload.get("event")
+    if event is not None:
+        # hidden events, e.g. edits and deletions, carry the message they are about
+        msg = event.get("message") or event.get("previous_message") or event
+        return event.get("channel", ""), msg.get("thread_ts") or msg.get("ts") or event.get("ts", "")
+    channel = payload.get("channel_id") or (payload.get("channel") or {}).get("id", "")
+    return channel, ""
+
+
+def shard_of(payload: Dict, workers: int) -> int:
+    channel, thread_ts = thread_of(payload)
+    return zlib.crc32(f"{channel}:{thread_ts}".encode()) % workers  # stable across processes, unlike hash()
+
+
+def worker_env(index: int, workers: int) -> Dict[str, str]:
+    """Environment overrides of a worker: its share of the rate limits, and its own metrics port."""
+    import importlib
+
+    env = {}
+    for name, (module, attr) in SHARED_RATE_LIMITS.items():
+        env[name] = repr(getattr(importlib.import_module(module), attr) / workers)
+    if os.environ.get("METRICS_PORT"):
+        env["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + 1 + index)
+    return env
+
+
+def write_message(writer: asyncio.StreamWriter, message: Dict):
+    writer.write(json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+
+
+async def broadcast(message: Dict):
+    """Sends a message to all other workers, if this process is a worker. See `Worker.handle_broadcast`."""
+    if supervisor_link is not None:
+        write_message(supervisor_link, {"type": "broadcast", "message": message})
+        await supervisor_link.drain()
+
+
+class Supervisor:
+    """Starts `workers` worker processes, restarts them when they exit, and routes Socket Mode requests to them."""
+
+    def __init__(self, workers: int, app_token: str, web_client=None):
+        from slack_sdk.socket_mode.aiohttp import SocketModeClient
+
+        self.workers = workers
+        self.client = SocketModeClient(app_token=app_token, web_client=web_client)
+        self.client.socket_mode_request_listeners.append(self.forward)
+        self.client.message_listeners.append(self.on_socket_message)
+        self.links: Dict[int, asyncio.StreamWriter] = {}
+        self.ready = [asyncio.Event() for _ in range(workers)]
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.state: Dict[str, Dict] = {}  # the last broadcast message of each type, for workers started later
+        self.socket_dir = tempfile.mkdtemp(prefix="chatgpt-slack-bot")
+        self.socket_path = os.path.join(self.socket_dir, "workers.sock")
+        self._stopping = False
+
+    async def run(self):
+        """Serves until cancelled, then stops the workers."""
+        server = await asyncio.start_unix_server(self._on_worker, self.socket_path, limit=max_line)
+        monitors = [asyncio.create_task(self._keep_running(index)) for index in range(self.workers)]
+        try:
+            await asyncio.wait_for(asyncio.gather(*[ready.wait() for ready in self.ready]), 60)
+            logging.info("%d workers ready", self.workers)
+            await self.client.connect()
+            await asyncio.Future()  # forever
+        finally:
+            self._stopping = True
+            for monitor in monitors:
+                monitor.cancel()
+            await asyncio.gather(*monitors, return_exceptions=True)
+            await self.client.close()
+            server.close()
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    async def _keep_running(self, index: int):
+        env = dict(os.environ, **worker_env(index, self.workers))
+        args = [sys.executable, os.path.abspath(__file__), "--index", str(index), "--socket", self.socket_path]
+        while True:
+            process = await asyncio.create_subprocess_exec(*args, env=env)
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await asyncio.shield(process.wait())
+                raise
+            self.ready[index].clear()
+            self.links.pop(index, None)
+            if self._stopping:
+                return
+            logging.error("Worker %d exited with %s, restarting", index, code)
+            worker_restarts_total.inc(worker=index)
+            await asyncio.sleep(restart_delay)
+
+    async def _on_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        index = None
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                match message["type"]:
+                    case "hello":
+                        index = message["index"]
+                        for state in self.state.values():
+                            write_message(writer, state)
+                        self.links[index] = writer
+                        self.ready[index].set()
+                    case "response":
+                        future = self.pending.get(message["id"])
+                        if future is not None and not future.done():
+                            future.set_result(message)
+                    case "broadcast":
+                        self.state[message["message"]["type"]] = message["message"]
+                        for other, link in list(self.links.items()):
+                            if other != index:
+                                write_message(link, message["message"])
+        finally:
+            if index is not None and self.links.get(index) is writer:
+                self.links.pop(index)
+                self.ready[index].clear()
+            writer.close()
+
+    async def on_socket_message(self, client, message: Dict, raw_message: Optional[str] = None):
+        """Tells the workers about a new Socket Mode connection, events may have been missed before it."""
+        if message.get("type") == "hello":
+            for link in list(self.links.values()):
+                write_message(link, {"type": "reconnected"})
+
+    async def forward(self, client, req):
+        """Routes a Socket Mode request to its worker and sends the worker's response as the ack."""
+        from slack_bolt.adapter.socket_mode.async_internals import send_async_response
+        from slack_bolt.response import BoltResponse
+
+        t0 = time.time()
+        index = shard_of(req.payload, self.workers)
+        worker_requests_total.inc(worker=index)
+        future = self.pending[req.envelope_id] = asyncio.get_running_loop().create_future()
+        try:
+            async with asyncio.timeout(ack_timeout):
+                await self.ready[index].wait()
+                write_message(self.links[index], {"type": "request", "id": req.envelope_id, "body": req.payload})
+                response = await future
+        except (TimeoutError, KeyError, ConnectionError):  # not acked, Slack retries the request
+            logging.error("Worker %d did not answer request %s in time", index, req.envelope_id)
+            return
+        finally:
+            self.pending.pop(req.envelope_id, None)
+        bolt_response = BoltResponse(status=response["status"], body=response["body"], headers=response["headers"])
+        await send_async_response(client, req, bolt_response, t0)
+
+
+class Worker:
+    """Dispatches the requests of the supervisor to the Bolt app of this process."""
+
+    def __init__(self, index: int, socket_path: str):
+        self.index = index
+        self.socket_path = socket_path
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def run(self):
+        global supervisor_link
+        import app
+        from http_clients import http_clients
+        from metrics import run_metrics
+
+        self.app = app
+        await app.setup()
+        reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=max_line)
+        supervisor_link = writer
+        write_message(writer, {"type": "hello", "index": self.index})
+        metrics_task = asyncio.create_task(run_metrics())
+        try:
+            async with http_clients:
+                while line := await reader.readline():
+                    message = json.loads(line)
+                    if message["type"] == "request":
+                        task = asyncio.create_task(self.dispatch(writer, message))
+                        self.tasks.add(task)
+                        task.add_done_callback(self.tasks.discard)
+                    else:
+                        self.handle_broadcast(message)
+                logging.info("Worker %d: the supervisor is gone, exiting", self.index)
+        finally:
+            metrics_task.cancel()
+            supervisor_link = None
+
+    async def dispatch(self, writer: asyncio.StreamWriter, message: Dict):
+        from slack_bolt.request.async_request import AsyncBoltRequest
+
+        response = await self.app.slack.async_dispatch(AsyncBoltRequest(mode="socket_mode", body=message["body"]))
+        response_message = {
+            "type": "response",
+            "id": message["id"],
+            "status": response.status,
+            "body": response.body,
+            "headers": response.headers,
+        }
+        write_message(writer, response_message)
+        await writer.drain()
+
+    def handle_broadcast(self, message: Dict):
+        """Applies state changes made by another worker or the supervisor, which must be the same in all workers."""
+        match message["type"]:
+            case "openai_key":
+                self.app.openai.set_openai_key(message["key"])
+            case "reconnected":
+                self.app.conversations.clear()
+            case _:
+                logging.error("Worker %d: unknown message %s", self.index, message)
+
+
+def worker_main():
+    parser = argparse.ArgumentParser(description="A worker process of the bot, started by the supervisor.")
+    parser.add_argument("--index", type=int, required=True)
+    parser.add_argument("--socket", required=True)
+    args = parser.parse_args()
+    asyncio.run(Worker(args.index, args.socket).run())
+
+
+if __name__ == "__main__":
+    # run the worker from the imported module, so that app.py shares its `supervisor_link`
+    from workers import worker_main as main
+
+    main()